@@ -0,0 +1,58 @@
+-- Per-commit summary index, one row per (duckdb_commit_sha, benchmark_series, storage_type,
+-- cpu_arch_label, machine_label, queries_sha, query).
+--
+-- This is what utils/benchmark_diff.py compares: "did commit X make TPC-H slower than commit Y"
+-- is answered from this table alone, without going back to query_metrics.
+--
+-- All warm runs of all (non-test) runs of a commit are pooled per query: mean_seconds is the mean
+-- over every timed run, and stddev_seconds is their spread - the noise a difference has to exceed
+-- before it means anything. Pooling across runs on purpose: run-to-run variation (a noisy machine,
+-- a cold cache) is part of the noise, so it belongs in the spread.
+--
+-- queries_sha is part of the key: an edited query is a different measurement, and is never compared
+-- with its previous version.
+--
+-- Failed attempts are counted (runs_failed) but have no timings; a query that failed in every run
+-- of a commit has timed_runs = 0 and NULL timings.
+
+with warm_runs as (
+    select
+        qm.run_id,
+        qm.query,
+        qm.metric_value as seconds
+    from query_metrics qm
+    where qm.metric_name = 'execution_time_seconds'
+      and qm.metric_value is not null
+      and qm.metric_value > 0    -- a non-positive timing is not a measurement
+)
+select
+    r.duckdb_commit_sha,
+    r.duckdb_version,
+    r.benchmark,
+    r.benchmark || coalesce(' @ sf' || printf('%g', r.scale_factor), '') as benchmark_series,
+    r.storage_type,
+    coalesce(r.cpu_arch, 'unknown')         as cpu_arch_label,
+    coalesce(r.machine_type, 'unspecified') as machine_label,
+    r.queries_sha,
+    qr.query,
+    count(distinct qr.run_id)                                  as runs,
+    count(distinct qr.run_id) filter (where qr.status <> 'ok') as runs_failed,
+    count(w.seconds)                                           as timed_runs,
+    avg(w.seconds)                                             as mean_seconds,
+    stddev_samp(w.seconds)                                     as stddev_seconds,
+    median(w.seconds)                                          as median_seconds,
+    min(w.seconds)                                             as fastest_seconds,
+    max(w.seconds)                                             as slowest_seconds,
+    min(r."timestamp")                                         as first_run_timestamp,
+    max(r."timestamp")                                         as last_run_timestamp
+from runs r
+join query_results qr
+    on qr.run_id = r.run_id
+-- left join: a query that failed in every run must still appear (with runs_failed)
+left join warm_runs w
+    on w.run_id = qr.run_id
+   and w.query = qr.query
+   and qr.status = 'ok'
+where not coalesce(r.is_test, false)
+group by all
+order by last_run_timestamp, benchmark_series, storage_type, qr.query;
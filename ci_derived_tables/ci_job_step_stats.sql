@@ -0,0 +1,33 @@
+-- Step durations per week, one row per (week, workflow, job, step).
+--
+-- Reads the flat ci_job_steps table (one row per step, maintained by the ci_metrics feed), not the
+-- nested steps of ci_jobs: answering "which step dominates this job" should not unnest every job.
+--
+-- Steps that did not run (skipped, or cancelled before they started) have no timestamps and are
+-- not counted in the durations; nr_skipped shows how often that happened.
+--
+-- Job names include the matrix values (e.g. 'linux (amd64)'), so matrix entries are separate rows.
+with steps as (
+    select
+        *,
+        -- week of the job: skipped steps have no started_at of their own
+        date_trunc('week', min(started_at) over (partition by job_id))::DATE as week
+    from ci_job_steps
+)
+select
+    week,
+    workflow_name,
+    job_name,
+    number                                           as step_number,
+    name                                             as step_name,
+    count(*)                                         as nr_steps,
+    count(*) filter (where conclusion = 'failure')   as nr_failed,
+    count(*) filter (where duration_seconds is null) as nr_skipped,
+    median(duration_seconds)                         as median_seconds,
+    quantile_cont(duration_seconds, 0.9)             as p90_seconds,
+    sum(duration_seconds)                            as total_seconds
+from steps
+where week is not null
+  and (duration_seconds is null or duration_seconds >= 0)
+group by all
+order by week, workflow_name, job_name, step_number;
@@ -0,0 +1,5 @@
+-- All jobs, hot and archived: the view ci_jobs_all over ci_jobs and ci_jobs_archive (no steps;
+-- those are in ci_job_steps), see feeds/ci_metrics/ci_tiering.py.
+--
+-- Stored in the ci_metrics source as 'ci_jobs'.
+from ci_jobs_all
@@ -0,0 +1,6 @@
+-- All runs, hot and archived: the view ci_runs_all over ci_runs (recent, full payload) and
+-- ci_runs_archive (older runs, analysis columns only), see feeds/ci_metrics/ci_tiering.py.
+--
+-- Stored in the ci_metrics source as 'ci_runs', so the dashboard keeps showing the whole history
+-- with the columns of the archive.
+from ci_runs_all
@@ -0,0 +1 @@
+select * from benchmark_geomean_trend
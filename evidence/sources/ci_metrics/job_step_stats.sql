@@ -0,0 +1 @@
+select * from ci_job_step_stats
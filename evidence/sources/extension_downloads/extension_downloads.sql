@@ -1 +0,0 @@
-select * from extension_downloads
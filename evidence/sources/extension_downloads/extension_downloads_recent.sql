@@ -0,0 +1 @@
+select * from extension_downloads_recent
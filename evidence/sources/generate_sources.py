@@ -10,17 +10,35 @@ run against the lake ('derived_tables'). That is for data which is far too large
 browser raw and only interesting aggregated, e.g. the benchmark results lake, whose query_metrics table
 holds one row per query per warm run per metric.
 
+A derived table can also be a downsampled copy of another table ('downsample' instead of 'sql_file'),
+so a chart of a long time series keeps a roughly constant number of points (see utils/downsample.py).
+
+A read-only lake can be read through a local cache ('local_cache': true), which mirrors its data files
+in ./local_cache/<lake_secret>/, so consecutive builds only fetch the files that are new.
+
+With '--cache', a source whose tables did not change since it was last generated is restored from the build
+cache instead of generated, and the keys of all sources are written for the cache-aware build (see utils/build_cache.py).
+
 run this file via Makefile: 'make generate_sources'
 to refresh a subset (e.g. without having credentials for every lake):
     python3 -m evidence.sources.generate_sources ci_metrics extension_downloads
+to profile every statement (stored in ./profiles/, see utils/query_profiler.py):
+    python3 -m evidence.sources.generate_sources --profile
+with the build cache: 'make generate_sources_cached' (python3 -m evidence.sources.generate_sources --cache)
 """
 
 import json
+import os
 import sys
 from pathlib import Path
+from utils import build_cache
+from utils.downsample import downsample_table
 from utils.ducklake import DuckLakeConnection
+from utils.lake_cache import LakeCache
+from utils.query_profiler import PROFILE_DIR_ENV_VAR, new_profile_dir, print_profile_summary
 
 DEFAULT_LAKE_SECRET = 'ducklake_secret'
+LOCAL_CACHE_DIR = Path("./local_cache")
 
 
 def generate_source(con: DuckLakeConnection, source: dict):
@@ -34,6 +52,16 @@ def generate_source(con: DuckLakeConnection, source: dict):
             else:
                 print(f"Error: table {table} not present in ducklake; can not refresh: {source['db_path']}!")
         for derived in source.get("derived_tables", []):
+            if "downsample" in derived:
+                config = derived["downsample"]
+                # a table of this source (e.g. a derived table above this one) or of the lake
+                in_source = con.sql(
+                    f"select 1 from duckdb_tables() where database_name = '{source['name']}' and table_name = '{config['table']}'"
+                ).fetchone()
+                source_table = f"{source['name']}.main.{config['table']}" if in_source else config['table']
+                downsample_table(con, source_table, f"{source['name']}.main.{derived['name']}", config)
+                print(f"Refreshed file '{source['db_path']}', table: {derived['name']} by downsampling {config['table']}", flush=True)
+                continue
             sql_file = Path(derived["sql_file"])
             if not sql_file.is_file():
                 print(f"Error: sql file not found: {sql_file}; can not refresh: {source['db_path']}!")
@@ -56,8 +84,19 @@ def main():
         sys.exit(1)
     sources = json.loads(sources_config.read_text())
 
+    args = sys.argv[1:]
+    profile_dir = None
+    if '--profile' in args:
+        args.remove('--profile')
+        profile_dir = new_profile_dir('generate_sources')
+        os.environ[PROFILE_DIR_ENV_VAR] = str(profile_dir)
+    use_cache = '--cache' in args
+    if use_cache:
+        args.remove('--cache')
+    manifest = build_cache.load_manifest(build_cache.SOURCES_MANIFEST) if use_cache else {}
+
     # optional positional args: only refresh these sources
-    only = set(sys.argv[1:])
+    only = set(args)
     if only:
         unknown = only - {source["name"] for source in sources}
         if unknown:
@@ -66,18 +105,41 @@ def main():
         sources = [source for source in sources if source["name"] in only]
 
     # group sources per lake, so each lake is attached exactly once
-    lakes: dict[tuple[str, bool], list[dict]] = {}
+    lakes: dict[tuple[str, bool, bool], list[dict]] = {}
     for source in sources:
-        lake = (source.get("lake_secret", DEFAULT_LAKE_SECRET), bool(source.get("read_only", False)))
+        lake = (
+            source.get("lake_secret", DEFAULT_LAKE_SECRET),
+            bool(source.get("read_only", False)),
+            bool(source.get("local_cache", False)),
+        )
         lakes.setdefault(lake, []).append(source)
 
     # create .duckdb source files from ducklake
-    for (lake_secret, read_only), lake_sources in lakes.items():
-        with DuckLakeConnection(lake_secret, read_only=read_only) as con:
+    for (lake_secret, read_only, local_cache), lake_sources in lakes.items():
+        lake_cache = LakeCache(LOCAL_CACHE_DIR / lake_secret) if local_cache else None
+        with DuckLakeConnection(lake_secret, read_only=read_only, lake_cache=lake_cache) as con:
             con.execute(f"SET preserve_insertion_order=false")
             con.execute(f"SET memory_limit = '8GB'")
+            versions = con.table_versions() if use_cache else {}
+            views = con.views() if use_cache else {}
             for source in lake_sources:
+                key = None
+                if use_cache:
+                    keys = build_cache.table_keys(source, versions, views)
+                    key = build_cache.source_key(source, keys)
+                    manifest[source["name"]] = {'key': key, 'tables': keys}
+                    if key and build_cache.restore_source(source, key):
+                        print(f"---\nrestored source {source['name']} from the build cache (unchanged: {key[:12]})", flush=True)
+                        continue
                 generate_source(con, source)
+                if key:
+                    build_cache.store_source(source, key)
+
+    if use_cache:
+        build_cache.save_manifest(build_cache.SOURCES_MANIFEST, manifest)
+
+    if profile_dir:
+        print_profile_summary(profile_dir)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,9 @@
+-- The extension download rollups of the last 104 weeks, one row per (repository, extension, week).
+--
+-- The extension-downloads page ranks the extensions by their downloads in a week range that the reader
+-- selects, so it needs the weekly grain; the export is capped to a fixed window instead, so the source
+-- (and the page load) does not grow with the weeks of history. All-time figures are not lost:
+-- cumulative_downloads counts from the first week in the lake.
+select *
+from extension_downloads_rollups
+where week_start > (select max(week_start) from extension_downloads_rollups) - 104 * 7
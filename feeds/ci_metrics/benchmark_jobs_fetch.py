@@ -0,0 +1,61 @@
+"""
+Compare the cost of fetching jobs via the REST api and via the GraphQL api, in rate-limit points per job.
+Note that both are separate budgets (REST: requests per hour, GraphQL: points per hour).
+
+Reads a sample of recent completed runs from the ducklake (read-only), fetches their jobs with both
+fetchers, and stores nothing.
+
+run this file via Makefile: 'make benchmark_jobs_fetch'
+or: python3 -m feeds.ci_metrics.benchmark_jobs_fetch [nr_runs] [github_repo]
+"""
+
+import sys
+import time
+from dotenv import load_dotenv
+
+from utils.ducklake import DuckLakeConnection
+from .ci_config import *
+from .ci_metrics_feed import fetch_jobs_graphql, fetch_jobs_rest
+from .ci_metrics_utils import get_runs_by_id
+
+load_dotenv()
+
+
+def benchmark(dl_secret: str, nr_runs: int, github_repo: str):
+    with DuckLakeConnection(dl_secret, read_only=True) as con:
+        run_ids = [
+            tup[0]
+            for tup in con.execute(
+                f"""
+                SELECT id FROM {GITHUB_RUNS_TABLE}
+                WHERE status = 'completed' AND repository['full_name'] = ?
+                ORDER BY id DESC
+                LIMIT ?
+                """,
+                [github_repo, nr_runs],
+            ).fetchall()
+        ]
+        runs = get_runs_by_id(con, run_ids)
+    if not runs:
+        raise ValueError(f"no completed runs found for repo '{github_repo}'")
+
+    results = []
+    for fetch_mode in ['rest', 'graphql']:
+        start = time.time()
+        if fetch_mode == 'rest':
+            jobs, points = fetch_jobs_rest(github_repo, run_ids, len(run_ids))
+        else:
+            jobs, points = fetch_jobs_graphql(github_repo, runs, len(runs))
+        results.append((fetch_mode, len(jobs), points, time.time() - start))
+
+    print(f"---\njobs of {len(runs)} runs of {github_repo}:")
+    print(f"{'mode':<10}{'jobs':>8}{'points':>10}{'points/job':>14}{'seconds':>10}")
+    for fetch_mode, nr_jobs, points, seconds in results:
+        points_per_job = points / nr_jobs if nr_jobs else float('nan')
+        print(f"{fetch_mode:<10}{nr_jobs:>8}{points:>10}{points_per_job:>14.3f}{seconds:>10.1f}")
+
+
+if __name__ == "__main__":
+    nr_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    github_repo = sys.argv[2] if len(sys.argv) > 2 else DUCKDB_REPO
+    benchmark('ducklake_secret', nr_runs, github_repo)
@@ -0,0 +1,249 @@
+"""
+Backfill of ci_runs, for the history that the feed can not reach: the feed walks the runs of a repo newest-first
+from page 1 until it finds the last stored run, so for a new repo (or after a long outage) that is one long serial
+crawl that exceeds the rate limit of the repo, and nothing is stored.
+
+- the history of a repo is split in slices by the 'created' date of the runs (GITHUB_BACKFILL_SLICE_DAYS); the
+  plan (one row per slice, with its status) is stored in the lake table 'ci_backfill_slices', so a backfill is
+  resumed slice by slice across cron runs
+- slices are fetched concurrently (GITHUB_BACKFILL_WORKERS threads), and committed in order (oldest first), each
+  slice in one transaction: its runs (deduplicated by id; runs that are already stored are skipped), the slice
+  status, and ci_repositories_metadata.max_run_id = greatest(max_run_id, max id of the slice)
+- committing in order keeps max_run_id consistent: all runs up to it are stored, so the feed connects to it. The
+  plan never starts after the current max_run_id (no gap); runs that are not completed yet end the slice early,
+  as in the feed (see: store_runs), and the slice is fetched again next time
+- the github api returns at most GITHUB_RUNS_MAX_PER_QUERY runs for a 'created' query: larger slices are split
+- the backfill spends the remainder of the rate limit (GITHUB_RATE_LIMITING_FACTOR); what is left is resumed
+
+run this file via Makefile: 'make backfill_ci_runs' (resumes the pending slices of all repos)
+or: python3 -m feeds.ci_metrics.ci_backfill [--repo <org/repo>]... [--from 2024-01-01] [--slice-days 7] [--workers 4] [--local]
+    --repo: plan a backfill for the repo (from --from, or from the creation of the repo), if it has no pending slices
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+import json
+import math
+import sys
+import tempfile
+
+from utils.ducklake import DuckLakeConnection, read_json_sql, retry_on_conflict
+from utils.github_utils import fetch_github_record_list, get_rate_limit, gh_api_request
+from .ci_config import *
+from .ci_schemas import CI_RUNS_SCHEMA
+from .ci_tiering import all_runs_table
+
+load_dotenv()
+
+# max pages of one slice: a probe for the number of runs, and the runs (100 per page)
+MAX_PAGES_PER_SLICE = 1 + GITHUB_RUNS_MAX_PER_QUERY // 100
+
+
+def ensure_backfill_table(con: DuckLakeConnection):
+    con.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {GITHUB_BACKFILL_TABLE} (
+          repository_id BIGINT,
+          full_name VARCHAR,
+          slice_start TIMESTAMP,
+          slice_end TIMESTAMP,
+          status VARCHAR,
+          nr_runs BIGINT,
+          updated_at TIMESTAMP
+        )
+        """
+    )
+
+
+def plan_backfill(con: DuckLakeConnection, github_repo: str, start: datetime | None, slice_days: int):
+    if con.execute(f"select 1 from {GITHUB_BACKFILL_TABLE} where full_name = ? and status = 'pending'", [github_repo]).fetchone():
+        print(f"{github_repo}: resuming the pending backfill")
+        return
+    repo = con.execute(f"select id, created_at from {GITHUB_REPOS_TABLE} where full_name = ?", [github_repo]).fetchone()
+    if not repo:
+        raise ValueError(f"repository '{github_repo}' not found in {GITHUB_REPOS_TABLE}; run the ci_metrics feed first")
+    repository_id, repo_created_at = repo
+    start = start or repo_created_at
+    # never start after the last stored run (max_run_id): the runs in between would be a gap
+    frontier = con.execute(
+        f"""
+        select runs.created_at
+        from {GITHUB_REPOS_METADATA_TABLE} meta join {all_runs_table(con)} runs on runs.id = meta.max_run_id
+        where meta.repository_id = ?
+        """,
+        [repository_id],
+    ).fetchone()
+    if frontier and frontier[0] < start:
+        print(f"{github_repo}: the last stored run was created at {frontier[0]}; backfilling from there")
+        start = frontier[0]
+    con.execute(
+        f"""
+        INSERT INTO {GITHUB_BACKFILL_TABLE}
+        SELECT ?, ?, slice_start, least(slice_start + INTERVAL (?) DAY, now()::TIMESTAMP), 'pending', NULL, now()::TIMESTAMP
+        FROM generate_series(date_trunc('day', ?::TIMESTAMP), now()::TIMESTAMP, INTERVAL (?) DAY) t(slice_start)
+        WHERE slice_start < now()::TIMESTAMP
+        """,
+        [repository_id, github_repo, slice_days, start, slice_days],
+    )
+    nr_slices = con.execute(
+        f"select count(*) from {GITHUB_BACKFILL_TABLE} where full_name = ? and status = 'pending'", [github_repo]
+    ).fetchone()[0]
+    print(f"{github_repo}: planned a backfill from {start} in {nr_slices} slices of {slice_days} days")
+
+
+def created_range(start: datetime, end: datetime) -> str:
+    # github 'created' qualifier; both ends are inclusive, the end of a slice is exclusive
+    return f"{start:%Y-%m-%dT%H:%M:%SZ}..{end - timedelta(seconds=1):%Y-%m-%dT%H:%M:%SZ}"
+
+
+def fetch_slice(github_repo: str, start: datetime, end: datetime) -> tuple[list[dict], int]:
+    # returns the runs created in [start, end), and the number of requests spent
+    endpoint = GITHUB_RUNS_ENDPOINT.format(GITHUB_REPO=github_repo) + f"?created={created_range(start, end)}"
+    total_count = gh_api_request(endpoint, params={"per_page": 1, "page": 1})['total_count']
+    if total_count > GITHUB_RUNS_MAX_PER_QUERY:
+        if end - start <= timedelta(minutes=1):
+            raise ValueError(f"{github_repo}: more than {GITHUB_RUNS_MAX_PER_QUERY} runs created in {created_range(start, end)}")
+        middle = start + timedelta(seconds=int((end - start).total_seconds()) // 2)
+        first_runs, first_requests = fetch_slice(github_repo, start, middle)
+        last_runs, last_requests = fetch_slice(github_repo, middle, end)
+        return first_runs + last_runs, 1 + first_requests + last_requests
+    if total_count == 0:
+        return [], 1
+    _, runs = fetch_github_record_list(endpoint, 'workflow_runs')
+    return runs, 1 + math.ceil(total_count / 100)
+
+
+def store_slice(dl_secret: str, repository_id: int, slice_start: datetime, runs: list[dict]) -> tuple[int, bool]:
+    """
+    Store the runs of one slice in one transaction, with the slice status and the max_run_id of the repo
+    Returns: the number of new runs, and whether the slice is done (False: it has runs that are not completed yet)
+    """
+    runs_str = f"[{',\n'.join([json.dumps(r) for r in runs])}]"
+    with tempfile.NamedTemporaryFile(mode='w+', suffix=".json") as tmp:
+        tmp.write(runs_str)
+        tmp.flush()
+        with DuckLakeConnection(dl_secret) as con:
+            con.execute(f"CREATE TEMPORARY TABLE staged_runs AS {read_json_sql(tmp.name, CI_RUNS_SCHEMA)}")
+            # as in store_runs: only the runs before the oldest run that is not completed (and not stale)
+            stale_timestamp = (datetime.now() - timedelta(hours=GITHUB_RUNS_STALE_DELAY)) if GITHUB_RUNS_STALE_DELAY else None
+            cutoff = con.execute(
+                f"""
+                select min(id) filter (where status != 'completed' {"and updated_at > ?" if stale_timestamp else ''})
+                from staged_runs
+                """,
+                [stale_timestamp] if stale_timestamp else None,
+            ).fetchone()[0]
+            con.execute(
+                f"""
+                CREATE TEMPORARY TABLE slice_runs AS
+                SELECT DISTINCT ON (id) * FROM staged_runs {f"WHERE id < {cutoff}" if cutoff else ''}
+                """
+            )
+            slice_max_run_id = con.sql("select max(id) from slice_runs").fetchone()[0]
+            # runs that are stored already, also in the archive (see: ci_tiering.py); old runs are archived by the next migration
+            stored_runs = all_runs_table(con)
+            nr_new_runs = con.sql(f"select count(*) from slice_runs anti join {stored_runs} using (id)").fetchone()[0]
+            done = cutoff is None
+            statements = [
+                f"insert into {GITHUB_RUNS_TABLE} by name select * from slice_runs anti join {stored_runs} using (id)",
+                f"""
+                update {GITHUB_BACKFILL_TABLE}
+                set status = '{'done' if done else 'pending'}', nr_runs = (select count(*) from slice_runs),
+                    updated_at = now()::TIMESTAMP
+                where repository_id = {repository_id} and slice_start = TIMESTAMP '{slice_start}'
+                """,
+            ]
+            if slice_max_run_id:
+                statements.append(
+                    f"""
+                    MERGE INTO {GITHUB_REPOS_METADATA_TABLE}
+                    USING (select {repository_id} as repository_id, {slice_max_run_id} as max_run_id) as upserts
+                    ON upserts.repository_id = {GITHUB_REPOS_METADATA_TABLE}.repository_id
+                    WHEN MATCHED THEN UPDATE SET max_run_id = greatest({GITHUB_REPOS_METADATA_TABLE}.max_run_id, upserts.max_run_id)
+                    WHEN NOT MATCHED THEN INSERT
+                    """
+                )
+            con.execute_transaction(statements)
+            return nr_new_runs, done
+
+
+def backfill_repo(dl_secret: str, github_repo: str, budget: int, workers: int) -> int:
+    # fetch the pending slices of the repo, a round of 'workers' slices at a time, and commit them in order
+    # returns the remaining budget (requests)
+    with DuckLakeConnection(dl_secret) as con:
+        slices = con.execute(
+            f"""
+            select repository_id, slice_start, slice_end from {GITHUB_BACKFILL_TABLE}
+            where full_name = ? and status = 'pending'
+            order by slice_start
+            """,
+            [github_repo],
+        ).fetchall()
+    print(f"===============\n{github_repo}: {len(slices)} pending slices; budget: {budget} requests", flush=True)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while slices:
+            nr_slices = min(workers, budget // MAX_PAGES_PER_SLICE)
+            if nr_slices == 0:
+                print(f"{github_repo}: rate limit budget spent; {len(slices)} slices left for the next run")
+                break
+            batch, slices = slices[:nr_slices], slices[nr_slices:]
+            futures = [pool.submit(fetch_slice, github_repo, start, end) for _, start, end in batch]
+            for (repository_id, start, end), future in zip(batch, futures):
+                runs, nr_requests = future.result()
+                budget -= nr_requests
+                nr_new_runs, done = retry_on_conflict(lambda: store_slice(dl_secret, repository_id, start, runs))
+                print(f"{github_repo}: slice {start} .. {end}: {len(runs)} runs, {nr_new_runs} new", flush=True)
+                if not done:
+                    # runs that are not completed yet: the later slices are fetched again in a next run
+                    print(f"{github_repo}: slice {start} has runs that are not completed; resuming from here next time")
+                    return budget
+    return budget
+
+
+def run_backfill(dl_secret: str, plan_repos: list[str], start: datetime | None, slice_days: int, workers: int):
+    with DuckLakeConnection(dl_secret) as con:
+        if not con.table_exists(GITHUB_RUNS_TABLE):
+            raise ValueError(f"table {GITHUB_RUNS_TABLE} does not exist; run the ci_metrics feed first")
+        con.execute(f"CREATE TABLE IF NOT EXISTS {GITHUB_REPOS_METADATA_TABLE} (repository_id BIGINT, max_run_id BIGINT)")
+        ensure_backfill_table(con)
+        for github_repo in plan_repos:
+            plan_backfill(con, github_repo, start, slice_days)
+        repos = [
+            tup[0]
+            for tup in con.sql(
+                f"select full_name from {GITHUB_BACKFILL_TABLE} where status = 'pending' group by all order by min(slice_start)"
+            ).fetchall()
+        ]
+    if not repos:
+        print("no pending backfill slices")
+        return
+    budget = int(get_rate_limit() * GITHUB_RATE_LIMITING_FACTOR)
+    for github_repo in repos:
+        budget = backfill_repo(dl_secret, github_repo, budget, workers)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    def pop_option(name, default=None):
+        if name in args:
+            idx = args.index(name)
+            value = args[idx + 1]
+            del args[idx : idx + 2]
+            return value
+        return default
+
+    dl_secret = 'ducklake_secret'
+    if '--local' in args:
+        args.remove('--local')
+        dl_secret = 'ducklake_secret_local'
+    plan_repos = []
+    while (github_repo := pop_option('--repo')) is not None:
+        plan_repos.append(github_repo)
+    start = pop_option('--from')
+    slice_days = int(pop_option('--slice-days', GITHUB_BACKFILL_SLICE_DAYS))
+    workers = int(pop_option('--workers', GITHUB_BACKFILL_WORKERS))
+    if args:
+        raise ValueError(f"Invalid arguments for ci_backfill: {args}")
+    run_backfill(dl_secret, plan_repos, datetime.fromisoformat(start) if start else None, slice_days, workers)
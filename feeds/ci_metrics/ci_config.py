@@ -1,4 +1,5 @@
-GITHUB_ORG = "duckdb"
+# the repositories of all these orgs are ingested (in sharded mode, spread over the workers; see: ci_sharding.py)
+GITHUB_ORGS = ["duckdb"]
 DUCKDB_REPO = "duckdb/duckdb"
 
 # ducklake table names
@@ -7,9 +8,17 @@ GITHUB_REPOS_METADATA_TABLE = "ci_repositories_metadata"
 GITHUB_WORKFLOWS_TABLE = "ci_workflows"
 GITHUB_RUNS_TABLE = "ci_runs"
 GITHUB_JOBS_TABLE = "ci_jobs"
+GITHUB_JOB_STEPS_TABLE = "ci_job_steps"
+GITHUB_LEASES_TABLE = "ci_leases"
+GITHUB_BACKFILL_TABLE = "ci_backfill_slices"
+# cold tier of ci_runs / ci_jobs (see: ci_tiering.py), and the views over both tiers
+GITHUB_RUNS_ARCHIVE_TABLE = "ci_runs_archive"
+GITHUB_JOBS_ARCHIVE_TABLE = "ci_jobs_archive"
+GITHUB_RUNS_VIEW = "ci_runs_all"
+GITHUB_JOBS_VIEW = "ci_jobs_all"
 
 # github endpoints
-GITHUB_REPOS_ENDPOINT = "https://api.github.com/orgs/{GITHUB_ORG}/repos".format(GITHUB_ORG=GITHUB_ORG)
+GITHUB_REPOS_ENDPOINT = "https://api.github.com/orgs/{GITHUB_ORG}/repos"
 GITHUB_WORKFLOWS_ENDPOINT = "https://api.github.com/repos/{GITHUB_REPO}/actions/workflows"
 GITHUB_RUNS_ENDPOINT = "https://api.github.com/repos/{GITHUB_REPO}/actions/runs"
 GITHUB_JOBS_ENDPOINT = "https://api.github.com/repos/{GITHUB_REPO}/actions/runs/{RUN_ID}/jobs"
@@ -22,3 +31,34 @@ GITHUB_RUNS_STALE_DELAY: int | None = 48
 
 # after this number of DAYS, we stop trying to fetch jobs for this run
 GITHUB_RUNS_JOB_CUTOFF: int | None = 10
+
+# how jobs are fetched:
+# - 'rest': one request (page) per run via GITHUB_JOBS_ENDPOINT; spends the REST rate limit
+# - 'graphql': the jobs of GITHUB_GRAPHQL_RUNS_PER_REQUEST runs per request; spends the (separate) GraphQL rate limit
+# note: graphql does not expose created_at, labels and runner info of jobs; these are stored as NULL
+GITHUB_JOBS_FETCH_MODE = "rest"
+GITHUB_GRAPHQL_RUNS_PER_REQUEST = 10
+
+# fetched jobs are stored by a writer thread while fetching continues; max nr of fetched batches (one per repo)
+# waiting to be stored, before fetching blocks (bounds memory)
+GITHUB_JOBS_MAX_PENDING_BATCHES = 4
+
+# sharded mode: a worker holds the lease on a shard (a set of repos) for this number of MINUTES; a lease that is
+# not completed nor renewed in time (e.g. the worker crashed) can be claimed by another worker
+GITHUB_SHARD_LEASE_MINUTES = 60
+
+# backfill of ci_runs (see: ci_backfill.py): the history of a repo is split in slices of this number of DAYS (by the
+# 'created' date of the runs), which are fetched concurrently by GITHUB_BACKFILL_WORKERS threads
+GITHUB_BACKFILL_SLICE_DAYS = 7
+GITHUB_BACKFILL_WORKERS = 4
+# the github api returns at most this number of runs for a filtered ('created') query; larger slices are split
+GITHUB_RUNS_MAX_PER_QUERY = 1000
+
+# tiering (see: ci_tiering.py): runs (and their jobs) created more than this number of DAYS ago are moved from
+# ci_runs / ci_jobs (hot: full payload) to the archive tables (cold: the analysis columns only); must exceed the
+# window in which the feed still updates runs and fetches jobs (GITHUB_RUNS_STALE_DELAY, GITHUB_RUNS_JOB_CUTOFF)
+GITHUB_HOT_DAYS = 90
+# archived runs and jobs older than this number of DAYS are deleted (None: kept forever)
+GITHUB_ARCHIVE_RETENTION_DAYS: int | None = None
+# the archive is written in bulk: large files (per table option of ducklake), partitioned by year
+GITHUB_ARCHIVE_TARGET_FILE_SIZE = "512MB"
@@ -1,13 +1,17 @@
 import json
+import math
 import tempfile
 import re
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
-from utils.ducklake import DuckLakeConnection
-from utils.github_utils import fetch_github_record_list, fetch_github_records, get_rate_limit
-from .ci_metrics_utils import RepoRatelimits, fetch_github_actions_runs, get_recent_run_ids_without_jobs
+from utils.ducklake import DuckLakeConnection, read_json_sql, retry_on_conflict, schema_columns_sql
+from utils.pipeline import StoreWorker
+from utils.github_utils import fetch_github_jobs_graphql, fetch_github_record_list, fetch_github_records, get_rate_limit
+from .ci_metrics_utils import RepoRatelimits, fetch_github_actions_runs, get_recent_run_ids_without_jobs, get_runs_by_id
 from .ci_config import *
+from .ci_schemas import CI_JOB_STEPS_SCHEMA, CI_JOBS_SCHEMA, CI_REPOSITORIES_SCHEMA, CI_RUNS_SCHEMA, CI_WORKFLOWS_SCHEMA
+from .ci_tiering import migrate_to_archive
 
 load_dotenv()
 
@@ -24,17 +28,25 @@ def run(dl_secret: str):
     print(f"===============\nupdating ci jobs")
     update_jobs(repo_names, dl_secret)
     with DuckLakeConnection(dl_secret) as con:
-        con.checkpoint()
+        # the jobs buffered in the local write buffer (if enabled) are stored before the checkpoint
+        con.flush_write_buffer()
+        # move the aged runs and jobs to the archive tables, so the checkpoint only rewrites the hot tier
+        migrate_to_archive(con)
+        con.checkpoint(verify=True)
 
 
 def update_repositories(con: DuckLakeConnection) -> list[str]:
-    repos = fetch_github_records(GITHUB_REPOS_ENDPOINT)
-    if not repos:
-        raise ValueError(f"No repositories could be fetched at endpoint: {GITHUB_REPOS_ENDPOINT}'")
+    repos = []
+    for github_org in GITHUB_ORGS:
+        endpoint = GITHUB_REPOS_ENDPOINT.format(GITHUB_ORG=github_org)
+        org_repos = fetch_github_records(endpoint)
+        if not org_repos:
+            raise ValueError(f"No repositories could be fetched at endpoint: {endpoint}'")
+        repos.extend(org_repos)
     if con.table_exists(GITHUB_REPOS_TABLE) and con.table_empty(GITHUB_REPOS_TABLE):
         raise ValueError(f"Invalid state - Table {GITHUB_REPOS_TABLE} should not be empty")
-    con.create_table(GITHUB_REPOS_TABLE, repos, if_not_exists=True, with_no_data=True)
-    con.upsert_table(GITHUB_REPOS_TABLE, repos, ['id'], print_changes=True)
+    con.create_or_evolve_table(GITHUB_REPOS_TABLE, CI_REPOSITORIES_SCHEMA)
+    con.upsert_table(GITHUB_REPOS_TABLE, repos, ['id'], print_changes=True, schema=CI_REPOSITORIES_SCHEMA)
     repo_names = [repo['full_name'] for repo in repos]
     return repo_names
 
@@ -55,169 +67,270 @@ def update_workflows(github_repos: list[str], con: DuckLakeConnection):
             if con.table_empty(GITHUB_WORKFLOWS_TABLE):
                 raise ValueError(f"Invalid state - Table {GITHUB_WORKFLOWS_TABLE} should not be empty")
             print(f"upserting into {GITHUB_WORKFLOWS_TABLE}")
-            con.upsert_table(GITHUB_WORKFLOWS_TABLE, all_workflows, ['id', 'repository'], True)
+            con.create_or_evolve_table(GITHUB_WORKFLOWS_TABLE, CI_WORKFLOWS_SCHEMA)
+            con.upsert_table(GITHUB_WORKFLOWS_TABLE, all_workflows, ['id', 'repository'], True, schema=CI_WORKFLOWS_SCHEMA)
         else:
-            con.create_table(GITHUB_WORKFLOWS_TABLE, all_workflows)
+            con.create_table(GITHUB_WORKFLOWS_TABLE, all_workflows, schema=CI_WORKFLOWS_SCHEMA)
     else:
         print(f"no workflows found")
 
 
-def update_runs(github_repos: list[str], dl_secret):
+def update_runs(github_repos: list[str], dl_secret, rate_limit_share: float = 1.0):
     # get ducklake state
     with DuckLakeConnection(dl_secret) as con:
         if con.table_exists(GITHUB_RUNS_TABLE):
             if con.table_empty(GITHUB_RUNS_TABLE):
                 raise ValueError(f"Invalid state - Table {GITHUB_RUNS_TABLE} should not be empty")
-            create_table = False
+            con.create_or_evolve_table(GITHUB_RUNS_TABLE, CI_RUNS_SCHEMA)
+        # fetch previous max_run_id per repo from the metadata in the ducklake: where to start fetching (store_runs
+        # re-reads it when storing, and creates the metadata table in its transaction the first time)
+        if con.table_exists(GITHUB_REPOS_METADATA_TABLE):
+            query = f"""
+            SELECT
+              repos.full_name,
+              meta.max_run_id
+            FROM {GITHUB_REPOS_TABLE} repos
+              LEFT JOIN {GITHUB_REPOS_METADATA_TABLE} meta on meta.repository_id = repos.id
+            ORDER BY repos.full_name
+            """
         else:
-            create_table = True
-        # fetch previous max_run_id per repo from the metadata in the ducklake
-        query = f"""
-        SELECT
-          repos.full_name,
-          repos.id,
-          meta.max_run_id
-        FROM {GITHUB_REPOS_TABLE} repos
-          LEFT JOIN {GITHUB_REPOS_METADATA_TABLE} meta on meta.repository_id = repos.id
-        ORDER BY repos.full_name
-        """
+            query = f"SELECT full_name, NULL FROM {GITHUB_REPOS_TABLE} ORDER BY full_name"
         res = con.sql(query).fetchall()
-        repos_max_run_id = {tup[0]: (tup[1], tup[2]) for tup in res}
+        repos_max_run_id = {tup[0]: tup[1] for tup in res}
 
-    # fetch from gh api store in ducklake
-    rate_limits = RepoRatelimits(github_repos)
+    # fetch from gh api; the runs of all repos are stored in one batch (one ducklake commit)
+    rate_limits = RepoRatelimits(github_repos, share=rate_limit_share)
     retry_repo = None
+    new_runs = []
     for github_repo in github_repos:
         rate_limit = rate_limits.get_repo_rate_limit(github_repo)
         assert github_repo in repos_max_run_id
-        repo_id = repos_max_run_id[github_repo][0]
-        repo_max_run_id = repos_max_run_id[github_repo][1]
+        repo_max_run_id = repos_max_run_id[github_repo]
         print(f"current max(id) for {github_repo} in {GITHUB_RUNS_TABLE}: {repo_max_run_id}")
         runs, retry_needed = fetch_github_actions_runs(rate_limit, github_repo, repo_max_run_id)
         if retry_needed and retry_repo is None:
             retry_repo = github_repo
-        if runs:
-            store_runs(dl_secret, runs, create_table, repo_id, repo_max_run_id)
-            create_table = False
+        new_runs.extend(runs)
     # per run, retry max one repo with remainder of rate limit:
     if retry_repo:
         github_repo = retry_repo
-        rate_limit = get_rate_limit() * GITHUB_RATE_LIMITING_FACTOR
+        rate_limit = get_rate_limit() * GITHUB_RATE_LIMITING_FACTOR * rate_limit_share
         print(f"retry fetching runs for repo '{github_repo}' with rate limit: {rate_limit}")
-        repo_id = repos_max_run_id[github_repo][0]
-        repo_max_run_id = repos_max_run_id[github_repo][1]
-        runs, _ = fetch_github_actions_runs(rate_limit, github_repo, repo_max_run_id)
-        if runs:
-            store_runs(dl_secret, runs, create_table, repo_id, repo_max_run_id)
+        runs, _ = fetch_github_actions_runs(rate_limit, github_repo, repos_max_run_id[github_repo])
+        new_runs.extend(runs)
+    if new_runs:
+        # concurrent workers (sharded mode, webhook receiver) update the metadata table in parallel; retry on a
+        # commit conflict (store_runs re-reads the stored state)
+        retry_on_conflict(lambda: store_runs(dl_secret, new_runs))
 
 
-def update_jobs(github_repos: list[str], dl_secret):
-    rate_limits = RepoRatelimits(github_repos)
+def update_jobs(
+    github_repos: list[str],
+    dl_secret,
+    fetch_mode: str = GITHUB_JOBS_FETCH_MODE,
+    rate_limit_share: float = 1.0,
+    skip_existing: bool = False,
+):
+    # skip_existing: when other writers may store the same jobs meanwhile (e.g. sharded workers, see: store_jobs)
+    assert fetch_mode in ['rest', 'graphql'], f"invalid jobs fetch mode: '{fetch_mode}'"
+    rate_limits = RepoRatelimits(github_repos, 'core' if fetch_mode == 'rest' else 'graphql', share=rate_limit_share)
     # get runs without jobs
     with DuckLakeConnection(dl_secret) as con:
         assert con.table_exists(GITHUB_RUNS_TABLE), f"tabel {GITHUB_RUNS_TABLE} does not exist"
         if con.table_exists(GITHUB_JOBS_TABLE):
             if con.table_empty(GITHUB_JOBS_TABLE):
                 raise ValueError(f"Invalid state - Table {GITHUB_JOBS_TABLE} should not be empty")
-            create_table = False
-        else:
-            create_table = True
+            con.create_or_evolve_table(GITHUB_JOBS_TABLE, CI_JOBS_SCHEMA)
         repo_runs: dict[str, list] = get_recent_run_ids_without_jobs(con)
+        if fetch_mode == 'graphql':
+            runs_by_id = {run['id']: run for run in get_runs_by_id(con, [i for ids in repo_runs.values() for i in ids])}
+
+    # store in ducklake in a writer thread, so fetching the next repo continues meanwhile
+    def store_batches(batches: list[list[dict]]):
+        jobs = [job for batch in batches for job in batch]
+        # store_jobs re-reads the stored state on a retry
+        retry_on_conflict(lambda: store_jobs(dl_secret, jobs, skip_existing))
 
     # fetch jobs for runs without jobs
-    for github_repo in github_repos:
-        assert (
-            github_repo in repo_runs
-        ), f"repo {github_repo} not found in query output: 'get_recent_run_ids_without_jobs'"
-        rate_limit = rate_limits.get_repo_rate_limit(github_repo)
-        run_ids = repo_runs[github_repo]
-        run_ids_count = len(run_ids)
-        print(f"jobs need to be fetched for {run_ids_count} runs for repo {github_repo}")
-        if run_ids_count > rate_limit:
-            print(f"applying rate limit: fetching jobs for {rate_limit} runs")
-
-        # fetch jobs from github
-        new_jobs = []
-        if run_ids:
-            print('fetching jobs per run:')
-        total_runs = min(run_ids_count, rate_limit)
-        for idx, run_id in enumerate(run_ids):
-            if idx + 1 > rate_limit:
-                break
-            print(f"{idx + 1}/{total_runs}", flush=True)
-            endpoint = GITHUB_JOBS_ENDPOINT.format(GITHUB_REPO=github_repo, RUN_ID=run_id)
-            try:
-                _, jobs = fetch_github_record_list(endpoint, 'jobs', rate_limit, detail_log=True)
-                new_jobs.extend(jobs)
-            except ValueError as e:
-                print(f"::notice title=could not fetch job::endpoint: '{endpoint}'; Error: {e}")
-
-        # store in ducklake
-        if new_jobs:
-            store_jobs(dl_secret, new_jobs, create_table)
-            create_table = False
-
-
-def store_runs(dl_secret, runs, create_table, repo_id, latest_previously_stored, max_age: int | None = GITHUB_RUNS_STALE_DELAY):
+    with StoreWorker(store_batches, max_pending=GITHUB_JOBS_MAX_PENDING_BATCHES) as writer:
+        for github_repo in github_repos:
+            assert (
+                github_repo in repo_runs
+            ), f"repo {github_repo} not found in query output: 'get_recent_run_ids_without_jobs'"
+            rate_limit = rate_limits.get_repo_rate_limit(github_repo)
+            run_ids = repo_runs[github_repo]
+            print(f"jobs need to be fetched for {len(run_ids)} runs for repo {github_repo}")
+
+            # fetch jobs from github
+            if fetch_mode == 'rest':
+                new_jobs, points = fetch_jobs_rest(github_repo, run_ids, rate_limit)
+            else:
+                new_jobs, points = fetch_jobs_graphql(github_repo, [runs_by_id[run_id] for run_id in run_ids], rate_limit)
+            if new_jobs:
+                print(f"{fetch_mode}: {points} rate-limit points for {len(new_jobs)} jobs ({points / len(new_jobs):.3f} points/job)")
+                writer.put(new_jobs)
+
+
+def fetch_jobs_rest(github_repo: str, run_ids: list[int], rate_limit: int) -> tuple[list[dict], int]:
+    # one request per page of jobs per run; returns the jobs and the nr of requests (= rate-limit points)
+    run_ids_count = len(run_ids)
+    if run_ids_count > rate_limit:
+        print(f"applying rate limit: fetching jobs for {rate_limit} runs")
+    new_jobs = []
+    points = 0
+    if run_ids:
+        print('fetching jobs per run:')
+    total_runs = min(run_ids_count, rate_limit)
+    for idx, run_id in enumerate(run_ids):
+        if idx + 1 > rate_limit:
+            break
+        print(f"{idx + 1}/{total_runs}", flush=True)
+        endpoint = GITHUB_JOBS_ENDPOINT.format(GITHUB_REPO=github_repo, RUN_ID=run_id)
+        try:
+            total_count, jobs = fetch_github_record_list(endpoint, 'jobs', rate_limit, detail_log=True)
+            new_jobs.extend(jobs)
+            points += max(1, math.ceil(total_count / 100))
+        except ValueError as e:
+            points += 1
+            print(f"::notice title=could not fetch job::endpoint: '{endpoint}'; Error: {e}")
+    return new_jobs, points
+
+
+def fetch_jobs_graphql(github_repo: str, runs: list[dict], rate_limit: int) -> tuple[list[dict], int]:
+    # many runs per request; returns the jobs and the spent graphql rate-limit points
+    if not runs:
+        return [], 0
+    # the rate limit is in points; a query costs at least 1 point, so it also bounds the nr of requests
+    new_jobs, nr_runs_fetched, points = fetch_github_jobs_graphql(
+        github_repo, runs, GITHUB_GRAPHQL_RUNS_PER_REQUEST, max_requests=rate_limit, detail_log=True
+    )
+    if nr_runs_fetched < len(runs):
+        print(f"applying rate limit: fetched jobs for {nr_runs_fetched} of {len(runs)} runs")
+    return new_jobs, points
+
+
+def store_runs(
+    dl_secret, runs: list[dict], max_age: int | None = GITHUB_RUNS_STALE_DELAY, advance_max_run_id: bool = True
+) -> dict[int, int]:
+    """
+    Store the runs of many repos in one transaction (i.e. one ducklake snapshot)
+    The stored state (max_run_id per repo, the runs that are stored) is read in the same transaction, so runs that
+    a concurrent writer stored in the meantime are not stored again, and max_run_id never goes down.
+    Args:
+        advance_max_run_id: the runs are all runs after max_run_id (as the polling feed fetches them), so max_run_id
+            can move past them; False for runs that may have gaps (e.g. webhook deliveries; a run above max_run_id
+            that is missing would never be fetched)
+    Returns: the new max run id per repository id, for the repos with new runs
+    """
     runs_str = f"[{',\n'.join([json.dumps(r) for r in runs])}]"
-    with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix=".json") as tmp:
+    with tempfile.NamedTemporaryFile(mode='w+', suffix=".json") as tmp:
         tmp.write(runs_str)
         tmp.flush()
         with DuckLakeConnection(dl_secret) as con:
-            # subquery to fetch only consecutive completed runs (i.e. no 'queued' or 'in progress' in between)
+            con.execute(f"CREATE TEMPORARY TABLE staged_runs AS {read_json_sql(tmp.name, CI_RUNS_SCHEMA)}")
+            # per repo, only store consecutive completed runs (i.e. no 'queued' or 'in progress' in between)
             # Note: max_age age can be set to to filter out stale runs.
             stale_timestamp = (
                 (datetime.now() - timedelta(hours=max_age)).strftime("%Y-%m-%d %H:%M:%S") if max_age else None
             )
-            oldest_non_completed = con.sql(
-                f"""select min(id) from read_json('{tmp.name}') where status != 'completed'
-                {f"and updated_at > TIMESTAMP '{stale_timestamp}'" if stale_timestamp else ''}
+            # the runs that can be stored, and of these the runs that are not stored yet
+            q_completed_runs = f"""
+                CREATE OR REPLACE TEMPORARY TABLE completed_runs AS
+                WITH cutoffs AS (
+                  SELECT
+                    repository['id'] AS repository_id,
+                    min(id) FILTER (
+                      WHERE status != 'completed'
+                      {f"AND updated_at > TIMESTAMP '{stale_timestamp}'" if stale_timestamp else ''}
+                    ) AS oldest_non_completed
+                  FROM staged_runs
+                  GROUP BY ALL
+                )
+                SELECT DISTINCT ON (staged_runs.id) staged_runs.*
+                FROM staged_runs
+                  JOIN cutoffs ON cutoffs.repository_id = staged_runs.repository['id']
+                  LEFT JOIN {GITHUB_REPOS_METADATA_TABLE} meta ON meta.repository_id = staged_runs.repository['id']
+                WHERE (cutoffs.oldest_non_completed IS NULL OR staged_runs.id < cutoffs.oldest_non_completed)
+                  AND (meta.max_run_id IS NULL OR staged_runs.id > meta.max_run_id)
                 """
-            ).fetchone()[0]
-            subquery = f"""
-                        (
-                        select * from read_json('{tmp.name}')
-                        where True
-                        {f"and id < {oldest_non_completed}" if oldest_non_completed else ''}
-                        {f"and id > {latest_previously_stored}" if latest_previously_stored else ''}
-                        )
-                        """
-            if not con.sql(f"select 1 from {subquery} limit 1").fetchone():
-                print("no new runs to store")
-                return
-
-            # update runs and metadata in a transaction:
-            new_max_run_id = con.sql(f"select max(id) from ({subquery})").fetchone()[0]
-            if create_table:
-                q_store_runs = f"create table {GITHUB_RUNS_TABLE} as {subquery}"
-            else:
-                q_store_runs = f"insert into {GITHUB_RUNS_TABLE} {subquery}"
+            # runs that are stored already: only the hot tier is read, the runs in the archive (see: ci_tiering.py) are
+            # older than max_run_id of their repo, and are not in completed_runs
+            q_new_runs = f"CREATE OR REPLACE TEMPORARY TABLE new_runs AS FROM completed_runs ANTI JOIN {GITHUB_RUNS_TABLE} stored USING (id)"
+            # update runs and metadata of all repos in a transaction (the tables are created in it, the first time):
+            q_create_runs = f"CREATE TABLE IF NOT EXISTS {GITHUB_RUNS_TABLE} ({schema_columns_sql(CI_RUNS_SCHEMA)})"
+            q_create_metadata = f"CREATE TABLE IF NOT EXISTS {GITHUB_REPOS_METADATA_TABLE} (repository_id BIGINT, max_run_id BIGINT)"
+            q_store_runs = f"insert into {GITHUB_RUNS_TABLE} by name from new_runs"
             q_update_metadata = f"""
                                  MERGE INTO {GITHUB_REPOS_METADATA_TABLE}
-                                 USING (select {repo_id} repository_id, {new_max_run_id} max_run_id) as upserts
+                                 USING (select repository['id'] repository_id, max(id) max_run_id from completed_runs group by all) as upserts
                                  ON upserts.repository_id = {GITHUB_REPOS_METADATA_TABLE}.repository_id
-                                 WHEN MATCHED THEN UPDATE
+                                 WHEN MATCHED THEN UPDATE SET max_run_id = greatest({GITHUB_REPOS_METADATA_TABLE}.max_run_id, upserts.max_run_id)
                                  WHEN NOT MATCHED THEN INSERT
                                  """
-            con.execute_transaction([q_store_runs, q_update_metadata])
+            statements = [q_create_runs, q_create_metadata, q_completed_runs, q_new_runs, q_store_runs]
+            con.execute_transaction(statements + [q_update_metadata] if advance_max_run_id else statements)
+            new_max_run_ids = con.sql(
+                "SELECT repository['id'] AS repository_id, max(id) AS max_run_id, count(*) AS nr_runs FROM new_runs GROUP BY ALL ORDER BY ALL"
+            ).fetchall()
+            if not new_max_run_ids:
+                print("no new runs to store")
+                return {}
             print('stored runs:')
-            con.sql(f"select id, created_at, status, html_url, '...' as 'more ...' from {subquery} order by id").show()
+            for repository_id, max_run_id, nr_runs in new_max_run_ids:
+                print(f"repository id {repository_id}: {nr_runs} runs, max(id): {max_run_id}")
+            return {repository_id: max_run_id for repository_id, max_run_id, _ in new_max_run_ids}
 
 
-def store_jobs(dl_secret, jobs, create_table):
+def store_jobs(dl_secret, jobs, skip_existing: bool = False):
+    # skip_existing: skip jobs that are already stored (e.g. when jobs may be delivered more than once, or a shard is
+    # processed by two workers)
     jobs_str = f"[{',\n'.join([json.dumps(j) for j in jobs])}]"
     with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix=".json") as tmp:
         tmp.write(jobs_str)
         tmp.flush()
         with DuckLakeConnection(dl_secret) as con:
-            subquery = f"(select * from read_json('{tmp.name}'))"
-            if create_table:
-                con.execute(f"create table {GITHUB_JOBS_TABLE} as {subquery}")
-            else:
-                con.execute(f"insert into {GITHUB_JOBS_TABLE} {subquery}")
+            subquery = f"({read_json_sql(tmp.name, CI_JOBS_SCHEMA)})"
+            # the first store creates the table (update_jobs evolves it)
+            if not con.table_exists(GITHUB_JOBS_TABLE):
+                con.create_or_evolve_table(GITHUB_JOBS_TABLE, CI_JOBS_SCHEMA)
+            ensure_job_steps_table(con)
+            # by name: the stored table may have more columns than the schema, in a different order
+            if skip_existing:
+                subquery = f"(select * from {subquery} where id not in (select id from {GITHUB_JOBS_TABLE}))"
+            con.execute(f"CREATE TEMPORARY TABLE staged_jobs AS {subquery}")
+            # the jobs and their steps in one transaction
+            con.insert_tables_by_name(
+                [(GITHUB_JOBS_TABLE, "(from staged_jobs)"), (GITHUB_JOB_STEPS_TABLE, f"({job_steps_sql('staged_jobs')})")]
+            )
             print('stored jobs:')
-            con.sql(f"select * from {subquery} order by id").show()
+            con.sql("select * from staged_jobs order by id").show()
+
+
+def job_steps_sql(jobs_table: str) -> str:
+    # one row per step of the jobs in jobs_table (with the columns of CI_JOB_STEPS_SCHEMA)
+    return f"""
+        select
+          job_id, run_id, workflow_name, job_name,
+          step.number, step.name, step.status, step.conclusion, step.started_at, step.completed_at,
+          epoch(step.completed_at - step.started_at)::DOUBLE as duration_seconds
+        from (
+          select id as job_id, run_id, workflow_name, name as job_name, unnest(steps) as step
+          from {jobs_table}
+        )
+        """
+
 
+def ensure_job_steps_table(con: DuckLakeConnection):
+    # the steps table is created (and backfilled with the steps of the stored jobs) once; after that, steps are
+    # added with their jobs (see: store_jobs)
+    if con.table_exists(GITHUB_JOB_STEPS_TABLE):
+        con.create_or_evolve_table(GITHUB_JOB_STEPS_TABLE, CI_JOB_STEPS_SCHEMA)
+        return
+    statements = [f"create table {GITHUB_JOB_STEPS_TABLE} ({schema_columns_sql(CI_JOB_STEPS_SCHEMA)})"]
+    if con.table_exists(GITHUB_JOBS_TABLE):
+        print(f"backfilling {GITHUB_JOB_STEPS_TABLE} from {GITHUB_JOBS_TABLE}", flush=True)
+        statements.append(f"insert into {GITHUB_JOB_STEPS_TABLE} by name {job_steps_sql(GITHUB_JOBS_TABLE)}")
+    con.execute_transaction(statements)
 
 if __name__ == "__main__":
     run()
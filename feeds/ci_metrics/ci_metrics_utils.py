@@ -8,9 +8,10 @@ from .ci_config import *
 class RepoRatelimits:
     # repo 'duckdb/duckdb' gets 10% of the rate limit
     # other repos equally share the remainder
-    def __init__(self, repo_names):
+    # share: the fraction of the rate limit for these repos (e.g. when several workers share the credentials)
+    def __init__(self, repo_names, resource: str = 'core', share: float = 1.0):
         nr_other_repos = len(repo_names) - 1 if DUCKDB_REPO in repo_names else len(repo_names)
-        self.total = int(get_rate_limit() * GITHUB_RATE_LIMITING_FACTOR)
+        self.total = int(get_rate_limit(resource) * GITHUB_RATE_LIMITING_FACTOR * share)
         if DUCKDB_REPO in repo_names:
             self.duckdb = int(self.total * 0.1) if nr_other_repos > 0 else self.total
         else:
@@ -81,3 +82,17 @@ def get_recent_run_ids_without_jobs(con: DuckLakeConnection) -> dict[str, list]:
     ).fetchall()
     repo_jobs: dict[str, list] = {tup[0]: (tup[1] if tup[1] != [None] else []) for tup in res}
     return repo_jobs
+
+
+def get_runs_by_id(con: DuckLakeConnection, run_ids: list[int]) -> list[dict]:
+    # the run properties needed to fetch (and fill in) jobs via the graphql api, see: fetch_github_jobs_graphql
+    if not run_ids:
+        return []
+    res = con.execute(f"""
+    SELECT id, node_id, run_attempt, head_sha, head_branch, name, html_url
+    FROM {GITHUB_RUNS_TABLE}
+    WHERE id IN (SELECT unnest($run_ids))
+    ORDER BY id
+    """, {"run_ids": run_ids})
+    columns = [col[0] for col in res.description]
+    return [dict(zip(columns, row)) for row in res.fetchall()]
@@ -0,0 +1,145 @@
+# schema registry for the ci tables: explicit column types, used as 'columns=' for read_json
+# - no type sniffing at ingest: every batch is read with the same types, whatever the first batch looked like
+# - json keys that are not listed here are dropped at ingest, also inside structs; this is where the heavy
+#   nested payloads go (e.g. the full 'owner' object with ~20 urls, repeated in every run and repository)
+# - to store a new field: add it here; it is added to the existing table with ALTER TABLE on the next run
+#   (see: DuckLakeConnection.create_or_evolve_table)
+# - note: timestamps are stored as TIMESTAMP (UTC), as the type sniffer did before
+
+ACTOR_TYPE = "STRUCT(login VARCHAR, id BIGINT, type VARCHAR)"
+
+CI_REPOSITORIES_SCHEMA = {
+    "id": "BIGINT",
+    "node_id": "VARCHAR",
+    "name": "VARCHAR",
+    "full_name": "VARCHAR",
+    "private": "BOOLEAN",
+    "owner": ACTOR_TYPE,
+    "html_url": "VARCHAR",
+    "description": "VARCHAR",
+    "fork": "BOOLEAN",
+    "url": "VARCHAR",
+    "created_at": "TIMESTAMP",
+    "updated_at": "TIMESTAMP",
+    "pushed_at": "TIMESTAMP",
+    "homepage": "VARCHAR",
+    "size": "BIGINT",
+    "stargazers_count": "BIGINT",
+    "watchers_count": "BIGINT",
+    "language": "VARCHAR",
+    "forks_count": "BIGINT",
+    "archived": "BOOLEAN",
+    "disabled": "BOOLEAN",
+    "open_issues_count": "BIGINT",
+    "license": "STRUCT(key VARCHAR, name VARCHAR, spdx_id VARCHAR)",
+    "topics": "VARCHAR[]",
+    "visibility": "VARCHAR",
+    "default_branch": "VARCHAR",
+}
+
+CI_WORKFLOWS_SCHEMA = {
+    "id": "BIGINT",
+    "node_id": "VARCHAR",
+    "name": "VARCHAR",
+    "path": "VARCHAR",
+    "state": "VARCHAR",
+    "created_at": "TIMESTAMP",
+    "updated_at": "TIMESTAMP",
+    "url": "VARCHAR",
+    "html_url": "VARCHAR",
+    "badge_url": "VARCHAR",
+    "repository": "VARCHAR",  # added by the feed: 'org/repo_name'
+}
+
+CI_RUNS_SCHEMA = {
+    "id": "BIGINT",
+    "name": "VARCHAR",
+    "node_id": "VARCHAR",
+    "head_branch": "VARCHAR",
+    "head_sha": "VARCHAR",
+    "path": "VARCHAR",
+    "display_title": "VARCHAR",
+    "run_number": "BIGINT",
+    "event": "VARCHAR",
+    "status": "VARCHAR",
+    "conclusion": "VARCHAR",
+    "workflow_id": "BIGINT",
+    "check_suite_id": "BIGINT",
+    "check_suite_node_id": "VARCHAR",
+    "url": "VARCHAR",
+    "html_url": "VARCHAR",
+    "pull_requests": "STRUCT(id BIGINT, number BIGINT)[]",
+    "created_at": "TIMESTAMP",
+    "updated_at": "TIMESTAMP",
+    "actor": ACTOR_TYPE,
+    "run_attempt": "BIGINT",
+    "run_started_at": "TIMESTAMP",
+    "triggering_actor": ACTOR_TYPE,
+    "jobs_url": "VARCHAR",
+    "head_commit": "STRUCT(id VARCHAR, tree_id VARCHAR, message VARCHAR, \"timestamp\" TIMESTAMP)",
+    "repository": "STRUCT(id BIGINT, name VARCHAR, full_name VARCHAR, private BOOLEAN)",
+    "head_repository": "STRUCT(id BIGINT, name VARCHAR, full_name VARCHAR, private BOOLEAN)",
+}
+
+CI_JOBS_SCHEMA = {
+    "id": "BIGINT",
+    "run_id": "BIGINT",
+    "workflow_name": "VARCHAR",
+    "head_branch": "VARCHAR",
+    "run_url": "VARCHAR",
+    "run_attempt": "BIGINT",
+    "node_id": "VARCHAR",
+    "head_sha": "VARCHAR",
+    "url": "VARCHAR",
+    "html_url": "VARCHAR",
+    "status": "VARCHAR",
+    "conclusion": "VARCHAR",
+    "created_at": "TIMESTAMP",
+    "started_at": "TIMESTAMP",
+    "completed_at": "TIMESTAMP",
+    "name": "VARCHAR",
+    "steps": (
+        "STRUCT(name VARCHAR, status VARCHAR, conclusion VARCHAR, number BIGINT,"
+        " started_at TIMESTAMP, completed_at TIMESTAMP)[]"
+    ),
+    "check_run_url": "VARCHAR",
+    "labels": "VARCHAR[]",
+    "runner_id": "BIGINT",
+    "runner_name": "VARCHAR",
+    "runner_group_id": "BIGINT",
+    "runner_group_name": "VARCHAR",
+}
+
+# flat table with one row per job step (see: ci_metrics_feed.job_steps_sql), so step-level queries do not have to
+# unnest the steps of every job; job and workflow name are repeated, so most queries need no join with ci_jobs
+CI_JOB_STEPS_SCHEMA = {
+    "job_id": "BIGINT",
+    "run_id": "BIGINT",
+    "workflow_name": "VARCHAR",
+    "job_name": "VARCHAR",
+    "number": "BIGINT",
+    "name": "VARCHAR",
+    "status": "VARCHAR",
+    "conclusion": "VARCHAR",
+    "started_at": "TIMESTAMP",
+    "completed_at": "TIMESTAMP",
+    "duration_seconds": "DOUBLE",
+}
+
+# the cold tier (see: ci_tiering.py) keeps the columns that analyses use: no urls, node ids, nested payloads
+# (head_commit, triggering_actor, pull_requests) or job steps (those are in ci_job_steps)
+CI_RUNS_ARCHIVE_SCHEMA = {
+    col: CI_RUNS_SCHEMA[col]
+    for col in [
+        "id", "name", "head_branch", "head_sha", "path", "run_number", "event", "status", "conclusion", "workflow_id",
+        "created_at", "updated_at", "actor", "run_attempt", "run_started_at", "repository",
+    ]
+}
+
+CI_JOBS_ARCHIVE_SCHEMA = {
+    col: CI_JOBS_SCHEMA[col]
+    for col in [
+        "id", "run_id", "workflow_name", "head_branch", "run_attempt", "head_sha", "status", "conclusion",
+        "created_at", "started_at", "completed_at", "name", "labels", "runner_name", "runner_group_name",
+    ]
+}
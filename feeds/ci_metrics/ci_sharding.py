@@ -0,0 +1,198 @@
+"""
+Sharded mode of the ci_metrics feed: the repositories (of all GITHUB_ORGS) are split in N shards, and any
+number of workers (e.g. the jobs of a GitHub Actions matrix, or local processes) process the shards in parallel.
+
+- shard of a repo: crc32(full_name) % N (stable across runs and workers)
+- a worker claims a shard via the lease table 'ci_leases' in the ducklake (one row per shard): it sets its
+  worker id, the round id and an expiry (GITHUB_SHARD_LEASE_MINUTES). Claiming is an UPDATE, so two workers
+  claiming concurrently conflict on commit; the loser retries (optimistic concurrency) and picks another shard.
+- a shard is claimed once per round (e.g. per workflow run: all matrix jobs share GITHUB_RUN_ID), unless its
+  lease expired before it was completed (e.g. the worker crashed). A worker whose lease expired may still be
+  processing the shard: runs and jobs that are stored already are skipped (see: store_runs, store_jobs)
+- per shard, the worker runs the same steps as the feed: workflows, runs and jobs of the shard's repos; each
+  commit is retried on a conflict with the commits of other workers (see: utils/ducklake.py: retry_on_conflict)
+- the rate limit of the (shared) github credentials is split evenly over the shards
+- the local write buffer (DUCKLAKE_WRITE_BUFFER_DIR, see: utils/write_buffer.py) is not used by workers: its file
+  is per lake, so workers would share it, and a shard already stores its jobs in a few commits
+- the checkpoint is not run by the workers (it should not run concurrently with writers); run the
+  non-sharded feed, or call DuckLakeConnection.checkpoint(), after all workers are done
+
+run a worker:
+    python3 -m feeds.ci_metrics.ci_sharding --shards 4 [--worker <id>] [--round <id>] [--local]
+run N workers as local processes (e.g. to test):
+    python3 -m feeds.ci_metrics.ci_sharding --shards 4 --local-workers 4 [--local]
+"""
+
+from datetime import datetime
+from dotenv import load_dotenv
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import zlib
+
+from utils.ducklake import DuckLakeConnection, retry_on_conflict
+from utils.write_buffer import WRITE_BUFFER_DIR_ENV_VAR
+from .ci_config import *
+from .ci_metrics_feed import update_jobs, update_repositories, update_runs, update_workflows
+
+load_dotenv()
+
+
+def shard_of(github_repo: str, nr_shards: int) -> int:
+    return zlib.crc32(github_repo.encode('utf-8')) % nr_shards
+
+
+def default_round_id() -> str:
+    # all jobs of a workflow run share the run id; otherwise: the current hour
+    return os.getenv('GITHUB_RUN_ID') or datetime.now().strftime('%Y%m%d%H')
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def ensure_lease_table(con: DuckLakeConnection, nr_shards: int):
+    shards = []
+    if con.table_exists(GITHUB_LEASES_TABLE):
+        shards = [tup[0] for tup in con.sql(f"select shard from {GITHUB_LEASES_TABLE} order by shard").fetchall()]
+    if shards != list(range(nr_shards)):
+        # (re)create one row per shard; concurrent workers doing the same conflict, and retry
+        print(f"creating lease table {GITHUB_LEASES_TABLE} for {nr_shards} shards")
+        con.execute(
+            f"""
+            CREATE OR REPLACE TABLE {GITHUB_LEASES_TABLE} AS
+            SELECT
+              range::INTEGER AS shard,
+              NULL::VARCHAR AS round_id,
+              NULL::VARCHAR AS worker_id,
+              NULL::TIMESTAMP AS leased_until,
+              false AS completed
+            FROM range({nr_shards})
+            """
+        )
+
+
+def claimable(round_id: str) -> str:
+    # not yet claimed in this round, or claimed but not completed and expired
+    return f"(round_id IS DISTINCT FROM '{round_id}' OR (NOT completed AND leased_until < now()::TIMESTAMP))"
+
+
+def claim_shard(dl_secret: str, nr_shards: int, worker_id: str, round_id: str) -> int | None:
+    def claim():
+        with DuckLakeConnection(dl_secret) as con:
+            ensure_lease_table(con, nr_shards)
+            candidates = [
+                tup[0]
+                for tup in con.sql(f"select shard from {GITHUB_LEASES_TABLE} where {claimable(round_id)}").fetchall()
+            ]
+            # random order: concurrent workers mostly try different shards
+            random.shuffle(candidates)
+            for shard in candidates:
+                con.execute(
+                    f"""
+                    UPDATE {GITHUB_LEASES_TABLE}
+                    SET round_id = '{round_id}', worker_id = '{worker_id}', completed = false,
+                        leased_until = now()::TIMESTAMP + INTERVAL {GITHUB_SHARD_LEASE_MINUTES} MINUTE
+                    WHERE shard = {shard} AND {claimable(round_id)}
+                    """
+                )
+                owner = con.sql(
+                    f"select round_id, worker_id from {GITHUB_LEASES_TABLE} where shard = {shard}"
+                ).fetchone()
+                if owner == (round_id, worker_id):
+                    return shard
+            return None
+
+    return retry_on_conflict(claim, max_attempts=10)
+
+
+def update_lease(dl_secret: str, shard: int, worker_id: str, round_id: str, completed: bool = False):
+    # renew the lease, or mark the shard as completed for this round
+    def update():
+        with DuckLakeConnection(dl_secret) as con:
+            con.execute(
+                f"""
+                UPDATE {GITHUB_LEASES_TABLE}
+                SET completed = {str(completed).lower()},
+                    leased_until = now()::TIMESTAMP + INTERVAL {GITHUB_SHARD_LEASE_MINUTES} MINUTE
+                WHERE shard = {shard} AND round_id = '{round_id}' AND worker_id = '{worker_id}'
+                """
+            )
+
+    retry_on_conflict(update, max_attempts=10)
+
+
+def run_worker(dl_secret: str, nr_shards: int, worker_id: str, round_id: str):
+    for value in [worker_id, round_id]:
+        assert re.fullmatch(r"[A-Za-z0-9_.-]+", value), f"invalid worker or round id: '{value}'"
+    print(f"worker '{worker_id}', round '{round_id}', {nr_shards} shards")
+    if os.environ.pop(WRITE_BUFFER_DIR_ENV_VAR, None):
+        print("write buffer disabled: not used by sharded workers")
+
+    # every worker refreshes the repository list (a few requests); concurrent upserts are retried
+    def refresh_repositories():
+        with DuckLakeConnection(dl_secret) as con:
+            return update_repositories(con)
+
+    repo_names = retry_on_conflict(refresh_repositories)
+    while (shard := claim_shard(dl_secret, nr_shards, worker_id, round_id)) is not None:
+        shard_repos = [repo for repo in repo_names if shard_of(repo, nr_shards) == shard]
+        print(f"===============\nshard {shard}: {len(shard_repos)} repositories")
+        if shard_repos:
+
+            def refresh_workflows():
+                with DuckLakeConnection(dl_secret) as con:
+                    update_workflows(shard_repos, con)
+
+            retry_on_conflict(refresh_workflows)
+            update_runs(shard_repos, dl_secret, rate_limit_share=1 / nr_shards)
+            update_lease(dl_secret, shard, worker_id, round_id)
+            update_jobs(shard_repos, dl_secret, rate_limit_share=1 / nr_shards, skip_existing=True)
+        update_lease(dl_secret, shard, worker_id, round_id, completed=True)
+        print(f"shard {shard} completed", flush=True)
+    print(f"no shards left to claim in round '{round_id}'")
+
+
+def run_local_workers(dl_secret: str, nr_shards: int, nr_workers: int, round_id: str):
+    # start the workers as separate processes (as matrix jobs would be), and wait for all of them
+    local_args = ['--local'] if dl_secret == 'ducklake_secret_local' else []
+    processes = [
+        subprocess.Popen(
+            [sys.executable, '-m', 'feeds.ci_metrics.ci_sharding', '--shards', str(nr_shards),
+             '--worker', f"local-{idx}", '--round', round_id] + local_args
+        )
+        for idx in range(nr_workers)
+    ]
+    failed = [idx for idx, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise ValueError(f"sharded workers failed: {failed}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    def pop_option(name, default=None):
+        if name in args:
+            idx = args.index(name)
+            value = args[idx + 1]
+            del args[idx : idx + 2]
+            return value
+        return default
+
+    dl_secret = 'ducklake_secret'
+    if '--local' in args:
+        args.remove('--local')
+        dl_secret = 'ducklake_secret_local'
+    nr_shards = int(pop_option('--shards', 1))
+    worker_id = pop_option('--worker') or default_worker_id()
+    round_id = pop_option('--round') or default_round_id()
+    nr_local_workers = pop_option('--local-workers')
+    if args:
+        raise ValueError(f"Invalid arguments for ci_sharding: {args}")
+    if nr_local_workers:
+        run_local_workers(dl_secret, nr_shards, int(nr_local_workers), round_id)
+    else:
+        run_worker(dl_secret, nr_shards, worker_id, round_id)
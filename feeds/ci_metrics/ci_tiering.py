@@ -0,0 +1,143 @@
+"""
+Hot/cold tiering of ci_runs and ci_jobs: every reader of these tables (the anti-join of runs without jobs, upserts,
+checkpoint rewrites) should not pay for all of history.
+
+- hot: ci_runs / ci_jobs, the runs created in the last GITHUB_HOT_DAYS (and their jobs), with the full payload.
+  The feed, the webhook receiver and the backfill only write here, and the feed only reads here
+- cold: ci_runs_archive / ci_jobs_archive, the older runs and jobs with the analysis columns only (see:
+  CI_RUNS_ARCHIVE_SCHEMA, CI_JOBS_ARCHIVE_SCHEMA), partitioned by year, written in bulk (sorted, in large files)
+- ci_runs_all / ci_jobs_all: views over both tiers (the analysis columns), for consumers of the history. A run that
+  is updated after it was archived (e.g. a re-run of an old workflow) is in both tiers until it ages again: the
+  views take the hot row
+- migrate_to_archive moves the aged runs and their jobs in one transaction (copy to the archive, delete from hot),
+  and applies the retention of the archive (GITHUB_ARCHIVE_RETENTION_DAYS). The ci_metrics feed runs it before
+  its checkpoint; when nothing aged, it is one count query
+
+run this file via Makefile: 'make tier_ci_tables'
+or: python3 -m feeds.ci_metrics.ci_tiering [--hot-days 90] [--local]
+"""
+
+from datetime import datetime, timedelta
+import math
+import sys
+
+from utils.ducklake import DuckLakeConnection
+from .ci_config import *
+from .ci_schemas import CI_JOBS_ARCHIVE_SCHEMA, CI_RUNS_ARCHIVE_SCHEMA
+
+# (hot table, archive table, archive schema, view, time column for partitioning and sorting)
+TIERS = [
+    (GITHUB_RUNS_TABLE, GITHUB_RUNS_ARCHIVE_TABLE, CI_RUNS_ARCHIVE_SCHEMA, GITHUB_RUNS_VIEW, 'created_at'),
+    # jobs fetched via graphql have no created_at
+    (GITHUB_JOBS_TABLE, GITHUB_JOBS_ARCHIVE_TABLE, CI_JOBS_ARCHIVE_SCHEMA, GITHUB_JOBS_VIEW, 'started_at'),
+]
+
+
+def columns_sql(schema: dict[str, str]) -> str:
+    return ", ".join([f'"{col}"' for col in schema])
+
+
+def create_archive_tables(con: DuckLakeConnection):
+    # the archive tables (created, or evolved with the archive schema) and the views over both tiers; a tier whose
+    # hot table does not exist yet (e.g. no jobs stored yet) is set up by a later migration
+    for hot_table, archive_table, schema, view, time_column in TIERS:
+        if not con.table_exists(hot_table):
+            continue
+        is_new = not con.table_exists(archive_table)
+        con.create_or_evolve_table(archive_table, schema)
+        if is_new:
+            con.execute(f"ALTER TABLE {archive_table} SET PARTITIONED BY (year({time_column}))")
+            con.execute(
+                f"CALL set_option('target_file_size', '{GITHUB_ARCHIVE_TARGET_FILE_SIZE}', table_name => '{archive_table}')"
+            )
+        con.execute(
+            f"""
+            CREATE OR REPLACE VIEW {view} AS
+            SELECT {columns_sql(schema)} FROM {hot_table}
+            UNION ALL
+            SELECT {columns_sql(schema)} FROM {archive_table} ANTI JOIN {hot_table} USING (id)
+            """
+        )
+
+
+def all_runs_table(con: DuckLakeConnection) -> str:
+    # the runs of both tiers, if tiering is set up; for readers of the history (not for the hot path)
+    return GITHUB_RUNS_VIEW if con.table_exists(GITHUB_RUNS_ARCHIVE_TABLE) else GITHUB_RUNS_TABLE
+
+
+def migrate_to_archive(con: DuckLakeConnection, hot_days: int = GITHUB_HOT_DAYS):
+    min_hot_days = max(GITHUB_RUNS_JOB_CUTOFF or 0, math.ceil((GITHUB_RUNS_STALE_DELAY or 0) / 24))
+    if hot_days <= min_hot_days:
+        raise ValueError(f"hot tier of {hot_days} days is too short: the feed still updates runs of {min_hot_days} days old")
+    if not con.table_exists(GITHUB_RUNS_TABLE):
+        print(f"tiering: no table {GITHUB_RUNS_TABLE} yet")
+        return
+    create_archive_tables(con)
+    cutoff = (datetime.now() - timedelta(days=hot_days)).strftime("%Y-%m-%d %H:%M:%S")
+    con.execute(
+        f"CREATE OR REPLACE TEMPORARY TABLE aged_runs AS SELECT id FROM {GITHUB_RUNS_TABLE} WHERE created_at < TIMESTAMP '{cutoff}'"
+    )
+    nr_runs = con.sql("select count(*) from aged_runs").fetchone()[0]
+    statements = []
+    has_jobs = con.table_exists(GITHUB_JOBS_TABLE)
+    if nr_runs:
+        runs_columns, jobs_columns = columns_sql(CI_RUNS_ARCHIVE_SCHEMA), columns_sql(CI_JOBS_ARCHIVE_SCHEMA)
+        jobs_filter = "run_id IN (SELECT id FROM aged_runs)"
+        # a run (or job) that was updated after it was archived replaces its archived version
+        statements.append(f"DELETE FROM {GITHUB_RUNS_ARCHIVE_TABLE} WHERE id IN (SELECT id FROM aged_runs)")
+        if has_jobs:
+            statements += [
+                f"DELETE FROM {GITHUB_JOBS_ARCHIVE_TABLE} WHERE id IN (SELECT id FROM {GITHUB_JOBS_TABLE} WHERE {jobs_filter})",
+                f"""
+                INSERT INTO {GITHUB_JOBS_ARCHIVE_TABLE} ({jobs_columns})
+                SELECT {jobs_columns} FROM {GITHUB_JOBS_TABLE} WHERE {jobs_filter}
+                ORDER BY started_at, run_id
+                """,
+                f"DELETE FROM {GITHUB_JOBS_TABLE} WHERE {jobs_filter}",
+            ]
+        statements += [
+            f"""
+            INSERT INTO {GITHUB_RUNS_ARCHIVE_TABLE} ({runs_columns})
+            SELECT {runs_columns} FROM {GITHUB_RUNS_TABLE} SEMI JOIN aged_runs USING (id)
+            ORDER BY created_at, repository.full_name
+            """,
+            f"DELETE FROM {GITHUB_RUNS_TABLE} WHERE id IN (SELECT id FROM aged_runs)",
+        ]
+    if GITHUB_ARCHIVE_RETENTION_DAYS:
+        retention = (datetime.now() - timedelta(days=GITHUB_ARCHIVE_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+        if con.table_exists(GITHUB_JOBS_ARCHIVE_TABLE):
+            statements.append(
+                f"""
+                DELETE FROM {GITHUB_JOBS_ARCHIVE_TABLE} WHERE run_id IN (
+                  SELECT id FROM {GITHUB_RUNS_ARCHIVE_TABLE} WHERE created_at < TIMESTAMP '{retention}'
+                )
+                """
+            )
+        statements.append(f"DELETE FROM {GITHUB_RUNS_ARCHIVE_TABLE} WHERE created_at < TIMESTAMP '{retention}'")
+    if not statements:
+        print(f"tiering: no runs created before {cutoff} in {GITHUB_RUNS_TABLE}")
+        return
+    con.execute_transaction(statements)
+    print(f"tiering: moved {nr_runs} runs created before {cutoff} (and their jobs) to {GITHUB_RUNS_ARCHIVE_TABLE}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    def pop_option(name, default=None):
+        if name in args:
+            idx = args.index(name)
+            value = args[idx + 1]
+            del args[idx : idx + 2]
+            return value
+        return default
+
+    dl_secret = 'ducklake_secret'
+    if '--local' in args:
+        args.remove('--local')
+        dl_secret = 'ducklake_secret_local'
+    hot_days = int(pop_option('--hot-days', GITHUB_HOT_DAYS))
+    if args:
+        raise ValueError(f"Invalid arguments for ci_tiering: {args}")
+    with DuckLakeConnection(dl_secret) as con:
+        migrate_to_archive(con, hot_days)
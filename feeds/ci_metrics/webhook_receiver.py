@@ -0,0 +1,272 @@
+"""
+Webhook receiver for GitHub 'workflow_run' and 'workflow_job' events; stores them in ci_runs / ci_jobs.
+
+The polling feed (ci_metrics_feed) fetches runs and jobs every 4 hours; with this receiver running, the
+dashboard data is minutes old, and the polling feed only has to store what the receiver missed.
+
+- deliveries are validated with the webhook secret (header 'X-Hub-Signature-256'), env: GITHUB_WEBHOOK_SECRET
+- events are buffered in memory and stored in micro-batches (every WEBHOOK_FLUSH_SECONDS, or after
+  WEBHOOK_FLUSH_EVENTS events), one ducklake commit per batch
+- runs are stored with the same semantics as the polling feed (see: store_runs): per repo only
+  consecutive completed runs; a run that is still queued or in progress holds back the more recent runs.
+  The receiver does not advance max_run_id (a delivery can be missed, and the polling feed only fetches
+  runs after max_run_id): the polling feed does, and skips the runs that the receiver already stored
+- jobs are only stored once their run is stored, and all jobs of a run at once: when the nr of buffered jobs
+  matches the nr of jobs of the run (its check runs, one GraphQL query per flush). The polling feed fetches the
+  jobs of runs without jobs (not the missing jobs of a run), so a run whose job deliveries are late or lost is
+  left to it; jobs that are already stored are skipped
+- on startup, the runs are reconciled once by polling (update_runs), to store the runs created while the
+  receiver was down
+
+run locally:
+    python3 -m feeds.ci_metrics.webhook_receiver [--port 8080] [--local] [--record <dir>] [--no-reconcile]
+replay recorded deliveries (files with keys 'event' and 'payload', as written by --record):
+    python3 -m feeds.ci_metrics.webhook_receiver --replay <file_or_dir> [--local]
+"""
+
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+import hashlib
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+
+from utils.ducklake import DuckLakeConnection
+from utils.github_utils import fetch_github_job_counts_graphql
+from .ci_config import *
+from .ci_metrics_feed import store_jobs, store_runs, update_runs
+
+load_dotenv()
+
+WEBHOOK_PORT = 8080
+WEBHOOK_FLUSH_SECONDS = 60
+WEBHOOK_FLUSH_EVENTS = 500
+
+
+def verify_signature(secret: str, body: bytes, signature_header: str | None) -> bool:
+    # https://docs.github.com/en/webhooks/using-webhooks/validating-webhook-deliveries
+    if not signature_header or not signature_header.startswith('sha256='):
+        return False
+    expected = 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature_header)
+
+
+class WebhookBuffer:
+    def __init__(self, dl_secret: str):
+        self.dl_secret = dl_secret
+        self.lock = threading.Lock()
+        self.runs: dict[int, dict] = {}  # latest state per run id
+        self.jobs: dict[int, dict] = {}  # completed jobs, waiting for their run to be stored
+        self.nr_events = 0
+
+    def add_event(self, event: str, payload: dict) -> bool:
+        # returns True if the event is buffered
+        with self.lock:
+            if event == 'workflow_run':
+                run = payload['workflow_run']
+                previous = self.runs.get(run['id'])
+                # deliveries can arrive out of order: keep the most recent state
+                if previous is None or previous['updated_at'] <= run['updated_at']:
+                    self.runs[run['id']] = run
+            elif event == 'workflow_job':
+                if payload.get('action') != 'completed':
+                    return False
+                job = payload['workflow_job']
+                self.jobs[job['id']] = job
+            else:
+                return False
+            self.nr_events += 1
+            return True
+
+    def flush(self):
+        with self.lock:
+            runs = list(self.runs.values())
+            jobs = list(self.jobs.values())
+            self.nr_events = 0
+        if not runs and not jobs:
+            return
+        print(f"flushing {len(runs)} buffered runs and {len(jobs)} buffered jobs", flush=True)
+
+        with DuckLakeConnection(self.dl_secret) as con:
+            if not con.table_exists(GITHUB_RUNS_TABLE):
+                raise ValueError(f"table {GITHUB_RUNS_TABLE} does not exist; run the polling feed first")
+            repos = con.sql(
+                f"""
+                SELECT repos.id, meta.max_run_id
+                FROM {GITHUB_REPOS_TABLE} repos
+                  LEFT JOIN {GITHUB_REPOS_METADATA_TABLE} meta on meta.repository_id = repos.id
+                """
+            ).fetchall()
+        repos_max_run_id = {repo_id: max_run_id for repo_id, max_run_id in repos}
+
+        # runs: per repo, with the same completed-prefix semantics as the polling feed
+        repo_runs = {}
+        for run in runs:
+            repo_id = run['repository']['id']
+            if repo_id in repos_max_run_id:  # unknown repos are picked up by the polling feed first
+                repo_runs.setdefault(repo_id, []).append(run)
+        if repo_runs:
+            store_runs(
+                self.dl_secret,
+                [run for repo_id in sorted(repo_runs) for run in repo_runs[repo_id]],
+                advance_max_run_id=False,
+            )
+
+        # the buffered runs (and the runs of the buffered jobs) that are stored, by the receiver or the polling feed
+        # (only the hot tier: runs that are old enough to be archived are not stored, see: store_runs)
+        with DuckLakeConnection(self.dl_secret) as con:
+            stored_run_node_ids = dict(
+                con.execute(
+                    f"SELECT id, node_id FROM {GITHUB_RUNS_TABLE} WHERE id IN (SELECT unnest($run_ids))",
+                    {"run_ids": list({run['id'] for run in runs} | {job['run_id'] for job in jobs})},
+                ).fetchall()
+            )
+        stored_run_ids = set(stored_run_node_ids)
+
+        # jobs: only for runs that are stored, once all jobs of the run are buffered
+        stale_jobs = (datetime.now() - timedelta(hours=GITHUB_RUNS_STALE_DELAY)).isoformat() if GITHUB_RUNS_STALE_DELAY else None
+        jobs_to_store = []
+        run_jobs = {}
+        for job in jobs:
+            if job['run_id'] in stored_run_ids:
+                run_jobs.setdefault(job['run_id'], []).append(job)
+        if run_jobs:
+            job_counts = fetch_github_job_counts_graphql([stored_run_node_ids[run_id] for run_id in run_jobs])
+            for run_id, buffered_jobs in run_jobs.items():
+                job_count = job_counts.get(stored_run_node_ids[run_id])
+                if job_count is not None and len(buffered_jobs) >= job_count:
+                    jobs_to_store.extend(buffered_jobs)
+            if jobs_to_store:
+                store_jobs(self.dl_secret, jobs_to_store, skip_existing=True)
+                with DuckLakeConnection(self.dl_secret) as con:
+                    # the micro-batch is the commit: do not keep jobs in the local write buffer (if enabled)
+                    con.flush_write_buffer()
+
+        # drop what is stored (or can no longer be stored) from the buffer
+        stored_job_ids = {job['id'] for job in jobs_to_store}
+        with self.lock:
+            for run in runs:
+                # stored, or at most the max_run_id of the polling feed (stored by it, or not stored on purpose)
+                max_run_id = repos_max_run_id.get(run['repository']['id'])
+                handled = run['id'] in stored_run_ids or (max_run_id is not None and run['id'] <= max_run_id)
+                if handled and self.runs.get(run['id']) is run:
+                    del self.runs[run['id']]
+            for job in jobs:
+                if job['id'] in stored_job_ids or (stale_jobs and (job['completed_at'] or '') < stale_jobs):
+                    self.jobs.pop(job['id'], None)
+        print(f"buffer: {len(self.runs)} runs and {len(self.jobs)} jobs waiting", flush=True)
+
+
+def make_handler(buffer: WebhookBuffer, webhook_secret: str, record_dir: Path | None):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not verify_signature(webhook_secret, body, self.headers.get('X-Hub-Signature-256')):
+                self.send_response(401)
+                self.end_headers()
+                return
+            event = self.headers.get('X-GitHub-Event', '')
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            if record_dir:
+                delivery = self.headers.get('X-GitHub-Delivery', str(time.time_ns()))
+                (record_dir / f"{event}_{delivery}.json").write_text(json.dumps({"event": event, "payload": payload}))
+            buffered = buffer.add_event(event, payload)
+            self.send_response(202 if buffered else 200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass  # no line per delivery
+
+    return WebhookHandler
+
+
+def flush_periodically(buffer: WebhookBuffer, stop: threading.Event):
+    # the only thread that writes to the ducklake
+    last_flush = time.time()
+    while not stop.wait(1):
+        if buffer.nr_events >= WEBHOOK_FLUSH_EVENTS or time.time() - last_flush >= WEBHOOK_FLUSH_SECONDS:
+            try:
+                buffer.flush()
+            except Exception as e:
+                # keep the events buffered, retry on the next flush
+                print(f"::warning title=webhook flush failed::{e}", flush=True)
+            last_flush = time.time()
+
+
+def serve(dl_secret: str, port: int, record_dir: Path | None, reconcile: bool):
+    webhook_secret = os.getenv('GITHUB_WEBHOOK_SECRET')
+    if not webhook_secret:
+        raise ValueError("Env variable 'GITHUB_WEBHOOK_SECRET' is missing!")
+    if record_dir:
+        record_dir.mkdir(parents=True, exist_ok=True)
+    if reconcile:
+        with DuckLakeConnection(dl_secret) as con:
+            repo_names = [tup[0] for tup in con.sql(f"SELECT full_name FROM {GITHUB_REPOS_TABLE} ORDER BY full_name").fetchall()]
+        print("reconciling runs by polling ...", flush=True)
+        update_runs(repo_names, dl_secret)
+
+    buffer = WebhookBuffer(dl_secret)
+    stop = threading.Event()
+    flusher = threading.Thread(target=flush_periodically, args=(buffer, stop), daemon=True)
+    flusher.start()
+    server = ThreadingHTTPServer(('', port), make_handler(buffer, webhook_secret, record_dir))
+    print(f"listening for github webhooks on port {port} ...", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stop.set()
+        flusher.join()
+        buffer.flush()
+
+
+def replay(dl_secret: str, path: Path):
+    files = sorted(path.glob('*.json')) if path.is_dir() else [path]
+    buffer = WebhookBuffer(dl_secret)
+    for file in files:
+        delivery = json.loads(file.read_text())
+        buffer.add_event(delivery['event'], delivery['payload'])
+    print(f"replaying {len(files)} deliveries")
+    buffer.flush()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    def pop_option(name, default=None):
+        if name in args:
+            idx = args.index(name)
+            value = args[idx + 1]
+            del args[idx : idx + 2]
+            return value
+        return default
+
+    def pop_flag(name):
+        if name in args:
+            args.remove(name)
+            return True
+        return False
+
+    dl_secret = 'ducklake_secret_local' if pop_flag('--local') else 'ducklake_secret'
+    replay_path = pop_option('--replay')
+    port = int(pop_option('--port', WEBHOOK_PORT))
+    record_dir = pop_option('--record')
+    reconcile = not pop_flag('--no-reconcile')
+    if args:
+        raise ValueError(f"Invalid arguments for webhook_receiver: {args}")
+    if replay_path:
+        replay(dl_secret, Path(replay_path))
+    else:
+        serve(dl_secret, port, Path(record_dir) if record_dir else None, reconcile)
@@ -1,8 +1,6 @@
-import boto3
-from botocore.exceptions import ClientError
-from collections import OrderedDict
-import json
+from datetime import datetime, timezone
 import os
+from pathlib import Path
 import re
 
 from utils.ducklake import DuckLakeConnection
@@ -12,49 +10,77 @@ load_dotenv()
 
 
 EXTENSION_DOWNLOADS_TABLE = 'extension_downloads'
+EXTENSION_ROLLUPS_TABLE = 'extension_downloads_rollups'
+# manifest of the ingested weekly stats files: one row per file, with the ETag and LastModified it had when read
+EXTENSION_FILES_TABLE = 'extension_downloads_files'
 
 S3_BUCKET_CORE = 'duckdb-core-extensions'
 S3_BUCKET_COMMUNITY = 'duckdb-community-extensions'
 S3_BUCKET_DIR = 'download-stats-weekly'
+REPOSITORY_BUCKETS = {'core': S3_BUCKET_CORE, 'community': S3_BUCKET_COMMUNITY}
+# a local directory with the layout of the buckets (<dir>/<bucket>/download-stats-weekly/<iso_year>/<iso_week>.json),
+# read instead of r2: e.g. to run the feed without the cloudflare credentials
+EXTENSION_STATS_DIR_ENV_VAR = 'EXTENSION_STATS_DIR'
 
 
 def run(dl_secret: str):
-    s3_client = get_s3_client()
+    # list the weekly stats files with their metadata first: a listing error does not leave a transaction open
+    listed_files = []
+    for repository, bucket in REPOSITORY_BUCKETS.items():
+        listed_files.extend(list_stats_files(repository, bucket))
 
-    # fetch periods and extension names already stored in ducklake
     with DuckLakeConnection(dl_secret) as con:
         create_extension_table_if_not_exists(con)
-        periods_in_ducklake = con.sql(f"select distinct year, week from {EXTENSION_DOWNLOADS_TABLE}").fetchall()
-
-        for bucket in (S3_BUCKET_CORE, S3_BUCKET_COMMUNITY):
-            if bucket == S3_BUCKET_CORE:
-                repository = 'core'
-            elif bucket == S3_BUCKET_COMMUNITY:
-                repository = 'community'
-            else:
-                raise ValueError(f"undefined repository name for extension bucket: {bucket}")
-
-            # fetch download stats for new periods from s3
-            new_records = []
-            s3_file_paths = get_s3_file_paths(s3_client, bucket)
-            for file_path in s3_file_paths:
-                iso_year_str, _, iso_week_str = (
-                    file_path.removeprefix(f'{S3_BUCKET_DIR}/').removesuffix('.json').partition('/')
-                )
-                if not is_valid_iso_year(iso_year_str) or not is_valid_iso_week(iso_week_str):
-                    raise ValueError(
-                        f"invalid file path: '{file_path}'; expected: '{S3_BUCKET_DIR}/<iso_year>/<iso_week>.json'"
-                    )
-                year_week_file = (int(iso_year_str), int(iso_week_str))
-                if year_week_file not in periods_in_ducklake:
-                    new_records.extend(get_download_stats_from_file(s3_client, bucket, file_path, repository))
-
-            # update ducklake
-            if new_records:
-                con.append_table(EXTENSION_DOWNLOADS_TABLE, new_records)
-                print(f"repo {repository}: inserted {len(new_records)} records to table '{EXTENSION_DOWNLOADS_TABLE}'.")
-            else:
-                print(f"repo {repository}: no new extension stats to store")
+        create_rollups_table_if_not_exists(con)
+        is_new_manifest = not con.table_exists(EXTENSION_FILES_TABLE)
+        create_files_table_if_not_exists(con)
+        if not os.getenv(EXTENSION_STATS_DIR_ENV_VAR):
+            create_r2_secrets(con)
+        # staged in one statement: the listed files as a list of structs
+        columns = ['repository', 'year', 'week', 'path', 'etag', 'last_modified']
+        con.execute(
+            """
+            CREATE OR REPLACE TEMPORARY TABLE listed_files AS
+            SELECT
+                f.repository::VARCHAR AS repository,
+                f.year::USMALLINT AS year,
+                f.week::UTINYINT AS week,
+                f.path::VARCHAR AS path,
+                f.etag::VARCHAR AS etag,
+                f.last_modified::TIMESTAMP AS last_modified
+            FROM (SELECT unnest($listed_files) AS f)
+            """,
+            {"listed_files": [dict(zip(columns, listed_file)) for listed_file in listed_files]},
+        )
+        if is_new_manifest:
+            bootstrap_files_manifest(con)
+
+        # the files that are new, or that changed since they were read (e.g. the current week, which is rewritten)
+        con.execute(
+            f"""
+            CREATE OR REPLACE TEMPORARY TABLE changed_files AS
+            SELECT listed_files.*, manifest.path IS NULL AS is_new
+            FROM listed_files
+              LEFT JOIN {EXTENSION_FILES_TABLE} manifest USING (path)
+            WHERE manifest.etag IS DISTINCT FROM listed_files.etag
+            """
+        )
+        for repository, nr_new, nr_changed in con.sql(
+            "select repository, count(*) filter (is_new), count(*) filter (not is_new) from changed_files group by all order by all"
+        ).fetchall():
+            print(f"repo {repository}: {nr_new} new and {nr_changed} changed weekly stats files")
+
+        # update ducklake
+        changed_paths = [tup[0] for tup in con.sql("select path from changed_files order by path").fetchall()]
+        if changed_paths:
+            nr_records = replace_download_stats(con, changed_paths)
+            print(f"replaced {len(changed_paths)} weeks: {nr_records} records in table '{EXTENSION_DOWNLOADS_TABLE}'.")
+        else:
+            print("no new extension stats to store")
+
+        # appends may be buffered locally (see utils/write_buffer.py): the rollups are computed from the lake
+        con.flush_write_buffer()
+        update_rollups(con)
 
 
 def create_extension_table_if_not_exists(con: DuckLakeConnection):
@@ -73,7 +99,189 @@ def create_extension_table_if_not_exists(con: DuckLakeConnection):
     )
 
 
+def create_files_table_if_not_exists(con: DuckLakeConnection):
+    con.execute(
+        f"""
+        CREATE TABLE
+            IF NOT EXISTS {EXTENSION_FILES_TABLE} (
+                repository VARCHAR,
+                year USMALLINT,
+                week UTINYINT,
+                path VARCHAR,
+                etag VARCHAR,
+                last_modified TIMESTAMP,
+                ingested_at TIMESTAMP,
+            )
+        """
+    )
+
+
+def bootstrap_files_manifest(con: DuckLakeConnection):
+    # the weeks that were stored before the manifest existed are taken as they are listed now, except the last
+    # week per repository (it may have been rewritten since it was read): that one is read again
+    con.execute(
+        f"""
+        INSERT INTO {EXTENSION_FILES_TABLE}
+        SELECT listed_files.*, now()::TIMESTAMP AS ingested_at
+        FROM listed_files
+          SEMI JOIN (SELECT DISTINCT repository, year, week FROM {EXTENSION_DOWNLOADS_TABLE}) stored
+            USING (repository, year, week)
+        WHERE (year, week) < (
+          SELECT max((year, week)) FROM {EXTENSION_DOWNLOADS_TABLE} latest WHERE latest.repository = listed_files.repository
+        )
+        """
+    )
+
+
+def iso_week_start_sql(year: str, week: str) -> str:
+    # the monday of an iso week: week 1 is the week with january 4th
+    jan_4 = f"make_date({year}::INTEGER, 1, 4)"
+    return f"({jan_4} - (isodow({jan_4}) - 1)::INTEGER + ({week}::INTEGER - 1) * 7)"
+
+
+def create_rollups_table_if_not_exists(con: DuckLakeConnection):
+    con.execute(
+        f"""
+        CREATE TABLE
+            IF NOT EXISTS {EXTENSION_ROLLUPS_TABLE} (
+                repository VARCHAR,
+                extension_name VARCHAR,
+                year USMALLINT,
+                week UTINYINT,
+                week_start DATE,
+                downloads BIGINT,
+                cumulative_downloads BIGINT,
+                rolling_4w_downloads BIGINT,
+                rolling_12w_downloads BIGINT,
+                growth_1w DOUBLE,
+                growth_4w DOUBLE,
+                rank_in_repository INTEGER,
+            )
+        """
+    )
+
+
+def update_rollups(con: DuckLakeConnection):
+    """
+    Maintain the rollups of the extension downloads, one row per (repository, extension_name, year, week):
+    cumulative downloads, rolling 4 and 12 week totals, week-over-week and 4-week growth, and the rank of the
+    extension in its repository in that week (top N = rank_in_repository <= N).
+    Incremental: only weeks that are not in the rollups yet are computed, from the 11 weeks before them (for
+    the rolling totals) and the cumulative downloads of the last rolled-up week. A week that arrives late
+    (before the last rolled-up week) recomputes the weeks after it, since their cumulative totals change.
+    """
+    create_rollups_table_if_not_exists(con)
+    week_start = iso_week_start_sql('e.year', 'e.week')
+    con.execute(
+        f"""
+        CREATE OR REPLACE TEMPORARY TABLE pending_rollups AS
+        SELECT repository, min({iso_week_start_sql('year', 'week')}) AS recompute_from
+        FROM (
+          SELECT DISTINCT repository, year, week FROM {EXTENSION_DOWNLOADS_TABLE}
+          EXCEPT
+          SELECT DISTINCT repository, year, week FROM {EXTENSION_ROLLUPS_TABLE}
+        )
+        GROUP BY ALL
+        """
+    )
+    pending = con.sql("select repository, recompute_from from pending_rollups order by all").fetchall()
+    if not pending:
+        print(f"{EXTENSION_ROLLUPS_TABLE}: up to date")
+        return
+    con.execute(
+        f"""
+        CREATE OR REPLACE TEMPORARY TABLE new_rollups AS
+        WITH weekly AS (
+          SELECT e.repository, e.extension_name, e.year, e.week, {week_start} AS week_start,
+                 sum(e.downloads)::BIGINT AS downloads, p.recompute_from
+          FROM {EXTENSION_DOWNLOADS_TABLE} e
+          JOIN pending_rollups p USING (repository)
+          WHERE {week_start} >= p.recompute_from - 11 * 7
+          GROUP BY ALL
+        ),
+        previous AS (
+          SELECT r.repository, r.extension_name, arg_max(r.cumulative_downloads, r.week_start) AS cumulative_before
+          FROM {EXTENSION_ROLLUPS_TABLE} r
+          JOIN pending_rollups p USING (repository)
+          WHERE r.week_start < p.recompute_from
+          GROUP BY ALL
+        ),
+        windows AS (
+          SELECT
+            weekly.*,
+            coalesce(previous.cumulative_before, 0)
+              + sum(if(week_start >= recompute_from, downloads, 0)) OVER (w ROWS UNBOUNDED PRECEDING) AS cumulative_downloads,
+            sum(downloads) OVER (w RANGE BETWEEN INTERVAL 21 DAY PRECEDING AND CURRENT ROW) AS rolling_4w_downloads,
+            sum(downloads) OVER (w RANGE BETWEEN INTERVAL 77 DAY PRECEDING AND CURRENT ROW) AS rolling_12w_downloads,
+            sum(downloads) OVER (w RANGE BETWEEN INTERVAL 55 DAY PRECEDING AND INTERVAL 28 DAY PRECEDING) AS previous_4w_downloads,
+            lag(downloads) OVER w AS previous_downloads,
+            lag(week_start) OVER w AS previous_week_start,
+            rank() OVER (PARTITION BY repository, week_start ORDER BY downloads DESC) AS rank_in_repository
+          FROM weekly
+          LEFT JOIN previous USING (repository, extension_name)
+          WINDOW w AS (PARTITION BY repository, extension_name ORDER BY week_start)
+        )
+        SELECT
+          * EXCLUDE (recompute_from, previous_4w_downloads, previous_downloads, previous_week_start),
+          -- growth against the previous week (only if the extension had downloads in that week)
+          if(previous_week_start = week_start - 7, downloads / nullif(previous_downloads, 0) - 1, NULL) AS growth_1w,
+          rolling_4w_downloads / nullif(previous_4w_downloads, 0) - 1 AS growth_4w
+        FROM windows
+        WHERE week_start >= recompute_from
+        """
+    )
+    # replace the recomputed weeks in one transaction
+    con.execute_transaction(
+        [
+            f"""
+            DELETE FROM {EXTENSION_ROLLUPS_TABLE} USING pending_rollups
+            WHERE {EXTENSION_ROLLUPS_TABLE}.repository = pending_rollups.repository
+              AND {EXTENSION_ROLLUPS_TABLE}.week_start >= pending_rollups.recompute_from
+            """,
+            f"INSERT INTO {EXTENSION_ROLLUPS_TABLE} BY NAME FROM new_rollups",
+        ]
+    )
+    nr_rows = con.sql("select count(*) from new_rollups").fetchone()[0]
+    for repository, recompute_from in pending:
+        print(f"{EXTENSION_ROLLUPS_TABLE}: repo {repository}: rolled up the weeks from {recompute_from}")
+    print(f"{EXTENSION_ROLLUPS_TABLE}: inserted {nr_rows} rows")
+
+
+def stats_dir(bucket: str) -> str:
+    # the directory with the weekly stats files of a bucket: on r2, or in the local stand-in directory
+    local_dir = os.getenv(EXTENSION_STATS_DIR_ENV_VAR)
+    root = f"{local_dir.rstrip('/')}/{bucket}" if local_dir else f"r2://{bucket}"
+    return f"{root}/{S3_BUCKET_DIR}"
+
+
+def create_r2_secrets(con: DuckLakeConnection):
+    # scoped to the buckets: the lake's own r2 secret stays the one for its data path
+    for repository, bucket in REPOSITORY_BUCKETS.items():
+        con.execute(
+            f"""
+            CREATE OR REPLACE TEMPORARY SECRET extension_stats_{repository} (
+                TYPE r2,
+                ACCOUNT_ID '{os.getenv('DUCKLAKE_STORAGE_R2_ACCOUNT_ID')}',
+                KEY_ID '{os.getenv('CF_KEY_ID')}',
+                SECRET '{os.getenv('CF_KEY_SECRET')}',
+                REGION 'auto',
+                SCOPE 'r2://{bucket}'
+            )
+            """
+        )
+
+
+def is_valid_iso_week(s: str):
+    return s.isnumeric() and int(s) >= 1 and int(s) <= 53
+
+
+def is_valid_iso_year(s: str):
+    return bool(re.fullmatch(r"\d{4}", s))
+
+
 def get_s3_client():
+    import boto3
+
     r2_account_id = os.getenv('DUCKLAKE_STORAGE_R2_ACCOUNT_ID')
     s3_client = boto3.client(
         service_name="s3",
@@ -85,55 +293,106 @@ def get_s3_client():
     return s3_client
 
 
-def is_valid_iso_week(s: str):
-    return s.isnumeric() and int(s) >= 1 and int(s) <= 53
-
-
-def is_valid_iso_year(s: str):
-    return bool(re.fullmatch(r"\d{4}", s))
-
+def list_stats_objects(bucket: str) -> list[tuple[str, str, datetime]]:
+    # (path, etag, last modified) of the files in the stats directory of the bucket: one listing request per 1000
+    local_dir = os.getenv(EXTENSION_STATS_DIR_ENV_VAR)
+    if local_dir:
+        # a local file has no etag: its size and modification time change when it is rewritten
+        objects = []
+        for path in sorted(Path(stats_dir(bucket)).rglob('*.json')):
+            stat = path.stat()
+            objects.append(
+                (
+                    f"{stats_dir(bucket)}/{path.relative_to(stats_dir(bucket)).as_posix()}",
+                    f"{stat.st_size}-{stat.st_mtime_ns}",
+                    datetime.fromtimestamp(stat.st_mtime, timezone.utc).replace(tzinfo=None),
+                )
+            )
+        return objects
+    from botocore.exceptions import ClientError
 
-def get_s3_file_paths(s3, bucket):
-    # validations
     try:
-        s3.head_bucket(Bucket=bucket)
+        pages = get_s3_client().get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=f"{S3_BUCKET_DIR}/")
+        return [
+            (f"r2://{bucket}/{obj['Key']}", obj['ETag'].strip('"'), obj['LastModified'].astimezone(timezone.utc).replace(tzinfo=None))
+            for page in pages
+            for obj in page.get('Contents', [])
+        ]
     except ClientError as e:
-        raise ValueError(f"failed to connect to bucket: '{bucket}'; error: {e.response['Error']}")
-    response = s3.list_objects_v2(Bucket=bucket, Prefix=S3_BUCKET_DIR)
-    if response['ResponseMetadata']['HTTPStatusCode'] != 200:
-        raise ValueError(
-            f"Request 'list_objects_v2' failed with status: {response['ResponseMetadata']['HTTPStatusCode']}"
+        raise ValueError(f"failed to list the files in bucket: '{bucket}'; error: {e.response['Error']}")
+
+
+def list_stats_files(repository: str, bucket: str) -> list[tuple]:
+    # the weekly stats files of the bucket: (repository, iso year, iso week, path, etag, last modified)
+    stats_files = []
+    for file_path, etag, last_modified in list_stats_objects(bucket):
+        iso_year_str, _, iso_week_str = (
+            file_path.removeprefix(f'{stats_dir(bucket)}/').removesuffix('.json').partition('/')
         )
-    if not 'Contents' in response:
-        raise ValueError(f"directory '{S3_BUCKET_DIR}' not found in bucket '{bucket}'")
-    file_paths = [obj['Key'] for obj in response['Contents']]
-    if file_paths == []:
+        if not is_valid_iso_year(iso_year_str) or not is_valid_iso_week(iso_week_str):
+            raise ValueError(
+                f"invalid file path: '{file_path}'; expected: '{S3_BUCKET_DIR}/<iso_year>/<iso_week>.json'"
+            )
+        stats_files.append((repository, int(iso_year_str), int(iso_week_str), file_path, etag, last_modified))
+    if stats_files == []:
         raise ValueError(f"no files found in directory '{S3_BUCKET_DIR}' in bucket '{bucket}'")
-    return file_paths
-
-
-def get_download_stats_from_file(s3_client, bucket, file_path, repository):
-    iso_year_str, _, iso_week_str = file_path.removeprefix(f'{S3_BUCKET_DIR}/').removesuffix('.json').partition('/')
-    response = s3_client.get_object(Bucket=bucket, Key=file_path)
-    content: dict = json.loads(response['Body'].read().decode('utf-8'))
-    if '_last_update' not in content:
-        raise ValueError(f"field '_last_update' not found in file {file_path}")
-    download_stats = []
-    last_update = content['_last_update']
-    for key in content.keys():
-        if key != '_last_update':
-            extension_name = key
-            downloads = content[extension_name]
-            record = OrderedDict(
-                year=int(iso_year_str),
-                week=int(iso_week_str),
-                extension_name=extension_name,
-                downloads=downloads,
-                last_update=last_update,
-                repository=repository,
+    return stats_files
+
+
+def replace_download_stats(con: DuckLakeConnection, file_paths: list[str]) -> int:
+    """
+    Read the weekly stats files (one json object per file: {"_last_update": ..., <extension_name>: <downloads>, ...})
+    in one read, and unpivot the extension names to rows: year, week and repository come from the path
+    (<bucket>/download-stats-weekly/<iso_year>/<iso_week>.json). Then, in one transaction, replace the rows of
+    these weeks, and their files in the manifest (temporary table changed_files); the rolled up weeks from the
+    first replaced week are recomputed by update_rollups.
+    """
+    files_sql = ", ".join([f"'{file_path}'" for file_path in file_paths])
+    repositories_sql = ", ".join([f"'{bucket}': '{repository}'" for repository, bucket in REPOSITORY_BUCKETS.items()])
+    try:
+        con.execute(
+            f"""
+            CREATE OR REPLACE TEMPORARY TABLE staged_downloads AS
+            WITH files AS (
+              SELECT
+                regexp_extract(
+                  filename, '([^/]+)/{S3_BUCKET_DIR}/(\\d{{4}})/(\\d{{1,2}})\\.json$', ['bucket', 'year', 'week']
+                ) AS path,
+                json::MAP(VARCHAR, JSON) AS stats,
+                coalesce(stats['_last_update'] ->> '$', error('field ''_last_update'' not found in file ' || filename)) AS last_update
+              FROM read_json_objects([{files_sql}], filename = true)
+            ),
+            records AS (
+              SELECT path, last_update, unnest(map_keys(stats)) AS extension_name, unnest(map_values(stats)) AS downloads
+              FROM files
             )
-            download_stats.append(record)
-    return download_stats
+            SELECT
+              path.year::USMALLINT AS year,
+              path.week::UTINYINT AS week,
+              extension_name,
+              downloads::UINTEGER AS downloads,
+              last_update::TIMESTAMP_S AS last_update,
+              MAP {{{repositories_sql}}}[path.bucket] AS repository
+            FROM records
+            WHERE extension_name <> '_last_update'
+            """
+        )
+    except RuntimeError as e:
+        raise ValueError(f"failed to ingest the extension stats files: {e.__cause__}")
+    weeks_filter = "USING changed_files WHERE {table}.repository = changed_files.repository AND {table}.year = changed_files.year AND {table}.week = changed_files.week"
+    con.execute_transaction(
+        [
+            f"DELETE FROM {EXTENSION_DOWNLOADS_TABLE} {weeks_filter.format(table=EXTENSION_DOWNLOADS_TABLE)}",
+            f"INSERT INTO {EXTENSION_DOWNLOADS_TABLE} BY NAME FROM staged_downloads",
+            f"DELETE FROM {EXTENSION_ROLLUPS_TABLE} {weeks_filter.format(table=EXTENSION_ROLLUPS_TABLE)}",
+            f"DELETE FROM {EXTENSION_FILES_TABLE} WHERE path IN (SELECT path FROM changed_files)",
+            f"""
+            INSERT INTO {EXTENSION_FILES_TABLE}
+            SELECT * EXCLUDE (is_new), now()::TIMESTAMP AS ingested_at FROM changed_files
+            """,
+        ]
+    )
+    return con.sql("select count(*) from staged_downloads").fetchone()[0]
 
 
 if __name__ == "__main__":
@@ -1,41 +1,133 @@
 # run this file via Makefile: 'make run_feeds' or 'make run_feeds_local'
+# add '--profile' to profile every statement, e.g.: python3 -m feeds.run_feeds local --profile
+# run a subset of the feeds: --only ci_metrics,extension_downloads or --skip extension_downloads
+#
+# feeds are discovered, not registered: every package feeds/<name>/ with a module <name>_feed.py, that has a
+# function run(dl_secret), is a feed. A feed module is only imported when the feed is selected, so running one
+# feed does not import the dependencies of the others; the import time per feed is reported.
+# (for a breakdown per module: python3 -X importtime -m feeds.run_feeds ...)
+# duckdb (and utils.ducklake) are imported where they are used, so the startup time that is reported (since the
+# process started) shows what the feeds pay before they run.
 
-import duckdb
+import importlib
+import os
+from pathlib import Path
 import sys
+import time
 
-import feeds.ci_metrics.ci_metrics_feed as ci_metrics_feed
-import feeds.extension_downloads.extension_downloads_feed as extension_downloads_feed
+from utils.query_profiler import PROFILE_DIR_ENV_VAR, new_profile_dir, print_profile_summary
+from utils.write_buffer import get_write_buffer
 
+MODULE_START = time.perf_counter()
+FEEDS_DIR = Path(__file__).parent
 
-FEEDS = [
-    ("ci_metrics_feed", ci_metrics_feed.run),
-    ("extension_downloads_feed", extension_downloads_feed.run),
-]
 
+def seconds_since_process_start() -> float:
+    # from the start time of the process in /proc (linux; interpreter startup included), otherwise since this
+    # module was imported
+    try:
+        start_ticks = int(Path('/proc/self/stat').read_text().rsplit(')', 1)[1].split()[19])
+        uptime = float(Path('/proc/uptime').read_text().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - MODULE_START
 
-def run_all_feeds(dl_secret: str):
-    for name, run_func in FEEDS:
+
+def discover_feeds() -> list[str]:
+    # the feed names, without importing anything: a package feeds/<name>/ with <name>_feed.py
+    return sorted(
+        path.name
+        for path in FEEDS_DIR.iterdir()
+        if (path / '__init__.py').is_file() and (path / f"{path.name}_feed.py").is_file()
+    )
+
+
+def select_feeds(only: list[str] | None = None, skip: list[str] | None = None) -> list[str]:
+    # names may be given with or without the '_feed' suffix
+    feeds = discover_feeds()
+    only = [name.removesuffix('_feed') for name in only] if only is not None else None
+    skip = [name.removesuffix('_feed') for name in skip or []]
+    unknown = [name for name in (only or []) + skip if name not in feeds]
+    if unknown:
+        raise ValueError(f"unknown feed(s): {unknown}, expected: {feeds}")
+    return [name for name in feeds if (only is None or name in only) and name not in skip]
+
+
+def load_feed(name: str):
+    # returns the run function of the feed, and the time its import took
+    start = time.perf_counter()
+    module = importlib.import_module(f"feeds.{name}.{name}_feed")
+    return module.run, time.perf_counter() - start
+
+
+def flush_write_buffer(dl_secret: str):
+    # only if the local write buffer is enabled (see utils/write_buffer.py)
+    if get_write_buffer(dl_secret):
+        from utils.ducklake import DuckLakeConnection
+
+        with DuckLakeConnection(dl_secret) as con:
+            con.flush_write_buffer()
+
+
+def check_secret(dl_secret: str):
+    import duckdb
+
+    with duckdb.connect() as con:
+        res = con.sql(f"from duckdb_secrets() where name = '{dl_secret}' and type = 'ducklake'").fetchone()
+        if not res:
+            raise ValueError(f"Connection secret with name '{dl_secret}' is not found")
+
+
+def run_all_feeds(dl_secret: str, feed_names: list[str]):
+    print(f"startup: {seconds_since_process_start():.2f}s since the process started, feeds: {', '.join(feed_names) or '(none)'}")
+    # recover: store what a previous (crashed) run left in the write buffer, before the feeds read the lake
+    flush_write_buffer(dl_secret)
+    for name in feed_names:
         print("------------------")
-        print(f"running {name} ...", flush=True)
+        print(f"running {name}_feed ...", flush=True)
         try:
+            run_func, import_seconds = load_feed(name)
+            print(f"imported {name}_feed in {import_seconds:.2f}s", flush=True)
             run_func(dl_secret)
         except (ValueError) as e:
-            print(f"::warning title={name}::data-feed '{name}' failed: {e}")
+            print(f"::warning title={name}_feed::data-feed '{name}_feed' failed: {e}")
         except (AssertionError) as e:
-            print(f"::warning title={name}::data-feed '{name}' AssertionError: {e}")
+            print(f"::warning title={name}_feed::data-feed '{name}_feed' AssertionError: {e}")
+        except (ImportError) as e:
+            # e.g. a dependency of this feed is not installed: the other feeds still run
+            print(f"::warning title={name}_feed::data-feed '{name}_feed' could not be imported: {e}")
+    flush_write_buffer(dl_secret)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) == 1:
+    args = sys.argv[1:]
+
+    def pop_option(name, default=None):
+        if name in args:
+            idx = args.index(name)
+            value = args[idx + 1]
+            del args[idx : idx + 2]
+            return value
+        return default
+
+    only = pop_option('--only')
+    skip = pop_option('--skip')
+    feed_names = select_feeds(only.split(',') if only else None, skip.split(',') if skip else None)
+    profile_dir = None
+    if '--profile' in args:
+        # profile every statement run via DuckLakeConnection.execute (see utils/query_profiler.py)
+        args.remove('--profile')
+        profile_dir = new_profile_dir('run_feeds')
+        os.environ[PROFILE_DIR_ENV_VAR] = str(profile_dir)
+    if len(args) == 0:
         dl_secret = 'ducklake_secret'
-    elif len(sys.argv) == 2 and sys.argv[1] == 'local':
+    elif len(args) == 1 and args[0] == 'local':
         dl_secret = 'ducklake_secret_local'
     else:
         raise ValueError("Invalid arguments for run_feeds()")
 
     # check if ducklake secret is available
-    with duckdb.connect() as con:
-        res = con.sql(f"from duckdb_secrets() where name = '{dl_secret}' and type = 'ducklake'").fetchone()
-        if not res:
-            raise ValueError(f"Connection secret with name '{dl_secret}' is not found")
-    run_all_feeds(dl_secret)
+    check_secret(dl_secret)
+    run_all_feeds(dl_secret, feed_names)
+    if profile_dir:
+        print_profile_summary(profile_dir)
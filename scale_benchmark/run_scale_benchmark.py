@@ -0,0 +1,217 @@
+"""
+Scaling benchmark: runs the stages of the pipeline on synthetic data (see: synthetic_data.py) at several scales, and
+reports time, peak memory and output size per stage and scale, with the scaling exponent between consecutive scales
+(time ~ scale^exponent): an exponent well above 1 is a superlinear step, that will hurt before the data grows 10x.
+
+stages:
+- generate: generating the synthetic data (also the size of the lakes)
+- recent_runs_without_jobs: get_recent_run_ids_without_jobs (the anti-join of ci_runs and ci_jobs)
+- upsert_runs: DuckLakeConnection.upsert_table of 1000 changed and 500 new runs into ci_runs
+- derived:<file>: the derived table SQL files (benchmark_derived_tables/ on the benchmark lake, ci_derived_tables/, extension_derived_tables/)
+- generate_sources: generate_sources for all sources in sources.json (written to the scale dir, not to evidence/)
+
+Each stage runs in a separate process, so the peak memory (max rss) is per stage.
+Data is generated once per scale in ./scale_benchmark_data/scale_<scale>/ and reused; use --regenerate after
+changing the generator. Note: upsert_runs changes the data, so it runs last.
+
+run this file via Makefile: 'make scale_benchmark'
+or: python3 -m scale_benchmark.run_scale_benchmark [--scales 0.1,1,10] [--stages <stage>,...] [--regenerate]
+"""
+
+import json
+import math
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from utils.ducklake import DuckLakeConnection
+from evidence.sources.generate_sources import DEFAULT_LAKE_SECRET, generate_source
+from feeds.ci_metrics.ci_config import *
+from feeds.ci_metrics.ci_metrics_utils import get_recent_run_ids_without_jobs
+from feeds.ci_metrics.ci_schemas import CI_RUNS_SCHEMA
+from .synthetic_data import generate, lake_paths
+
+DATA_DIR = Path('./scale_benchmark_data')
+DEFAULT_SCALES = [0.1, 1, 10]
+DERIVED_SQL_DIRS = {
+    'benchmark': Path('./benchmark_derived_tables'),
+    'ci': Path('./ci_derived_tables'),
+    'extension': Path('./extension_derived_tables'),
+}
+SOURCES_CONFIG = Path('./evidence/sources/sources.json')
+SUPERLINEAR_EXPONENT = 1.3
+UPSERT_CHANGED = 1000
+UPSERT_NEW = 500
+
+
+def scale_dir(scale: float) -> Path:
+    return DATA_DIR / f"scale_{scale:g}"
+
+
+def all_stages() -> list[str]:
+    derived = [f"derived:{sql_file.stem}" for sql_dir in DERIVED_SQL_DIRS.values() for sql_file in sorted(sql_dir.glob('*.sql'))]
+    return ['recent_runs_without_jobs'] + derived + ['generate_sources', 'upsert_runs']
+
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+# stages: run in the child process; return the output size (bytes or rows) as (value, unit)
+
+
+def stage_recent_runs_without_jobs(scale: float) -> tuple[int, str]:
+    lake, _ = lake_paths(scale_dir(scale))
+    with DuckLakeConnection(lake) as con:
+        repo_runs = get_recent_run_ids_without_jobs(con)
+    return sum(len(run_ids) for run_ids in repo_runs.values()), 'runs'
+
+
+def stage_upsert_runs(scale: float) -> tuple[int, str]:
+    lake, _ = lake_paths(scale_dir(scale))
+    with DuckLakeConnection(lake) as con:
+        max_id = con.max_id(GITHUB_RUNS_TABLE)
+        # the most recent runs with a changed conclusion, and new runs (as the feed gets them: json records)
+        records = [
+            json.loads(tup[0])
+            for tup in con.sql(
+                f"""
+                select to_json(changed) from (
+                  select * replace ('cancelled' as conclusion) from {GITHUB_RUNS_TABLE} order by id desc limit {UPSERT_CHANGED}
+                ) changed
+                union all
+                select to_json(new) from (
+                  select * replace (id + {max_id} as id) from {GITHUB_RUNS_TABLE} order by id desc limit {UPSERT_NEW}
+                ) new
+                """
+            ).fetchall()
+        ]
+        con.upsert_table(GITHUB_RUNS_TABLE, records, ['id'], schema=CI_RUNS_SCHEMA)
+    return len(records), 'records'
+
+
+def stage_derived(scale: float, name: str) -> tuple[int, str]:
+    lake, benchmark_lake = lake_paths(scale_dir(scale))
+    for lake_kind, sql_dir in DERIVED_SQL_DIRS.items():
+        sql_file = sql_dir / f"{name}.sql"
+        if sql_file.is_file():
+            with DuckLakeConnection(benchmark_lake if lake_kind == 'benchmark' else lake, read_only=True) as con:
+                con.execute(f"CREATE TEMPORARY TABLE derived AS\n{sql_file.read_text()}")
+                return con.sql("select count(*) from derived").fetchone()[0], 'rows'
+    raise ValueError(f"derived table sql file not found: {name}")
+
+
+def stage_generate_sources(scale: float) -> tuple[int, str]:
+    lake, benchmark_lake = lake_paths(scale_dir(scale))
+    out_dir = scale_dir(scale) / 'sources'
+    out_dir.mkdir(exist_ok=True)
+    sources = json.loads(SOURCES_CONFIG.read_text())
+    for lake_path, read_only in [(lake, False), (benchmark_lake, True)]:
+        # the benchmarks source reads the benchmark lake, all other sources the feeds' lake
+        lake_sources = [s for s in sources if (s.get('lake_secret', DEFAULT_LAKE_SECRET) != DEFAULT_LAKE_SECRET) == read_only]
+        with DuckLakeConnection(lake_path, read_only=read_only) as con:
+            con.execute("SET preserve_insertion_order=false")
+            for source in lake_sources:
+                db_path = out_dir / f"{source['name']}.duckdb"
+                db_path.unlink(missing_ok=True)
+                generate_source(con, {**source, 'db_path': str(db_path)})
+    return dir_size(out_dir), 'bytes'
+
+
+def run_stage(scale: float, stage: str) -> dict:
+    start = time.perf_counter()
+    if stage == 'generate':
+        shutil.rmtree(scale_dir(scale), ignore_errors=True)
+        generate(scale, scale_dir(scale))
+        output, unit = dir_size(scale_dir(scale)), 'bytes'
+    elif stage.startswith('derived:'):
+        output, unit = stage_derived(scale, stage.removeprefix('derived:'))
+    else:
+        output, unit = globals()[f"stage_{stage}"](scale)
+    seconds = time.perf_counter() - start
+    # linux: ru_maxrss in KiB
+    peak_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'stage': stage, 'scale': scale, 'seconds': seconds, 'peak_mib': peak_mib, 'output': output, 'unit': unit}
+
+
+def run_stage_in_process(scale: float, stage: str) -> dict:
+    result_file = scale_dir(scale) / f"result_{stage.replace(':', '_')}.json"
+    result_file.parent.mkdir(parents=True, exist_ok=True)
+    result_file.unlink(missing_ok=True)
+    cmd = [sys.executable, '-m', 'scale_benchmark.run_scale_benchmark', '--run-stage', stage, '--scale', str(scale),
+           '--result-file', str(result_file)]
+    print(f"--- scale {scale:g}: {stage}", flush=True)
+    if subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode != 0 or not result_file.is_file():
+        print(f"::warning title=scale benchmark::stage '{stage}' failed at scale {scale:g}")
+        return {'stage': stage, 'scale': scale, 'seconds': math.nan, 'peak_mib': math.nan, 'output': 0, 'unit': 'failed'}
+    return json.loads(result_file.read_text())
+
+
+def format_output(output: int, unit: str) -> str:
+    return f"{output / 1024**2:.1f} MiB" if unit == 'bytes' else f"{output} {unit}"
+
+
+def print_report(results: list[dict]):
+    print(f"\n{'stage':<32}{'scale':>8}{'seconds':>10}{'peak MiB':>10}{'output':>18}{'exponent':>10}")
+    for stage in dict.fromkeys(r['stage'] for r in results):
+        stage_results = sorted([r for r in results if r['stage'] == stage], key=lambda r: r['scale'])
+        previous = None
+        for r in stage_results:
+            exponent = ''
+            if previous and previous['seconds'] > 0 and r['seconds'] > 0:
+                value = math.log(r['seconds'] / previous['seconds']) / math.log(r['scale'] / previous['scale'])
+                # short stages are dominated by fixed costs (process start, attach); only flag what takes time
+                flag = ' !' if value > SUPERLINEAR_EXPONENT and r['seconds'] > 1 else ''
+                exponent = f"{value:.2f}{flag}"
+            print(
+                f"{stage:<32}{r['scale']:>8g}{r['seconds']:>10.2f}{r['peak_mib']:>10.0f}"
+                f"{format_output(r['output'], r['unit']):>18}{exponent:>10}"
+            )
+            previous = r
+    print(f"\n'!': time grows faster than scale^{SUPERLINEAR_EXPONENT} (superlinear)")
+
+
+def main(args: list[str]):
+    def pop_option(name, default=None):
+        if name in args:
+            idx = args.index(name)
+            value = args[idx + 1]
+            del args[idx : idx + 2]
+            return value
+        return default
+
+    # child process: run one stage, write the result
+    stage = pop_option('--run-stage')
+    if stage:
+        result = run_stage(float(pop_option('--scale')), stage)
+        Path(pop_option('--result-file')).write_text(json.dumps(result))
+        return
+
+    scales = [float(s) for s in pop_option('--scales', ",".join(map(str, DEFAULT_SCALES))).split(',')]
+    stages = pop_option('--stages')
+    stages = stages.split(',') if stages else all_stages()
+    regenerate = '--regenerate' in args
+    if regenerate:
+        args.remove('--regenerate')
+    if args:
+        raise ValueError(f"Invalid arguments for run_scale_benchmark: {args}")
+    unknown = set(stages) - set(all_stages())
+    if unknown:
+        raise ValueError(f"unknown stage(s): {sorted(unknown)}, expected: {all_stages()}")
+    # upsert_runs changes the data: always last
+    stages.sort(key=lambda s: s == 'upsert_runs')
+
+    results = []
+    for scale in scales:
+        if regenerate or not Path(lake_paths(scale_dir(scale))[0]).is_file():
+            results.append(run_stage_in_process(scale, 'generate'))
+        for stage in stages:
+            results.append(run_stage_in_process(scale, stage))
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
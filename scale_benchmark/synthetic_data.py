@@ -0,0 +1,249 @@
+"""
+Synthetic data for the scaling benchmark (see: run_scale_benchmark.py), generated with SQL in local file-backed ducklakes:
+- <scale_dir>/lake.ducklake: ci_repositories, ci_repositories_metadata, ci_workflows, ci_runs, ci_jobs, ci_job_steps
+  (runs and jobs tiered as by the feed: the aged ones in ci_runs_archive / ci_jobs_archive) and extension_downloads (and its rollups), with the schemas of the feeds
+- <scale_dir>/benchmark_lake.ducklake: runs, query_results and query_metrics, with the columns that the derived
+  tables of the benchmarks source use (see: benchmark_derived_tables/)
+
+Volumes are SCALE_1 times the scale factor: scale 1 is roughly today's volume, so scale 10 and 100 show how the
+pipeline behaves when the history (and the number of repos, extensions and benchmark runs) grows.
+Data is deterministic per scale (no random()), timestamps end at the time of generation.
+"""
+
+from pathlib import Path
+
+from utils.ducklake import DuckLakeConnection, schema_columns_sql
+from feeds.ci_metrics.ci_config import *
+from feeds.ci_metrics.ci_metrics_feed import job_steps_sql
+from feeds.ci_metrics.ci_schemas import (
+    CI_JOB_STEPS_SCHEMA,
+    CI_JOBS_SCHEMA,
+    CI_REPOSITORIES_SCHEMA,
+    CI_RUNS_SCHEMA,
+    CI_WORKFLOWS_SCHEMA,
+)
+from feeds.ci_metrics.ci_tiering import migrate_to_archive
+from feeds.extension_downloads.extension_downloads_feed import (
+    EXTENSION_DOWNLOADS_TABLE,
+    EXTENSION_ROLLUPS_TABLE,
+    create_extension_table_if_not_exists,
+    update_rollups,
+)
+
+SCALE_1 = {
+    'repos': 20,
+    'workflows_per_repo': 12,
+    'runs': 100_000,
+    'jobs_per_run': 20,
+    'steps_per_job': 8,
+    'history_days': 730,
+    'runs_without_jobs_fraction': 0.01,  # the most recent runs, as if their jobs are not fetched yet
+    'extensions': 300,
+    'weeks': 150,
+    'benchmark_runs': 2_000,
+    'warm_runs': 5,
+}
+
+# these grow with the scale; the others (e.g. jobs per run, weeks of extension stats) are the same at every scale
+SCALED_VOLUMES = ['repos', 'runs', 'extensions', 'benchmark_runs']
+
+# queries per benchmark suite, as in the benchmark lake
+BENCHMARK_QUERIES = {'tpch': 22, 'tpcds': 99, 'clickbench': 43}
+
+
+def lake_paths(scale_dir: Path) -> tuple[str, str]:
+    return str(scale_dir / 'lake.ducklake'), str(scale_dir / 'benchmark_lake.ducklake')
+
+
+def volumes(scale: float) -> dict:
+    return {key: max(1, int(value * scale)) if key in SCALED_VOLUMES else value for key, value in SCALE_1.items()}
+
+
+def generate(scale: float, scale_dir: Path):
+    scale_dir.mkdir(parents=True, exist_ok=True)
+    lake, benchmark_lake = lake_paths(scale_dir)
+    v = volumes(scale)
+    print(f"generating synthetic data at scale {scale}: {v}", flush=True)
+    with DuckLakeConnection(lake) as con:
+        generate_ci_tables(con, v)
+        generate_extension_downloads(con, v)
+    with DuckLakeConnection(benchmark_lake) as con:
+        generate_benchmark_tables(con, v)
+
+
+def generate_ci_tables(con: DuckLakeConnection, v: dict):
+    for table, schema in [
+        (GITHUB_REPOS_TABLE, CI_REPOSITORIES_SCHEMA),
+        (GITHUB_WORKFLOWS_TABLE, CI_WORKFLOWS_SCHEMA),
+        (GITHUB_RUNS_TABLE, CI_RUNS_SCHEMA),
+        (GITHUB_JOBS_TABLE, CI_JOBS_SCHEMA),
+        (GITHUB_JOB_STEPS_TABLE, CI_JOB_STEPS_SCHEMA),
+    ]:
+        con.execute(f"CREATE OR REPLACE TABLE {table} ({schema_columns_sql(schema)})")
+    con.execute(f"CREATE OR REPLACE TABLE {GITHUB_REPOS_METADATA_TABLE} (repository_id BIGINT, max_run_id BIGINT)")
+
+    con.execute(
+        f"""
+        INSERT INTO {GITHUB_REPOS_TABLE} BY NAME
+        SELECT
+          r + 1 AS id, 'repo_' || r AS name, 'synthetic/repo_' || r AS full_name, false AS private,
+          now()::TIMESTAMP - INTERVAL {v['history_days']} DAY AS created_at, 'main' AS default_branch
+        FROM range({v['repos']}) t(r)
+        """
+    )
+    con.execute(
+        f"""
+        INSERT INTO {GITHUB_WORKFLOWS_TABLE} BY NAME
+        SELECT
+          r * 100 + w AS id, 'Workflow ' || w AS name, '.github/workflows/workflow_' || w || '.yml' AS path,
+          'active' AS state, 'synthetic/repo_' || r AS repository
+        FROM range({v['repos']}) t1(r), range({v['workflows_per_repo']}) t2(w)
+        """
+    )
+    # runs: evenly spread over the history, round robin over the repos; one in ten fails
+    con.execute(
+        f"""
+        INSERT INTO {GITHUB_RUNS_TABLE} BY NAME
+        SELECT
+          i + 1 AS id,
+          'Workflow ' || (i % {v['workflows_per_repo']}) AS name,
+          if(i % 3 = 0, 'feature-' || (i % 97), 'main') AS head_branch,
+          md5(i::VARCHAR) AS head_sha,
+          i // {v['repos']} AS run_number,
+          ['push', 'pull_request', 'schedule'][i % 3 + 1] AS event,
+          'completed' AS status,
+          if(i % 10 = 0, 'failure', 'success') AS conclusion,
+          (i % {v['repos']}) * 100 + i % {v['workflows_per_repo']} AS workflow_id,
+          created_at,
+          created_at + INTERVAL 40 MINUTE AS updated_at,
+          created_at AS run_started_at,
+          1 AS run_attempt,
+          {{'id': i % {v['repos']} + 1, 'name': 'repo_' || (i % {v['repos']}),
+            'full_name': 'synthetic/repo_' || (i % {v['repos']}), 'private': false}} AS repository
+        FROM (
+          SELECT i, now()::TIMESTAMP - to_seconds(({v['runs']} - i) * {v['history_days'] * 86400 // v['runs']}) AS created_at
+          FROM range({v['runs']}) t(i)
+        )
+        """
+    )
+    con.execute(
+        f"""
+        INSERT INTO {GITHUB_REPOS_METADATA_TABLE}
+        SELECT repository['id'], max(id) FROM {GITHUB_RUNS_TABLE} GROUP BY ALL
+        """
+    )
+    # jobs (with nested steps), for all but the most recent runs
+    runs_with_jobs = int(v['runs'] * (1 - v['runs_without_jobs_fraction']))
+    con.execute(
+        f"""
+        INSERT INTO {GITHUB_JOBS_TABLE} BY NAME
+        SELECT
+          runs.id * 100 + j AS id,
+          runs.id AS run_id,
+          runs.name AS workflow_name,
+          runs.head_branch,
+          runs.head_sha,
+          'completed' AS status,
+          if((runs.id + j) % 50 = 0, 'failure', 'success') AS conclusion,
+          runs.created_at AS created_at,
+          runs.created_at + to_seconds(30 + j * 7) AS started_at,
+          runs.created_at + to_seconds(30 + j * 7 + {v['steps_per_job']} * (20 + j)) AS completed_at,
+          'job_' || j || ' (' || ['linux', 'osx', 'windows'][j % 3 + 1] || ')' AS name,
+          [
+            {{'name': 'step_' || s, 'status': 'completed', 'conclusion': 'success', 'number': s + 1,
+              'started_at': runs.created_at + to_seconds(30 + j * 7 + s * (20 + j)),
+              'completed_at': runs.created_at + to_seconds(30 + j * 7 + (s + 1) * (20 + j))}}
+            FOR s IN range({v['steps_per_job']})
+          ] AS steps,
+          [['ubuntu-latest', 'macos-latest', 'windows-latest'][j % 3 + 1]] AS labels,
+          j % 3 AS runner_group_id
+        FROM {GITHUB_RUNS_TABLE} runs, range({v['jobs_per_run']}) t(j)
+        WHERE runs.id <= {runs_with_jobs}
+        """
+    )
+    con.execute(f"INSERT INTO {GITHUB_JOB_STEPS_TABLE} BY NAME {job_steps_sql(GITHUB_JOBS_TABLE)}")
+    migrate_to_archive(con)
+
+
+def generate_extension_downloads(con: DuckLakeConnection, v: dict):
+    con.execute(f"DROP TABLE IF EXISTS {EXTENSION_DOWNLOADS_TABLE}")
+    con.execute(f"DROP TABLE IF EXISTS {EXTENSION_ROLLUPS_TABLE}")
+    create_extension_table_if_not_exists(con)
+    # downloads per extension grow over the weeks; one in five extensions is a core extension
+    con.execute(
+        f"""
+        INSERT INTO {EXTENSION_DOWNLOADS_TABLE} BY NAME
+        SELECT
+          isoyear(d) AS year,
+          week(d) AS week,
+          'extension_' || e AS extension_name,
+          ((e * 7919) % 10000 + 10 * w) * if(e % 5 = 0, 100, 1) AS downloads,
+          d + INTERVAL 7 DAY AS last_update,
+          if(e % 5 = 0, 'core', 'community') AS repository
+        FROM (
+          SELECT w, current_date - INTERVAL ({v['weeks']} - w) WEEK AS d
+          FROM range({v['weeks']}) t(w)
+        ), range({v['extensions']}) t2(e)
+        """
+    )
+    update_rollups(con)
+
+
+def generate_benchmark_tables(con: DuckLakeConnection, v: dict):
+    benchmarks = list(BENCHMARK_QUERIES)
+    queries_case = " ".join([f"WHEN '{b}' THEN {n}" for b, n in BENCHMARK_QUERIES.items()])
+    con.execute(
+        f"""
+        CREATE OR REPLACE TABLE runs AS
+        SELECT
+          i + 1 AS run_id,
+          'invocation_' || (i // 3) AS invocation_id,
+          now()::TIMESTAMP - to_seconds(({v['benchmark_runs']} - i) * {v['history_days'] * 86400 // v['benchmark_runs']}) AS "timestamp",
+          {benchmarks}[i % {len(benchmarks)} + 1] AS benchmark,
+          ['duckdb', 'ducklake'][i // {len(benchmarks)} % 2 + 1] AS benchmark_name,
+          if(i % {len(benchmarks)} = 2, NULL, [1, 10, 100][i // 6 % 3 + 1])::DOUBLE AS scale_factor,
+          ['v1.4.5', 'v1.5.5', 'v2.0.0-alpha'][i // 12 % 3 + 1] AS duckdb_version,
+          md5('commit' || (i // 12)) AS duckdb_commit_sha,
+          'release' AS binary_source,
+          'linux' AS os,
+          ['x86_64', 'aarch64'][i // 36 % 2 + 1] AS cpu_arch,
+          NULL::VARCHAR AS machine_type,
+          8 AS threads,
+          '16GB' AS memory_limit,
+          ['duckdb', 'ducklake'][i // {len(benchmarks)} % 2 + 1] AS storage_type,
+          {v['warm_runs']} AS warm_runs,
+          md5('queries' || {benchmarks}[i % {len(benchmarks)} + 1]) AS queries_sha,
+          i % 50 = 49 AS is_test
+        FROM range({v['benchmark_runs']}) t(i)
+        """
+    )
+    # one query in 200 fails
+    con.execute(
+        f"""
+        CREATE OR REPLACE TABLE query_results AS
+        SELECT
+          run_id,
+          'q' || lpad((q + 1)::VARCHAR, 2, '0') AS query,
+          if((run_id + q) % 200 = 0, 'failed', 'ok') AS status,
+          true AS verified,
+          if((run_id + q) % 200 = 0, 'synthetic error', NULL) AS error,
+          NULL::DOUBLE AS median_seconds
+        FROM (SELECT run_id, unnest(range(CASE benchmark {queries_case} END)) AS q FROM runs)
+        """
+    )
+    con.execute(
+        f"""
+        CREATE OR REPLACE TABLE query_metrics AS
+        SELECT
+          qr.run_id,
+          qr.query,
+          query_run,
+          metric_name,
+          if(metric_name = 'execution_time_seconds',
+             (hash(qr.query) % 1000) / 100.0 + 0.01 + (hash(qr.run_id, query_run) % 100) / 1000.0,
+             (hash(qr.run_id, qr.query, query_run) % 1000000)::DOUBLE) AS metric_value
+        FROM query_results qr, range(1, {v['warm_runs']} + 1) t(query_run),
+          (SELECT unnest(['execution_time_seconds', 'peak_memory_bytes']) AS metric_name)
+        WHERE qr.status = 'ok'
+        """
+    )
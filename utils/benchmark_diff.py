@@ -0,0 +1,187 @@
+"""
+Compare the benchmark results of two duckdb commits (or versions): per query and the overall geomean, in ms.
+
+Reads the summary index benchmark_commit_summary of the benchmarks source (see:
+benchmark_derived_tables/benchmark_commit_summary.sql, built by generate_sources), so a comparison never
+scans query_metrics: one row per commit, series, storage type, cpu arch, machine, queries_sha and query, with
+the mean and the spread of all warm runs.
+
+- a side is a commit sha (or a prefix of it) or a duckdb version (e.g. 'v1.5.5'); a version with several
+  benchmarked commits is its most recently benchmarked commit, per series
+- series are compared per (benchmark_series, storage_type, cpu_arch_label, machine_label), and only with the
+  same queries_sha: an edited query is not comparable with its previous version
+- a difference is significant if it exceeds both BENCHMARK_DIFF_Z standard errors of the warm-run spread
+  (Welch) and BENCHMARK_DIFF_MIN_CHANGE; the geomean uses the same test on the log scale, over the queries
+  that were timed on both sides
+
+run this file via Makefile: 'make benchmark_diff BASE=<commit|version> COMPARE=<commit|version>'
+or: python3 -m utils.benchmark_diff <base> <compare> [--series 'tpch @ sf1'] [--storage-type duckdb]
+        [--cpu-arch x86_64] [--machine <label>] [--significant] [--db <benchmarks.duckdb>]
+"""
+
+import duckdb
+import math
+import sys
+
+BENCHMARKS_SOURCE_DB = './evidence/sources/benchmarks/benchmarks.duckdb'
+SUMMARY_TABLE = 'benchmark_commit_summary'
+SERIES_KEY = ['benchmark_series', 'storage_type', 'cpu_arch_label', 'machine_label']
+FILTER_OPTIONS = {
+    '--series': 'benchmark_series',
+    '--storage-type': 'storage_type',
+    '--cpu-arch': 'cpu_arch_label',
+    '--machine': 'machine_label',
+}
+BENCHMARK_DIFF_Z = 3.0
+BENCHMARK_DIFF_MIN_CHANGE = 0.05
+
+
+def load_side(con: duckdb.DuckDBPyConnection, name: str, selector: str, filters: dict[str, str]):
+    # temp table <name>: the summary rows of the commit that the selector resolves to, per series and queries_sha
+    filter_sql = "".join([f" and {column} = ?" for column in filters])
+    key_sql = ", ".join(SERIES_KEY + ['queries_sha'])
+    con.execute(
+        f"""
+        create or replace temp table {name} as
+        with matches as (
+          from {SUMMARY_TABLE}
+          where (starts_with(duckdb_commit_sha, ?) or duckdb_version = ?){filter_sql}
+        ),
+        latest as (
+          select {key_sql}, arg_max(duckdb_commit_sha, last_run_timestamp) as duckdb_commit_sha
+          from matches
+          group by all
+        )
+        select matches.* from matches semi join latest using ({key_sql}, duckdb_commit_sha)
+        """,
+        [selector, selector] + list(filters.values()),
+    )
+    commits = con.sql(f"select distinct duckdb_commit_sha, duckdb_version from {name} order by all").fetchall()
+    if not commits:
+        raise ValueError(f"no benchmark results for '{selector}' (filters: {filters}) in {SUMMARY_TABLE}")
+    for commit_sha, version in commits:
+        print(f"{name}: {selector} -> commit {commit_sha} ({version})")
+
+
+def compare(a: tuple | None, b: tuple | None) -> tuple:
+    # a, b: (mean_seconds, stddev_seconds, timed_runs); returns (diff_seconds, relative change, verdict)
+    if not a or not b or not a[2] or not b[2]:
+        return None, None, 'missing'
+    diff = b[0] - a[0]
+    change = diff / a[0]
+    if a[2] < 2 or b[2] < 2:
+        return diff, change, '?'
+    se = math.sqrt(a[1] ** 2 / a[2] + b[1] ** 2 / b[2])
+    return diff, change, verdict(abs(diff) > BENCHMARK_DIFF_Z * se, change)
+
+
+def verdict(beyond_noise: bool, change: float) -> str:
+    if not beyond_noise or abs(change) < BENCHMARK_DIFF_MIN_CHANGE:
+        return ''
+    return 'slower' if change > 0 else 'faster'
+
+
+def compare_geomean(query_timings: list[tuple[tuple, tuple]]) -> tuple:
+    # geomean over the queries timed on both sides; the variance of log(mean) is ~ (stddev / mean)^2 / n
+    timed = [(a, b) for a, b in query_timings if a and b and a[2] and b[2]]
+    if not timed:
+        return None, None, None, 'missing'
+    log_a = sum(math.log(a[0]) for a, _ in timed) / len(timed)
+    log_b = sum(math.log(b[0]) for _, b in timed) / len(timed)
+    geomean_a, geomean_b = math.exp(log_a), math.exp(log_b)
+    change = geomean_b / geomean_a - 1
+    if any(a[2] < 2 or b[2] < 2 for a, b in timed):
+        return geomean_a, geomean_b, change, '?'
+    se = math.sqrt(sum((a[1] / a[0]) ** 2 / a[2] + (b[1] / b[0]) ** 2 / b[2] for a, b in timed)) / len(timed)
+    return geomean_a, geomean_b, change, verdict(abs(log_b - log_a) > BENCHMARK_DIFF_Z * se, change)
+
+
+def format_ms(seconds: float | None) -> str:
+    return f"{seconds * 1000:.1f}" if seconds is not None else '-'
+
+
+def format_change(change: float | None) -> str:
+    return f"{change:+.1%}" if change is not None else '-'
+
+
+def print_series(series: tuple, rows: list[tuple], significant_only: bool):
+    # rows: (query, base timing, compare timing); a timing is (mean_seconds, stddev_seconds, timed_runs) or None
+    print(f"\n{' | '.join(series)}")
+    print(f"  {'query':<12}{'base ms':>12}{'compare ms':>12}{'diff ms':>12}{'change':>10}  verdict")
+    for query, a, b in rows:
+        diff, change, result = compare(a, b)
+        if significant_only and result not in ['slower', 'faster']:
+            continue
+        print(
+            f"  {query:<12}{format_ms(a[0] if a else None):>12}{format_ms(b[0] if b else None):>12}"
+            f"{format_ms(diff):>12}{format_change(change):>10}  {result}"
+        )
+    geomean_a, geomean_b, change, result = compare_geomean([(a, b) for _, a, b in rows])
+    diff = geomean_b - geomean_a if geomean_a is not None else None
+    print(
+        f"  {'geomean':<12}{format_ms(geomean_a):>12}{format_ms(geomean_b):>12}"
+        f"{format_ms(diff):>12}{format_change(change):>10}  {result}"
+    )
+
+
+def benchmark_diff(db_path: str, base: str, other: str, filters: dict[str, str], significant_only: bool = False):
+    with duckdb.connect(db_path, read_only=True) as con:
+        load_side(con, 'base', base, filters)
+        load_side(con, 'compare', other, filters)
+        key_sql = ", ".join(SERIES_KEY)
+        # series measured on both sides, but never with the same queries: not comparable
+        for tup in con.sql(
+            f"""
+            select {key_sql}, string_agg(distinct base.queries_sha[:8]), string_agg(distinct compare.queries_sha[:8])
+            from base join compare using ({key_sql})
+            group by all
+            having count(*) filter (where base.queries_sha = compare.queries_sha) = 0
+            order by all
+            """
+        ).fetchall():
+            print(f"\n{' | '.join(tup[:4])}: queries changed ({tup[4]} -> {tup[5]}), not compared")
+        rows = con.sql(
+            f"""
+            with common as (
+              select distinct {key_sql}, queries_sha from base join compare using ({key_sql}, queries_sha)
+            ),
+            both_sides as (
+              select
+                {key_sql}, queries_sha, query,
+                if(base.query is null, null, (base.mean_seconds, base.stddev_seconds, base.timed_runs)) as base_timing,
+                if(compare.query is null, null, (compare.mean_seconds, compare.stddev_seconds, compare.timed_runs)) as compare_timing
+              from base full join compare using ({key_sql}, queries_sha, query)
+            )
+            select {key_sql}, query, base_timing, compare_timing
+            from both_sides semi join common using ({key_sql}, queries_sha)
+            order by all
+            """
+        ).fetchall()
+    series_rows: dict[tuple, list[tuple]] = {}
+    for row in rows:
+        series_rows.setdefault(row[:4], []).append(row[4:])
+    if not series_rows:
+        print("no series benchmarked on both sides (with the same queries)")
+    for series, query_rows in series_rows.items():
+        print_series(series, query_rows, significant_only)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    def pop_option(name, default=None):
+        if name in args:
+            idx = args.index(name)
+            value = args[idx + 1]
+            del args[idx : idx + 2]
+            return value
+        return default
+
+    db_path = pop_option('--db', BENCHMARKS_SOURCE_DB)
+    filters = {column: value for option, column in FILTER_OPTIONS.items() if (value := pop_option(option))}
+    significant_only = '--significant' in args
+    if significant_only:
+        args.remove('--significant')
+    if len(args) != 2:
+        raise ValueError(f"Invalid arguments for benchmark_diff: {args}; expected: <base> <compare> (commit sha or version)")
+    benchmark_diff(db_path, args[0], args[1], filters, significant_only)
@@ -0,0 +1,171 @@
+"""
+Content-addressed build cache for the evidence sources, kept across workflow runs in ./build_cache/.
+
+generate_sources --cache computes a key per table of a source, from what the table is made of:
+- a copied table: its version in the lake (table_id and the last snapshot that changed it, see
+  DuckLakeConnection.table_versions), so a feed that did not touch the table does not change its key
+- a derived table: its SQL file, and the versions of the lake tables that the SQL mentions (outside of comments)
+- a view (copied, or mentioned by a derived table): its SQL, and the versions of the tables it reads (see:
+  DuckLakeConnection.views)
+- a downsampled table: its config, the key (or version) of the table it downsamples, and the date (the
+  full resolution window is relative to the current date)
+The key of a source combines these with its config and its evidence query files. A source whose key is in the
+cache is restored (sources/<name>/<key>.duckdb) instead of generated; the keys are written to sources_manifest.json.
+
+The build (python3 -m utils.build_cache) restores the output of the previous evidence build (the parquet files of
+every source query, and evidence's own metadata), re-runs 'npm run sources' only for the sources whose key differs
+from the previous build (build_manifest.json), then runs 'npm run build' and stores the output for the next run.
+A source without a key (e.g. a table that is not in the lake) is never cached.
+
+run this file via Makefile: 'make generate_sources_cached build_cached'
+"""
+
+from datetime import date
+import hashlib
+import json
+from pathlib import Path
+import shutil
+import subprocess
+
+from utils.ducklake import referenced_names
+
+BUILD_CACHE_DIR = Path('./build_cache')
+SOURCES_MANIFEST = 'sources_manifest.json'
+BUILD_MANIFEST = 'build_manifest.json'
+# bump when the way a source is generated changes, to invalidate every cached source
+CACHE_FORMAT_VERSION = 1
+EVIDENCE_DIR = Path('./evidence')
+# the output of 'npm run sources', which 'npm run build' reads
+EVIDENCE_STATE_DIRS = [Path('.evidence/template/static/data'), Path('.evidence/meta')]
+DOWNSAMPLE_MODULE = Path('./utils/downsample.py')
+
+
+def digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_digest(path: Path) -> str | None:
+    return hashlib.sha256(path.read_bytes()).hexdigest() if path.is_file() else None
+
+
+def load_manifest(name: str) -> dict:
+    path = BUILD_CACHE_DIR / name
+    return json.loads(path.read_text()) if path.is_file() else {}
+
+
+def save_manifest(name: str, manifest: dict):
+    BUILD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = (BUILD_CACHE_DIR / name).with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(manifest, indent=1, sort_keys=True))
+    tmp_path.replace(BUILD_CACHE_DIR / name)
+
+
+def lake_versions(names, versions: dict[str, str], views: dict[str, dict]) -> dict[str, str] | None:
+    # the versions of the lake tables in names, and for the lake views in names: their SQL and the versions of the
+    # tables they read; None if a name is unknown
+    tables, view_sql = set(), {}
+    for name in names:
+        if name in views:
+            view_sql[name] = views[name]['sql']
+            tables.update(views[name]['tables'])
+        else:
+            tables.add(name)
+    if not tables <= set(versions):
+        return None
+    return {**{table: versions[table] for table in sorted(tables)}, **view_sql}
+
+
+def table_keys(source: dict, versions: dict[str, str], views: dict[str, dict]) -> dict[str, str | None]:
+    # per table of the source: its key, or None if it can not be determined (then the source is not cached)
+    keys = {}
+    for table in source.get("tables", []):
+        read_tables = lake_versions([table], versions, views)
+        keys[table] = digest(['table', table, read_tables]) if read_tables else None
+    for derived in source.get("derived_tables", []):
+        if "downsample" in derived:
+            config = derived["downsample"]
+            # a table of this source (e.g. a derived table above this one) or of the lake
+            upstream = keys[config['table']] if config['table'] in keys else lake_versions([config['table']], versions, views)
+            inputs = [upstream, file_digest(DOWNSAMPLE_MODULE), str(date.today())]
+        else:
+            sql_file = Path(derived["sql_file"])
+            sql = sql_file.read_text() if sql_file.is_file() else None
+            # the lake tables and views that the SQL mentions: more than it reads is fine, a table too many only
+            # invalidates more often
+            read_tables = lake_versions(referenced_names(sql, set(versions) | set(views)), versions, views) if sql else None
+            inputs = [sql, read_tables]
+        keys[derived["name"]] = digest([derived, *inputs]) if None not in inputs else None
+    return keys
+
+
+def source_key(source: dict, keys: dict[str, str | None]) -> str | None:
+    if not keys or None in keys.values():
+        return None
+    # the evidence queries of the source (next to its .duckdb file): their output is cached by the build
+    query_files = sorted(p for p in Path(source["db_path"]).parent.iterdir() if p.suffix in ['.sql', '.yaml'])
+    return digest([CACHE_FORMAT_VERSION, source, keys, {p.name: file_digest(p) for p in query_files}])
+
+
+def cached_db_path(source: dict, key: str) -> Path:
+    return BUILD_CACHE_DIR / 'sources' / source["name"] / f"{key}.duckdb"
+
+
+def restore_source(source: dict, key: str) -> bool:
+    cached = cached_db_path(source, key)
+    if not cached.is_file():
+        return False
+    shutil.copyfile(cached, source["db_path"])
+    return True
+
+
+def store_source(source: dict, key: str):
+    # only the latest version of a source is kept
+    cached = cached_db_path(source, key)
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    for old in cached.parent.iterdir():
+        old.unlink()
+    shutil.copyfile(source["db_path"], cached.with_suffix('.tmp'))
+    cached.with_suffix('.tmp').replace(cached)
+
+
+def restore_evidence_state() -> bool:
+    cached_dirs = [BUILD_CACHE_DIR / 'evidence' / d for d in EVIDENCE_STATE_DIRS]
+    if not all(d.is_dir() for d in cached_dirs):
+        return False
+    for state_dir, cached_dir in zip(EVIDENCE_STATE_DIRS, cached_dirs):
+        shutil.copytree(cached_dir, EVIDENCE_DIR / state_dir, dirs_exist_ok=True)
+    return True
+
+
+def store_evidence_state():
+    for state_dir in EVIDENCE_STATE_DIRS:
+        cached_dir = BUILD_CACHE_DIR / 'evidence' / state_dir
+        shutil.rmtree(cached_dir, ignore_errors=True)
+        shutil.copytree(EVIDENCE_DIR / state_dir, cached_dir)
+
+
+def npm(*args: str):
+    subprocess.run(['npm', '--prefix', str(EVIDENCE_DIR), 'run', *args], check=True)
+
+
+def build():
+    sources = load_manifest(SOURCES_MANIFEST)
+    if not sources:
+        raise ValueError(f"no {SOURCES_MANIFEST} in {BUILD_CACHE_DIR}: run 'make generate_sources_cached' first")
+    built = load_manifest(BUILD_MANIFEST)
+    changed = sorted(name for name, entry in sources.items() if entry['key'] is None or built.get(name) != entry['key'])
+    if not restore_evidence_state():
+        print("build cache: no previous build, running all sources")
+        npm('sources')
+    elif changed:
+        print(f"build cache: running changed sources: {', '.join(changed)} (unchanged: {len(sources) - len(changed)})")
+        npm('sources', '--', '--sources', ','.join(changed))
+    else:
+        print(f"build cache: all {len(sources)} sources unchanged")
+    npm('build')
+    store_evidence_state()
+    save_manifest(BUILD_MANIFEST, {name: entry['key'] for name, entry in sources.items() if entry['key']})
+
+
+if __name__ == "__main__":
+    build()
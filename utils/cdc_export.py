@@ -0,0 +1,179 @@
+"""
+Change data capture: export the changes of ducklake tables as parquet files, so a consumer refreshes in time
+proportional to what changed, instead of rescanning whole tables.
+
+Per table, in <dir>/<table>/:
+- base.parquet: the table at snapshot base_snapshot; columns _rowid, _snapshot_id and the columns of the table
+- delta_<start>_<end>.parquet: the net change per row in snapshots start..end (see:
+  DuckLakeConnection.net_table_changes_sql); columns _change_type ('upsert' or 'delete'), _rowid, _snapshot_id and
+  the columns of the table (of a deleted row: as it was). The snapshot range and the table are also stored in the
+  parquet metadata (KV_METADATA)
+- state.json: table_id, base_snapshot, last_snapshot (the last exported snapshot) and the delta files
+
+An export only reads the changes since last_snapshot, and skips a table that did not change since then (see:
+DuckLakeConnection.table_versions). A full export (a new base) is made for a new table, a re-created table (new
+table_id), or when snapshots after last_snapshot were expired (checkpoint), since their changes are gone.
+Compaction folds the deltas into the base: after CDC_COMPACT_AFTER_DELTAS deltas, or with --compact.
+Row ids are stable in a ducklake (also across updates and compaction), so they are the key of the fold.
+
+A consumer reads the current state of a table with current_state_sql(<dir>/<table>), or applies the deltas
+since the last one it read.
+
+run this file via Makefile: 'make cdc_export'
+or: python3 -m utils.cdc_export [<table> ...] [--dir ./cdc_export] [--compact] [--local]
+"""
+
+import json
+from pathlib import Path
+import sys
+
+from utils.ducklake import DuckLakeConnection
+
+CDC_DIR = Path('./cdc_export')
+CDC_COMPACT_AFTER_DELTAS = 20
+STATE_FILE = 'state.json'
+BASE_FILE = 'base.parquet'
+
+
+def load_state(table_dir: Path) -> dict | None:
+    path = table_dir / STATE_FILE
+    return json.loads(path.read_text()) if path.is_file() else None
+
+
+def save_state(table_dir: Path, state: dict):
+    tmp_path = (table_dir / STATE_FILE).with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(state, indent=1))
+    tmp_path.replace(table_dir / STATE_FILE)
+
+
+def kv_metadata_sql(metadata: dict) -> str:
+    return "{" + ", ".join([f"'{key}': '{value}'" for key, value in metadata.items()]) + "}"
+
+
+def current_state_sql(table_dir: Path) -> str:
+    # the table as of the last export: the base, with the last change per row of the deltas applied
+    state = load_state(table_dir)
+    if not state:
+        raise ValueError(f"no cdc export found in {table_dir}")
+    files = [str(table_dir / BASE_FILE)] + [str(table_dir / delta['file']) for delta in state['deltas']]
+    return f"""
+        select * exclude (_change_type)
+        from read_parquet({files}, union_by_name = true)
+        qualify row_number() over (partition by _rowid order by _snapshot_id desc) = 1
+          and _change_type is distinct from 'delete'
+        """
+
+
+def export_full(con: DuckLakeConnection, table: str, table_dir: Path, table_id: int, snapshot_id: int) -> dict:
+    for old_file in table_dir.glob('*.parquet'):
+        old_file.unlink()
+    con.execute(
+        f"""
+        COPY (select rowid as _rowid, {snapshot_id}::BIGINT as _snapshot_id, * from {table})
+        TO '{table_dir / BASE_FILE}'
+        (FORMAT parquet, KV_METADATA {kv_metadata_sql({'table': table, 'snapshot_id': snapshot_id})})
+        """
+    )
+    print(f"cdc {table}: full export at snapshot {snapshot_id}", flush=True)
+    return {'table_id': table_id, 'base_snapshot': snapshot_id, 'last_snapshot': snapshot_id, 'deltas': []}
+
+
+def export_delta(con: DuckLakeConnection, table: str, table_dir: Path, state: dict, snapshot_id: int):
+    start = state['last_snapshot'] + 1
+    delta_file = f"delta_{start}_{snapshot_id}.parquet"
+    res = con.execute(
+        f"""
+        COPY (
+          select
+            if(change_type = 'delete', 'delete', 'upsert') as _change_type,
+            rowid as _rowid,
+            snapshot_id as _snapshot_id,
+            * exclude (change_type, rowid, snapshot_id)
+          from ({con.net_table_changes_sql(table, start, snapshot_id)})
+          order by _rowid
+        )
+        TO '{table_dir / delta_file}'
+        (FORMAT parquet, KV_METADATA {kv_metadata_sql({'table': table, 'snapshot_start': start, 'snapshot_end': snapshot_id})})
+        """
+    )
+    nr_rows = res.fetchone()[0]
+    state['deltas'].append({'file': delta_file, 'snapshot_start': start, 'snapshot_end': snapshot_id, 'rows': nr_rows})
+    state['last_snapshot'] = snapshot_id
+    print(f"cdc {table}: {nr_rows} changed rows in snapshots {start}..{snapshot_id}", flush=True)
+
+
+def compact(con: DuckLakeConnection, table: str, table_dir: Path, state: dict):
+    # fold the deltas into a new base, written next to the old one and then swapped in
+    if not state['deltas']:
+        return
+    tmp_path = table_dir / f"{BASE_FILE}.tmp"
+    con.execute(
+        f"""
+        COPY ({current_state_sql(table_dir)})
+        TO '{tmp_path}'
+        (FORMAT parquet, KV_METADATA {kv_metadata_sql({'table': table, 'snapshot_id': state['last_snapshot']})})
+        """
+    )
+    tmp_path.replace(table_dir / BASE_FILE)
+    for delta in state['deltas']:
+        (table_dir / delta['file']).unlink(missing_ok=True)
+    print(f"cdc {table}: folded {len(state['deltas'])} deltas into the base (snapshot {state['last_snapshot']})")
+    state['deltas'] = []
+    state['base_snapshot'] = state['last_snapshot']
+
+
+def export_table(con: DuckLakeConnection, table: str, out_dir: Path, versions: dict[str, str], force_compact: bool = False):
+    table_dir = out_dir / table
+    table_dir.mkdir(parents=True, exist_ok=True)
+    snapshot_id = con.current_snapshot()
+    table_id, table_version = [int(part) for part in versions[table].split(':')]
+    oldest_snapshot = con.sql(f"select min(snapshot_id) from {con.catalog}.ducklake_snapshot").fetchone()[0]
+    state = load_state(table_dir)
+    if not state or state['table_id'] != table_id or state['last_snapshot'] + 1 < oldest_snapshot:
+        state = export_full(con, table, table_dir, table_id, snapshot_id)
+    elif table_version > state['last_snapshot']:
+        export_delta(con, table, table_dir, state, snapshot_id)
+    else:
+        # no change since the last export: nothing to read
+        state['last_snapshot'] = snapshot_id
+    if state['deltas'] and (force_compact or len(state['deltas']) >= CDC_COMPACT_AFTER_DELTAS):
+        compact(con, table, table_dir, state)
+    save_state(table_dir, state)
+
+
+def cdc_export(dl_secret: str, tables: list[str], out_dir: Path = CDC_DIR, force_compact: bool = False):
+    with DuckLakeConnection(dl_secret, read_only=True) as con:
+        # tables only (see: DuckLakeConnection.table_versions): a view has no changes of its own
+        versions = con.table_versions()
+        views = set(tables) & set(con.views())
+        if views:
+            raise ValueError(f"view(s) can not be exported, export the tables they read: {sorted(views)}")
+        unknown = set(tables) - set(versions)
+        if unknown:
+            raise ValueError(f"unknown table(s): {sorted(unknown)}")
+        for table in tables or sorted(versions):
+            export_table(con, table, out_dir, versions, force_compact)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    def pop_option(name, default=None):
+        if name in args:
+            idx = args.index(name)
+            value = args[idx + 1]
+            del args[idx : idx + 2]
+            return value
+        return default
+
+    dl_secret = 'ducklake_secret'
+    if '--local' in args:
+        args.remove('--local')
+        dl_secret = 'ducklake_secret_local'
+    out_dir = Path(pop_option('--dir', CDC_DIR))
+    force_compact = '--compact' in args
+    if force_compact:
+        args.remove('--compact')
+    if any(arg.startswith('--') for arg in args):
+        raise ValueError(f"Invalid arguments for cdc_export: {args}")
+    cdc_export(dl_secret, args, out_dir, force_compact)
@@ -0,0 +1,115 @@
+"""
+Downsampling of long time series, so the payload of a chart does not grow with the length of the history.
+
+Used by generate_sources for derived tables with a 'downsample' config (see: evidence/sources/sources.json):
+    {
+      "name": "benchmark_geomean_trend",
+      "downsample": {
+        "table": "benchmark_geomean",         # a table of the source (e.g. a derived table above it), or of the lake
+        "time_column": "run_timestamp",
+        "value_column": "geomean_seconds",
+        "group_by": ["benchmark_series"],     # one series per group (e.g. one line per chart)
+        "method": "lttb",                     # 'lttb' or 'buckets'
+        "max_points": 300,                    # lttb: max points per series, for the downsampled part
+        "bucket": "week",                     # buckets: date_trunc part
+        "full_resolution_days": 60            # points more recent than this are kept as is
+      }
+    }
+
+- lttb (Largest-Triangle-Three-Buckets): keeps the points that preserve the visual shape of the series. The
+  kept points are rows of the input table, with all of its columns, so the output is a drop-in replacement.
+- buckets: one row per series per bucket with the median, min and max of the value and the number of points
+  (columns: group_by, time_column, value_column, <value_column>_min, <value_column>_max, nr_points). Recent
+  rows are passed through with min = max = value.
+"""
+
+DOWNSAMPLE_METHODS = ['lttb', 'buckets']
+
+
+def lttb(points: list[tuple], max_points: int) -> list:
+    # points: (key, x, y) sorted by x; returns the keys of the points to keep
+    n = len(points)
+    if max_points >= n or max_points < 3:
+        return [p[0] for p in points]
+    every = (n - 2) / (max_points - 2)
+    kept = [points[0][0]]
+    a = 0
+    for i in range(max_points - 2):
+        # the average of the next bucket is the third point of the triangle
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = sum(p[1] for p in points[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_y = sum(p[2] for p in points[avg_start:avg_end]) / (avg_end - avg_start)
+        ax, ay = points[a][1], points[a][2]
+        max_area = -1.0
+        next_a = int(i * every) + 1
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (points[j][2] - ay) - (ax - points[j][1]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                next_a = j
+        kept.append(points[next_a][0])
+        a = next_a
+    kept.append(points[-1][0])
+    return kept
+
+
+def downsample_table(con, source_table: str, target_table: str, config: dict):
+    # con: DuckLakeConnection; source_table and target_table may be qualified (e.g. '<source>.main.<table>')
+    method = config.get('method', 'lttb')
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"unknown downsample method '{method}', expected one of: {DOWNSAMPLE_METHODS}")
+    time_col = f'"{config["time_column"]}"'
+    value_col = f'"{config["value_column"]}"'
+    group_cols = [f'"{col}"' for col in config.get('group_by', [])]
+    cutoff = f"current_date - INTERVAL {int(config.get('full_resolution_days', 0))} DAY"
+    is_recent = f"{time_col}::TIMESTAMP >= {cutoff}"
+
+    if method == 'buckets':
+        group_list = "".join([f"{col}, " for col in group_cols])
+        value_min = f'"{config["value_column"]}_min"'
+        value_max = f'"{config["value_column"]}_max"'
+        con.execute(
+            f"""
+            CREATE OR REPLACE TABLE {target_table} AS
+            SELECT {group_list}date_trunc('{config.get('bucket', 'week')}', {time_col}) AS {time_col},
+                   median({value_col}) AS {value_col}, min({value_col}) AS {value_min}, max({value_col}) AS {value_max},
+                   count(*) AS nr_points
+            FROM {source_table}
+            WHERE NOT ({is_recent}) AND {value_col} IS NOT NULL
+            GROUP BY ALL
+            UNION ALL BY NAME
+            SELECT {group_list}{time_col}, {value_col}, {value_col} AS {value_min}, {value_col} AS {value_max},
+                   1::BIGINT AS nr_points
+            FROM {source_table}
+            WHERE {is_recent} AND {value_col} IS NOT NULL
+            ORDER BY ALL
+            """
+        )
+    else:
+        con.execute(f"CREATE OR REPLACE TEMP TABLE __downsample_input AS SELECT *, row_number() OVER () AS __row FROM {source_table}")
+        rows = con.execute(
+            f"""
+            SELECT __row, epoch({time_col}), {value_col}{"".join([f", {col}" for col in group_cols])}
+            FROM __downsample_input
+            WHERE NOT ({is_recent}) AND {value_col} IS NOT NULL
+            ORDER BY {"".join([f"{col}, " for col in group_cols])}{time_col}
+            """
+        ).fetchall()
+        series: dict[tuple, list[tuple]] = {}
+        for row in rows:
+            series.setdefault(row[3:], []).append(row[:3])
+        max_points = int(config.get('max_points', 300))
+        kept_rows = [key for points in series.values() for key in lttb(points, max_points)]
+        con.execute(
+            f"""
+            CREATE OR REPLACE TABLE {target_table} AS
+            SELECT * EXCLUDE (__row)
+            FROM __downsample_input
+            WHERE {is_recent} OR {value_col} IS NULL OR __row IN (SELECT unnest($kept_rows))
+            ORDER BY __row
+            """,
+            {"kept_rows": kept_rows},
+        )
+        con.execute("DROP TABLE __downsample_input")
+        print(f"downsampled {len(rows)} points in {len(series)} series to {len(kept_rows)} points (lttb)")
@@ -1,15 +1,83 @@
 from collections import OrderedDict
 import duckdb
 import json
+import random
+import re
 import tempfile
+import time
+
+from utils.lake_cache import LakeCache
+from utils.query_profiler import QueryProfiler, profile_dir_from_env
+from utils.write_buffer import get_write_buffer
+
+
+def schema_columns_sql(schema: dict[str, str]) -> str:
+    # column definitions for CREATE TABLE, e.g. '"id" BIGINT, "name" VARCHAR'
+    return ", ".join([f'"{col}" {col_type}' for col, col_type in schema.items()])
+
+
+def read_json_sql(file_path: str, schema: dict[str, str] | None = None) -> str:
+    """
+    Query that reads a json file; with a schema, the columns and types are pinned (no type sniffing)
+    and json keys that are not in the schema are dropped, also inside nested structs.
+    Timestamps are read as TIMESTAMPTZ (to respect utc offsets) and cast to the schema type.
+    """
+    if not schema:
+        return f"select * from read_json('{file_path}')"
+    read_types = {col: re.sub(r"\bTIMESTAMP\b", "TIMESTAMPTZ", col_type) for col, col_type in schema.items()}
+    columns_arg = "{" + ", ".join([f"'{col}': '{col_type}'" for col, col_type in read_types.items()]) + "}"
+    select_list = ", ".join([f'"{col}"::{col_type} as "{col}"' for col, col_type in schema.items()])
+    return f"select {select_list} from read_json('{file_path}', columns={columns_arg})"
+
+
+def referenced_names(sql_str: str, names) -> set[str]:
+    # the names (of tables or views) that a query mentions as a word, outside of comments; a name too many (e.g. a
+    # column with the name of a table) is fine for what this is used for (cache keys)
+    sql_str = re.sub(r"--[^\n]*|/\*.*?\*/", " ", sql_str, flags=re.DOTALL)
+    return {name for name in names if re.search(rf"\b{re.escape(name)}\b", sql_str)}
+
+
+def is_commit_conflict(e: BaseException) -> bool:
+    # a commit that conflicts with a concurrent commit (e.g. two transactions updating the same table)
+    while e is not None:
+        if isinstance(e, duckdb.TransactionException) or 'conflict' in str(e).lower():
+            return True
+        e = e.__cause__
+    return False
+
+
+def retry_on_conflict(func, max_attempts: int = 5):
+    """
+    Optimistic concurrency for concurrent writers: run func, and run it again on a ducklake commit conflict.
+    func should open its own connection and re-read the state it depends on (a conflicting transaction is rolled back).
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_attempts or not is_commit_conflict(e):
+                raise
+            delay = random.uniform(0, 2**attempt)
+            print(f"ducklake commit conflict (attempt {attempt}/{max_attempts}), retrying in {delay:.1f}s: {e}", flush=True)
+            time.sleep(delay)
 
 
 class DuckLakeConnection:
-    def __init__(self, connection_string='', read_only: bool = False):
+    def __init__(self, connection_string='', read_only: bool = False, lake_cache: LakeCache | None = None):
         self.ducklake_db_alias = 'my_ducklake'
         self.catalog = f"__ducklake_metadata_{self.ducklake_db_alias}"
         self.connection_string = connection_string
         self.read_only = read_only
+        # optional local mirror of the data files; only for read-only lakes (see: utils/lake_cache.py)
+        assert lake_cache is None or read_only, "a lake cache can only be used for a read-only lake"
+        self.lake_cache = lake_cache
+        # profile every statement run via execute(), if env variable DUCKLAKE_PROFILE_DIR is set (see: utils/query_profiler.py)
+        profile_dir = profile_dir_from_env()
+        self.profiler = QueryProfiler(profile_dir) if profile_dir else None
+        # buffer appends locally, if env variable DUCKLAKE_WRITE_BUFFER_DIR is set (see: utils/write_buffer.py)
+        self.write_buffer = None if read_only else get_write_buffer(connection_string)
+        # catalog metadata (tables, row counts, column stats) of one snapshot; see: metadata()
+        self._metadata = None
 
     def __enter__(self):
         self.con = duckdb.connect()
@@ -19,7 +87,26 @@ class DuckLakeConnection:
         self.con.execute(
             f"ATTACH 'ducklake:{self.connection_string}' AS {self.ducklake_db_alias} ({attach_options})"
         )
+        if self.lake_cache:
+            mirror = self.lake_cache.sync(self)
+            self.lake_cache.print_stats()
+            if mirror:
+                # re-attach reading from the local mirror, pinned to the snapshot that was mirrored
+                snapshot_id, local_data_path = mirror
+                self.con.execute(f"DETACH {self.ducklake_db_alias}")
+                self.con.execute(
+                    f"""
+                    ATTACH 'ducklake:{self.connection_string}' AS {self.ducklake_db_alias}
+                    (READ_ONLY, DATA_PATH '{local_data_path.absolute()}/', SNAPSHOT_VERSION {snapshot_id})
+                    """
+                )
         self.con.execute(f"USE {self.ducklake_db_alias}")
+        # github timestamps are UTC; casts from TIMESTAMPTZ (see read_json_sql) should not shift them to local time
+        self.con.execute("SET TimeZone = 'UTC'")
+        if self.profiler:
+            self.profiler.start(self.con)
+        if self.write_buffer:
+            self.write_buffer.attach(self)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -35,6 +122,8 @@ class DuckLakeConnection:
 
     def execute(self, sql_str, parameters=None):
         try:
+            if self.profiler:
+                return self.profiler.profile(self.con, sql_str, parameters)
             return self.con.execute(sql_str, parameters)
         except Exception as e:
             raise RuntimeError(
@@ -42,6 +131,16 @@ class DuckLakeConnection:
                 ) from e
 
     def execute_transaction(self, sql_statments: list[str], parameters=None):
+        if self.profiler:
+            # profile per statement
+            self.con.execute("BEGIN TRANSACTION")
+            try:
+                for stmnt in sql_statments:
+                    self.execute(stmnt, parameters)
+            except Exception:
+                self.con.execute("ROLLBACK")
+                raise
+            return self.con.execute("COMMIT")
         sql_statments = [stmnt + ";" if stmnt[-1] != ';' else stmnt for stmnt in sql_statments]
         sql_str = "BEGIN TRANSACTION;" + "".join(sql_statments) + "COMMIT;"
         return self.con.execute(sql_str, parameters)
@@ -52,33 +151,183 @@ class DuckLakeConnection:
     def fetchall(self):
         return self.con.fetchall()
 
+    def metadata(self) -> dict:
+        """
+        Catalog metadata of the current snapshot, loaded in one catalog query and cached per snapshot id (a
+        commit, of this or any other connection, makes a new snapshot; other statements do not reload it):
+            {'snapshot_id': int, 'tables': {table_name: {'record_count', 'nr_delete_files', 'has_inlined_data',
+                                                         'columns': {column_name: {stat: value}}}}}
+        """
+        snapshot_id = self.current_snapshot()
+        if self._metadata is None or self._metadata['snapshot_id'] != snapshot_id:
+            rows = self.con.sql(
+                f"""
+                with snapshot as (
+                  select {snapshot_id}::bigint as snapshot_id
+                ),
+                tables as (
+                  select t.table_id, t.table_name
+                  from {self.catalog}.ducklake_table t
+                    join {self.catalog}.ducklake_schema s using (schema_id), snapshot
+                  where t.begin_snapshot <= snapshot.snapshot_id
+                    and (t.end_snapshot is null or t.end_snapshot > snapshot.snapshot_id)
+                    and s.begin_snapshot <= snapshot.snapshot_id
+                    and (s.end_snapshot is null or s.end_snapshot > snapshot.snapshot_id)
+                ),
+                columns as (
+                  select c.table_id, c.column_name, cs.min_value, cs.max_value, cs.contains_nan, cs.extra_stats
+                  from {self.catalog}.ducklake_column c
+                    left join {self.catalog}.ducklake_table_column_stats cs using (table_id, column_id), snapshot
+                  where c.parent_column is null
+                    and c.begin_snapshot <= snapshot.snapshot_id
+                    and (c.end_snapshot is null or c.end_snapshot > snapshot.snapshot_id)
+                )
+                select
+                  tables.table_name,
+                  ts.record_count,
+                  (select count(*) from {self.catalog}.ducklake_delete_file d
+                   where d.table_id = tables.table_id and d.end_snapshot is null),
+                  exists (select 1 from {self.catalog}.ducklake_inlined_data_tables i where i.table_id = tables.table_id),
+                  list(
+                    {{'column_name': columns.column_name, 'min_value': columns.min_value, 'max_value': columns.max_value,
+                      'contains_nan': columns.contains_nan, 'extra_stats': columns.extra_stats}}
+                  ) filter (where columns.column_name is not null)
+                from tables
+                  left join {self.catalog}.ducklake_table_stats ts using (table_id)
+                  left join columns using (table_id)
+                group by all
+                """
+            ).fetchall()
+            self._metadata = {
+                'snapshot_id': snapshot_id,
+                'tables': {
+                    table_name: {
+                        'record_count': record_count,
+                        'nr_delete_files': nr_delete_files,
+                        'has_inlined_data': has_inlined_data,
+                        'columns': {col.pop('column_name'): col for col in columns or []},
+                    }
+                    for table_name, record_count, nr_delete_files, has_inlined_data, columns in rows
+                },
+            }
+        return self._metadata
+
+    def table_versions(self) -> dict[str, str]:
+        """
+        Per table of the current snapshot: '<table_id>:<last snapshot that changed it>', from the snapshot changes
+        of the catalog ('inserted_into_table:12,deleted_from_table:12,...'). The version of a table only changes
+        when the table does (a compaction counts as a change); a re-created table has a new table_id.
+        Views are not included: a view changes with its SQL and the tables it reads (see: views).
+        """
+        rows = self.con.sql(
+            f"""
+            with snapshot as (
+              select snapshot_id from {self.ducklake_db_alias}.current_snapshot()
+            ),
+            tables as (
+              select t.table_id, t.table_name, t.begin_snapshot
+              from {self.catalog}.ducklake_table t
+                join {self.catalog}.ducklake_schema s using (schema_id), snapshot
+              where t.begin_snapshot <= snapshot.snapshot_id
+                and (t.end_snapshot is null or t.end_snapshot > snapshot.snapshot_id)
+                and s.begin_snapshot <= snapshot.snapshot_id
+                and (s.end_snapshot is null or s.end_snapshot > snapshot.snapshot_id)
+            ),
+            changes as (
+              select c.snapshot_id, unnest(regexp_extract_all(c.changes_made, '[a-z_]+:(\\d+)', 1))::bigint as table_id
+              from {self.catalog}.ducklake_snapshot_changes c, snapshot
+              where c.snapshot_id <= snapshot.snapshot_id
+            )
+            select tables.table_name, tables.table_id, greatest(max(tables.begin_snapshot), max(changes.snapshot_id))
+            from tables left join changes using (table_id)
+            group by all
+            """
+        ).fetchall()
+        return {table_name: f"{table_id}:{version}" for table_name, table_id, version in rows}
+
+    def views(self) -> dict[str, dict]:
+        """
+        Per view of the current snapshot: {'sql': its SQL, 'tables': the tables it reads, also via the views it
+        reads (the tables and views that its SQL mentions, see: referenced_names)}
+        """
+        views_sql = dict(
+            self.con.sql(
+                f"""
+                select v.view_name, v.sql
+                from {self.catalog}.ducklake_view v, (select snapshot_id from {self.ducklake_db_alias}.current_snapshot()) snapshot
+                where v.begin_snapshot <= snapshot.snapshot_id
+                  and (v.end_snapshot is null or v.end_snapshot > snapshot.snapshot_id)
+                """
+            ).fetchall()
+        )
+        table_names = set(self.metadata()['tables'])
+
+        def base_tables(view: str, seen: set[str]) -> set[str]:
+            tables = set()
+            for name in referenced_names(views_sql[view], table_names | set(views_sql)):
+                if name in views_sql:
+                    if name not in seen:
+                        tables |= base_tables(name, seen | {name})
+                else:
+                    tables.add(name)
+            return tables
+
+        return {view: {'sql': sql, 'tables': sorted(base_tables(view, {view}))} for view, sql in views_sql.items()}
+
+    def table_metadata(self, table_name: str) -> dict | None:
+        return self.metadata()['tables'].get(table_name)
+
     def table_exists(self, table_name: str) -> bool:
-        return self.con.sql(
-            f"select 1 from duckdb_tables() where table_name='{table_name}' and database_name='{self.ducklake_db_alias}'"
-        ).fetchone() == (1,)
+        return self.table_metadata(table_name) is not None
 
     def table_empty(self, table_name: str) -> bool:
+        # from the catalog stats: the record count of the data files; rows can only be missing from it
+        # (inlined rows), or deleted (delete files), so only 'not empty' is certain; otherwise: read a row
+        table = self.table_metadata(table_name)
+        if table and (table['record_count'] or 0) > 0 and table['nr_delete_files'] == 0:
+            return False
         return self.con.sql(f"select 1 from \"{table_name}\" limit 1").fetchone() != (1,)
 
     def max_id(self, table_name: str):
+        # from the column stats, if they cover all rows: no inlined rows (not in the stats) and no deletes
+        # (a deleted max stays in the stats); otherwise: scan
+        table = self.table_metadata(table_name)
+        if table and not table['has_inlined_data'] and table['nr_delete_files'] == 0:
+            max_value = table['columns'].get('id', {}).get('max_value')
+            if max_value is not None:
+                return int(max_value)
         return self.con.sql(f"select max(id) from {table_name}").fetchone()[0]
 
     def from_table_column_stats(self, table_name: str, column_name: str, stat: str, cast_to: str = None):
         assert stat in ['min_value', 'max_value', 'contains_nan', 'extra_stats']
-        cast_str = "::" + cast_to if cast_to else ''
-        return self.con.sql(
-            f"""
-            select
-              ducklake_table_column_stats.{stat}{cast_str}
-            from {self.catalog}.ducklake_table_column_stats
-              join {self.catalog}.ducklake_table using (table_id)
-              join {self.catalog}.ducklake_column using (table_id, column_id)
-            where ducklake_table.table_name = '{table_name}'
-              and ducklake_table.end_snapshot is null
-              and ducklake_column.column_name = '{column_name}'
-              and ducklake_column.parent_column is null;
-            """
-        ).fetchone()[0]
+        table = self.table_metadata(table_name)
+        value = table['columns'].get(column_name, {}).get(stat) if table else None
+        if value is None or not cast_to:
+            return value
+        return self.con.execute(f"select ?::{cast_to}", [value]).fetchone()[0]
+
+    def table_columns(self, table_name: str) -> list[str]:
+        return [
+            tup[0]
+            for tup in self.con.sql(
+                f"""
+                select column_name from duckdb_columns()
+                where table_name='{table_name}' and database_name='{self.ducklake_db_alias}'
+                order by column_index
+                """
+            ).fetchall()
+        ]
+
+    def create_or_evolve_table(self, table_name: str, schema: dict[str, str]):
+        # additive schema evolution only: columns are never dropped or changed, so existing data stays intact
+        if not self.table_exists(table_name):
+            self.con.execute(f"create table {table_name} ({schema_columns_sql(schema)})")
+            return
+        existing_columns = self.table_columns(table_name)
+        for col, col_type in schema.items():
+            if col not in existing_columns:
+                print(f"schema evolution: adding column {table_name}.{col} {col_type}")
+                self.con.execute(f'alter table {table_name} add column "{col}" {col_type}')
 
     def create_table(
         self,
@@ -87,43 +336,82 @@ class DuckLakeConnection:
         or_replace: bool = False,
         if_not_exists: bool = False,
         with_no_data: bool = False,
+        schema: dict[str, str] | None = None,
     ):
         json_str = f"[{',\n'.join([json.dumps(rec) for rec in records])}]"
-        # work-around: use temp-file to utilize the type-sniffer
+        # work-around: use temp-file to utilize the type-sniffer (or to read with a pinned schema)
         with tempfile.NamedTemporaryFile(mode='w+', suffix=".json") as tmp:
             tmp.write(json_str)
             tmp.flush()
-            self.con.execute(
-                f"""
+            create_str = f"""
                 create
                 {" or replace " if or_replace else ''}
                 table
                 {" if not exists " if if_not_exists else ''}
                 {table_name}
-                as from read_json('{tmp.name}')
-                {" with no data " if with_no_data else ''}
                 """
-            )
+            if schema:
+                self.con.execute(f"{create_str} ({schema_columns_sql(schema)})")
+                if not with_no_data:
+                    self.con.execute(f"insert into {table_name} by name {read_json_sql(tmp.name, schema)}")
+            else:
+                self.con.execute(
+                    f"""
+                    {create_str}
+                    as from read_json('{tmp.name}')
+                    {" with no data " if with_no_data else ''}
+                    """
+                )
 
-    def append_table(self, table_name: str, records: list[OrderedDict]):
+    def append_table(self, table_name: str, records: list[OrderedDict], schema: dict[str, str] | None = None):
         json_str = f"[{',\n'.join([json.dumps(rec) for rec in records])}]"
-        # work-around: use temp-file to utilize the type-sniffer
+        # work-around: use temp-file to utilize the type-sniffer (or to read with a pinned schema)
         with tempfile.NamedTemporaryFile(mode='w+', suffix=".json") as tmp:
             tmp.write(json_str)
             tmp.flush()
-            self.con.execute(f"insert into {table_name} from read_json('{tmp.name}')")
+            self.insert_by_name(table_name, read_json_sql(tmp.name, schema))
+
+    def insert_by_name(self, table_name: str, select_sql: str):
+        # append the result of a query; goes to the local write buffer (flushed later, in one commit) if enabled
+        self.insert_tables_by_name([(table_name, select_sql)])
+
+    def insert_tables_by_name(self, inserts: list[tuple[str, str]]):
+        # append to several tables at once: (table_name, select_sql), in one transaction (or buffer flush)
+        if self.write_buffer:
+            self.write_buffer.append(self, inserts)
+        else:
+            self.execute_transaction([f"insert into {table_name} by name {select_sql}" for table_name, select_sql in inserts])
+
+    def flush_write_buffer(self):
+        # write everything that is buffered to the lake, in one transaction; no-op without a write buffer
+        if self.write_buffer:
+            self.write_buffer.flush(self)
 
     def upsert_table(
-        self, table_name: str, records: list[dict], match_columns: list[str] = ['id'], print_changes: bool = False
+        self,
+        table_name: str,
+        records: list[dict],
+        match_columns: list[str] = ['id'],
+        print_changes: bool = False,
+        schema: dict[str, str] | None = None,
     ):
         json_str = f"[{',\n'.join([json.dumps(rec) for rec in records])}]"
-        # work-around: use temp-file to utilize the type-sniffer
+        # work-around: use temp-file to utilize the type-sniffer (or to read with a pinned schema)
         with tempfile.NamedTemporaryFile(mode='w+', suffix=".json") as tmp:
             tmp.write(json_str)
             tmp.flush()
             # work-around: use EXCEPT to find new or updated records, to prevent unnecessary snapshots
             # see: https://github.com/duckdblabs/duckdb-internal/issues/6557
-            subquery = f"select * from read_json('{tmp.name}') EXCEPT select * from {table_name}"
+            if schema:
+                # only compare the schema columns; the stored table may have more (or wider) columns
+                table_select = ", ".join([f'"{col}"::{col_type}' for col, col_type in schema.items()])
+                subquery = f"{read_json_sql(tmp.name, schema)} EXCEPT select {table_select} from {table_name}"
+                update_str = "update set " + ", ".join([f'"{col}" = upserts."{col}"' for col in schema])
+                insert_str = "insert by name"
+            else:
+                subquery = f"select * from read_json('{tmp.name}') EXCEPT select * from {table_name}"
+                update_str = "update"
+                insert_str = "insert"
             nr_new_or_updated: int = self.sql(f"select count(*) from ({subquery})").fetchone()[0]
             if nr_new_or_updated > 0:
                 if print_changes:
@@ -136,8 +424,8 @@ class DuckLakeConnection:
                     merge into {table_name}
                     using ({subquery}) as upserts
                     on ({match_str})
-                    when matched then update
-                    when not matched then insert;
+                    when matched then {update_str}
+                    when not matched then {insert_str};
                     """
                 )
             else:
@@ -147,32 +435,41 @@ class DuckLakeConnection:
     def current_snapshot(self) -> int:
         return self.con.sql(f"from {self.ducklake_db_alias}.current_snapshot()").fetchone()[0]
 
+    def net_table_changes_sql(self, tbl: str, snapshot_start: int, snapshot_end: int) -> str:
+        """
+        The net change per row in the snapshots snapshot_start..snapshot_end, in one scan of the changes: the last
+        change of each row (row ids are stable across updates; an update's postimage wins over its preimage).
+        change_type is 'insert', 'update_postimage' (the row as it is now) or 'delete'.
+        """
+        return f"""
+            select *
+            from {self.ducklake_db_alias}.table_changes('{tbl}', {snapshot_start}, {snapshot_end})
+            qualify row_number() over (partition by rowid order by snapshot_id desc, change_type = 'update_preimage') = 1
+            """
+
     def table_changes(self, tbl: str, snapshot_start: int, snapshot_end: int) -> duckdb.DuckDBPyRelation:
-        # returns new or updated records
+        # returns new or updated records (as they are at snapshot_end)
         return self.con.sql(
             f"""
             select * exclude (snapshot_id, rowid, change_type)
-              from {self.ducklake_db_alias}.table_changes('{tbl}', {snapshot_start}, {snapshot_end})
-              where change_type = 'insert'
-            union
-            select * exclude (snapshot_id, rowid, change_type)
-              from {self.ducklake_db_alias}.table_changes('{tbl}', {snapshot_start}, {snapshot_end})
-              where change_type = 'update_postimage'
-            except
-            select * exclude (snapshot_id, rowid, change_type)
-              from {self.ducklake_db_alias}.table_changes('{tbl}', {snapshot_start}, {snapshot_end})
-              where change_type = 'update_preimage'
-            except
-            select * exclude (snapshot_id, rowid, change_type)
-              from {self.ducklake_db_alias}.table_changes('{tbl}', {snapshot_start}, {snapshot_end})
-              where change_type = 'delete'
+            from ({self.net_table_changes_sql(tbl, snapshot_start, snapshot_end)})
+            where change_type != 'delete'
             order by id;
             """
         )
 
     # https://ducklake.select/docs/stable/duckdb/maintenance/checkpoint
-    def checkpoint(self):
+    def checkpoint(self, verify: bool = False):
         print('\nCreating a checkpoint ...', flush=True)
+        if verify:
+            # pre-check: the cleanup steps delete files, do not run them on a lake that does not match its storage
+            # (e.g. a wrong data path makes every file look orphaned); imported here: verify_catalog uses boto3
+            from utils.verify_catalog import print_report, verify_lake
+
+            report = verify_lake(self)
+            if report['missing'] or report['size_mismatch']:
+                print_report(report)
+                raise ValueError("checkpoint: files of the catalog are missing in storage (or differ in size); not checkpointing")
         self.con.execute("SET memory_limit = '8GB'")
         self.con.execute("CALL set_option('expire_older_than', '1 month')")
         print("ducklake_flush_inlined_data", flush=True)
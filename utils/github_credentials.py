@@ -0,0 +1,161 @@
+"""
+Pool of GitHub credentials, so the feeds are not capped by the hourly rate limit of a single token.
+
+Credentials are read from env variables:
+- GITHUB_TOKEN: a single token (e.g. the token of the GitHub Actions run)
+- GITHUB_TOKENS: comma separated list of additional (personal access) tokens
+- GITHUB_APP_ID, GITHUB_APP_PRIVATE_KEY and GITHUB_APP_INSTALLATION_IDS (comma separated): GitHub App
+  installation tokens; these are created on first use and refreshed before they expire (after 1 hour).
+  Note: requires PyJWT with crypto support: 'pip install "PyJWT[crypto]"'
+
+Each request is routed to the credential with the most remaining quota for the resource ('core' for the
+REST api, 'graphql' for the GraphQL api), tracked from the 'X-RateLimit-*' response headers.
+Without any credential, requests are unauthenticated (60 requests per hour).
+"""
+
+from datetime import datetime
+import os
+import threading
+import time
+
+import requests
+
+GITHUB_API_URL = "https://api.github.com"
+APP_TOKEN_REFRESH_MARGIN = 5 * 60  # seconds before expiry
+
+
+class GitHubCredential:
+    def __init__(self, name: str, token: str | None = None, app_id: str | None = None,
+                 app_private_key: str | None = None, installation_id: str | None = None):
+        self.name = name
+        self.token = token
+        self.token_expires_at = None
+        self.app_id = app_id
+        self.app_private_key = app_private_key
+        self.installation_id = installation_id
+        # per resource: {'remaining': int, 'reset': epoch seconds}; unknown until the first response
+        self.quota: dict[str, dict] = {}
+
+    def is_app(self) -> bool:
+        return self.installation_id is not None
+
+    def refresh_app_token(self):
+        try:
+            import jwt
+        except ImportError:
+            raise ValueError("GitHub App credentials require PyJWT: pip install 'PyJWT[crypto]'")
+        now = int(time.time())
+        app_jwt = jwt.encode({"iat": now - 60, "exp": now + 9 * 60, "iss": self.app_id}, self.app_private_key, algorithm="RS256")
+        resp = requests.post(
+            f"{GITHUB_API_URL}/app/installations/{self.installation_id}/access_tokens",
+            headers={"Accept": "application/vnd.github+json", "Authorization": f"Bearer {app_jwt}"},
+        )
+        if resp.status_code != 201:
+            raise ValueError(f"creating token for app installation {self.installation_id} failed: {resp.status_code} {resp.text}")
+        body = resp.json()
+        self.token = body['token']
+        self.token_expires_at = datetime.fromisoformat(body['expires_at'].replace('Z', '+00:00')).timestamp()
+
+    def authorization(self) -> str | None:
+        if self.is_app() and (self.token is None or self.token_expires_at - time.time() < APP_TOKEN_REFRESH_MARGIN):
+            self.refresh_app_token()
+        return f"Bearer {self.token}" if self.token else None
+
+    def remaining(self, resource: str) -> int | None:
+        quota = self.quota.get(resource)
+        if quota is None:
+            return None
+        if quota['reset'] <= time.time():
+            return None  # the quota has been reset since; unknown again
+        return quota['remaining']
+
+    def update_quota(self, resp: requests.Response):
+        headers = resp.headers
+        if 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Resource' in headers:
+            self.quota[headers['X-RateLimit-Resource']] = {
+                'remaining': int(headers['X-RateLimit-Remaining']),
+                'reset': int(headers.get('X-RateLimit-Reset', 0)),
+            }
+
+
+class GitHubCredentialPool:
+    def __init__(self, credentials: list[GitHubCredential]):
+        self.credentials = credentials or [GitHubCredential('anonymous')]
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "GitHubCredentialPool":
+        credentials = []
+        tokens = [os.getenv("GITHUB_TOKEN")] + os.getenv("GITHUB_TOKENS", "").split(",")
+        for idx, token in enumerate(dict.fromkeys(t.strip() for t in tokens if t and t.strip())):
+            credentials.append(GitHubCredential(f"token_{idx}", token=token))
+        app_id = os.getenv("GITHUB_APP_ID")
+        if app_id:
+            private_key = os.getenv("GITHUB_APP_PRIVATE_KEY", "").replace("\\n", "\n")
+            for installation_id in os.getenv("GITHUB_APP_INSTALLATION_IDS", "").split(","):
+                if installation_id.strip():
+                    credentials.append(
+                        GitHubCredential(
+                            f"app_installation_{installation_id.strip()}",
+                            app_id=app_id,
+                            app_private_key=private_key,
+                            installation_id=installation_id.strip(),
+                        )
+                    )
+        return cls(credentials)
+
+    def select(self, resource: str, exclude: set[str] = frozenset()) -> GitHubCredential | None:
+        # the credential with the most headroom; credentials with unknown quota are tried first
+        with self.lock:
+            candidates = [c for c in self.credentials if c.name not in exclude]
+            if not candidates:
+                return None
+            return max(candidates, key=lambda c: float('inf') if c.remaining(resource) is None else c.remaining(resource))
+
+    def request(self, method: str, url: str, resource: str, headers: dict, **kwargs) -> requests.Response:
+        # on a rate limit error, retry with the next credential that has headroom
+        tried = set()
+        resp = None
+        while True:
+            credential = self.select(resource, tried)
+            if credential is None:
+                return resp  # all credentials exhausted: return the last (rate limited) response
+            request_headers = dict(headers)
+            authorization = credential.authorization()
+            if authorization:
+                request_headers["Authorization"] = authorization
+            resp = requests.request(method, url, headers=request_headers, **kwargs)
+            with self.lock:
+                credential.update_quota(resp)
+            rate_limited = resp.status_code in (403, 429) and resp.headers.get('X-RateLimit-Remaining') == '0'
+            if not rate_limited:
+                return resp
+            tried.add(credential.name)
+
+    def rate_limits(self, resource: str) -> dict[str, int]:
+        # remaining quota per credential; calls to the rate_limit endpoint do not count against the rate limit
+        result = {}
+        for credential in self.credentials:
+            headers = {"Accept": "application/vnd.github+json"}
+            authorization = credential.authorization()
+            if authorization:
+                headers["Authorization"] = authorization
+            resp = requests.get(f"{GITHUB_API_URL}/rate_limit", headers=headers)
+            if resp.status_code != 200:
+                raise ValueError(f"fetching rate limit for credential '{credential.name}' failed: {resp.status_code} {resp.text}")
+            quota = resp.json()['resources'][resource]
+            with self.lock:
+                credential.quota[resource] = {'remaining': quota['remaining'], 'reset': quota['reset']}
+            result[credential.name] = quota['remaining']
+        return result
+
+
+_pool: GitHubCredentialPool | None = None
+
+
+def get_credential_pool() -> GitHubCredentialPool:
+    global _pool
+    if _pool is None:
+        _pool = GitHubCredentialPool.from_env()
+        print(f"github credentials: {', '.join(c.name for c in _pool.credentials)}")
+    return _pool
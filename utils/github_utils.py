@@ -1,24 +1,42 @@
-import os
-import requests
+from utils.github_credentials import get_credential_pool
+
+GITHUB_GRAPHQL_ENDPOINT = "https://api.github.com/graphql"
 
 
 def gh_api_request(url, headers={"Accept": "application/vnd.github+json"}, params=None):
-    GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
-    if GITHUB_TOKEN:
-        headers["Authorization"] = f"token {GITHUB_TOKEN}"
-    resp = requests.get(url=url, headers=headers, params=params)
+    # authenticated with the credential with the most remaining quota, see: utils/github_credentials.py
+    resp = get_credential_pool().request("GET", url, 'core', headers, params=params)
     if resp.status_code != 200:
         raise ValueError(f"fetching from: {url}\n GitHub API error: {resp.status_code} {resp.text}")
     return resp.json()
 
 
-def get_rate_limit():
-    url = "https://api.github.com/rate_limit"
-    resp = gh_api_request(url)
-    rate_limit = resp['rate']['remaining']
-    if not isinstance(rate_limit, int):
-        raise ValueError(f"Invalid rate limit: {rate_limit}")
-    return rate_limit
+def gh_graphql_request(query: str, variables: dict | None = None) -> tuple[dict, list[dict]]:
+    """
+    Returns: the data, and the errors of the fields that could not be resolved (e.g. a node that was deleted:
+    its field is null in the data, see the 'path' of the error). A query that returns no data raises.
+    """
+    pool = get_credential_pool()
+    if all(credential.name == 'anonymous' for credential in pool.credentials):
+        raise ValueError("the GitHub GraphQL API requires authentication; env variable 'GITHUB_TOKEN' is not set")
+    headers = {"Accept": "application/vnd.github+json"}
+    resp = pool.request("POST", GITHUB_GRAPHQL_ENDPOINT, 'graphql', headers, json={"query": query, "variables": variables or {}})
+    if resp.status_code != 200:
+        raise ValueError(f"fetching from: {GITHUB_GRAPHQL_ENDPOINT}\n GitHub API error: {resp.status_code} {resp.text}")
+    body = resp.json()
+    if not body.get('data'):
+        raise ValueError(f"fetching from: {GITHUB_GRAPHQL_ENDPOINT}\n GitHub GraphQL error: {body.get('errors')}")
+    return body['data'], body.get('errors') or []
+
+
+def get_rate_limit(resource: str = 'core'):
+    # the aggregate over all credentials in the pool
+    # note: calls to the rate_limit endpoint do not count against the rate limit
+    # resource 'core' is the REST budget, 'graphql' the (separate) GraphQL budget in points
+    rate_limits = get_credential_pool().rate_limits(resource)
+    if not all(isinstance(rate_limit, int) for rate_limit in rate_limits.values()):
+        raise ValueError(f"Invalid rate limit: {rate_limits}")
+    return sum(rate_limits.values())
 
 
 def fetch_github_records(endpoint: str, start_page=1, per_page=100) -> list[dict]:
@@ -115,3 +133,180 @@ def fetch_github_record_list(
     if detail_log:
         print(f"fetched {len(fetched_records)} from a total of {total_count} records")
     return total_count, fetched_records
+
+
+# graphql equivalent of: https://api.github.com/repos/{GITHUB_REPO}/actions/runs/{RUN_ID}/jobs
+# a workflow run has one check suite, its check runs are the jobs (check run id == job id)
+Q_GRAPHQL_RUN_JOBS = """
+query($ids: [ID!]!, $after: String) {
+  rateLimit { cost remaining }
+  nodes(ids: $ids) {
+    ... on WorkflowRun {
+      databaseId
+      checkSuite {
+        checkRuns(first: 100, after: $after) {
+          pageInfo { hasNextPage endCursor }
+          nodes {
+            databaseId
+            id
+            name
+            status
+            conclusion
+            startedAt
+            completedAt
+            steps(first: 100) {
+              nodes { name status conclusion number startedAt completedAt }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def graphql_check_run_to_job(github_repo: str, run: dict, check_run: dict) -> dict:
+    """
+    Map a graphql CheckRun to the record shape of the REST jobs endpoint (same keys, same order).
+    Fields that the graphql api does not expose (created_at, labels, runner info) are None.
+    Args:
+        run: the stored ci_runs record, providing: id, node_id, run_attempt, head_sha, head_branch, name, html_url
+    """
+    def lower(value):
+        return value.lower() if value else None
+
+    job_id = check_run['databaseId']
+    return {
+        "id": job_id,
+        "run_id": run['id'],
+        "workflow_name": run['name'],
+        "head_branch": run['head_branch'],
+        "run_url": f"https://api.github.com/repos/{github_repo}/actions/runs/{run['id']}",
+        "run_attempt": run['run_attempt'],
+        "node_id": check_run['id'],
+        "head_sha": run['head_sha'],
+        "url": f"https://api.github.com/repos/{github_repo}/actions/jobs/{job_id}",
+        "html_url": f"{run['html_url']}/job/{job_id}",
+        "status": lower(check_run['status']),
+        "conclusion": lower(check_run['conclusion']),
+        "created_at": None,
+        "started_at": check_run['startedAt'],
+        "completed_at": check_run['completedAt'],
+        "name": check_run['name'],
+        "steps": [
+            {
+                "name": step['name'],
+                "status": lower(step['status']),
+                "conclusion": lower(step['conclusion']),
+                "number": step['number'],
+                "started_at": step['startedAt'],
+                "completed_at": step['completedAt'],
+            }
+            for step in check_run['steps']['nodes']
+        ],
+        "check_run_url": f"https://api.github.com/repos/{github_repo}/check-runs/{job_id}",
+        "labels": None,
+        "runner_id": None,
+        "runner_name": None,
+        "runner_group_id": None,
+        "runner_group_name": None,
+    }
+
+
+def fetch_github_jobs_graphql(
+    github_repo: str, runs: list[dict], runs_per_request: int = 10, max_requests=None, detail_log=False
+) -> tuple[list[dict], int, int]:
+    """
+    Fetch the jobs of many workflow runs per request via the GitHub GraphQL API.
+    The returned jobs have the same shape as the records of the REST jobs endpoint (see graphql_check_run_to_job)
+
+    Args:
+        runs: ci_runs records (at least: id, node_id, run_attempt, head_sha, head_branch, name, html_url)
+        runs_per_request: nr of runs per query; keep this low, github limits a query to 500,000 nodes
+            (runs_per_request * 100 check runs * 100 steps)
+        max_requests: max number of graphql queries (also the pages of runs with more than 100 jobs); a run whose
+            jobs could not all be fetched within the budget is not returned (it is fetched again next time)
+
+    Returns: tuple with 3 values:
+        List[dict]: the fetched jobs
+        int: the number of runs for which jobs were fetched
+        int: the rate-limit points spent (graphql budget)
+    """
+    runs_by_node_id = {run['node_id']: run for run in runs}
+    node_ids = list(runs_by_node_id.keys())
+    jobs = []
+    points = 0
+    nr_requests = 0
+    nr_runs_fetched = 0
+    for batch_start in range(0, len(node_ids), runs_per_request):
+        if max_requests is not None and nr_requests >= max_requests:
+            break
+        batch = node_ids[batch_start : batch_start + runs_per_request]
+        if detail_log:
+            print(f"graphql: fetching jobs for runs {batch_start + 1}-{batch_start + len(batch)}/{len(node_ids)}", flush=True)
+        data, errors = gh_graphql_request(Q_GRAPHQL_RUN_JOBS, {"ids": batch})
+        nr_requests += 1
+        points += data['rateLimit']['cost']
+        # per-node errors (e.g. a run that was deleted, NOT_FOUND): only that run is skipped
+        node_errors = {}
+        for error in errors:
+            path = error.get('path') or []
+            if len(path) < 2 or path[0] != 'nodes':
+                raise ValueError(f"fetching from: {GITHUB_GRAPHQL_ENDPOINT}\n GitHub GraphQL error: {error}")
+            node_errors[batch[path[1]]] = error.get('type') or error.get('message')
+        for node_id, node in zip(batch, data['nodes']):
+            run = runs_by_node_id[node_id]
+            if node_id in node_errors or not node or not node.get('checkSuite'):
+                reason = f": {node_errors[node_id]}" if node_id in node_errors else ''
+                print(f"::notice title=could not fetch job::graphql: no check suite for run {run['id']} in {github_repo}{reason}")
+                continue
+            check_runs = node['checkSuite']['checkRuns']
+            run_jobs = [graphql_check_run_to_job(github_repo, run, cr) for cr in check_runs['nodes']]
+            # runs with more than 100 jobs: page through the remaining check runs of this run only
+            while check_runs['pageInfo']['hasNextPage']:
+                if max_requests is not None and nr_requests >= max_requests:
+                    break
+                data, errors = gh_graphql_request(Q_GRAPHQL_RUN_JOBS, {"ids": [node_id], "after": check_runs['pageInfo']['endCursor']})
+                nr_requests += 1
+                points += data['rateLimit']['cost']
+                node = data['nodes'][0]
+                if errors or not node or not node.get('checkSuite'):
+                    print(f"::notice title=could not fetch job::graphql: could not page through the jobs of run {run['id']}: {errors}")
+                    break
+                check_runs = node['checkSuite']['checkRuns']
+                run_jobs.extend(graphql_check_run_to_job(github_repo, run, cr) for cr in check_runs['nodes'])
+            if check_runs['pageInfo']['hasNextPage']:
+                # incomplete (request budget spent, or a page failed): no jobs for this run, it is fetched again next time
+                continue
+            jobs.extend(run_jobs)
+            nr_runs_fetched += 1
+    if detail_log:
+        print(f"graphql: fetched {len(jobs)} jobs for {nr_runs_fetched} runs in {nr_requests} requests, cost: {points} points")
+    return jobs, nr_runs_fetched, points
+
+
+Q_GRAPHQL_RUN_JOB_COUNTS = """
+query($ids: [ID!]!) {
+  rateLimit { cost remaining }
+  nodes(ids: $ids) {
+    ... on WorkflowRun {
+      checkSuite {
+        checkRuns(first: 1) { totalCount }
+      }
+    }
+  }
+}
+"""
+
+
+def fetch_github_job_counts_graphql(node_ids: list[str], runs_per_request: int = 100) -> dict[str, int]:
+    # the nr of jobs (check runs) per workflow run, by node_id; runs that could not be resolved are left out
+    job_counts = {}
+    for batch_start in range(0, len(node_ids), runs_per_request):
+        batch = node_ids[batch_start : batch_start + runs_per_request]
+        data, _ = gh_graphql_request(Q_GRAPHQL_RUN_JOB_COUNTS, {"ids": batch})
+        for node_id, node in zip(batch, data['nodes']):
+            if node and node.get('checkSuite'):
+                job_counts[node_id] = node['checkSuite']['checkRuns']['totalCount']
+    return job_counts
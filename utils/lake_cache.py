@@ -0,0 +1,159 @@
+"""
+Local cache for read-only ducklakes, e.g. the benchmark results lake on S3.
+
+The data files referenced by the current snapshot are mirrored to a local directory (same layout as
+the lake's data_path), and the lake is then re-attached with DATA_PATH pointing at the mirror, pinned
+to the snapshot that was mirrored. Data files in a ducklake are immutable, so a file that is already
+in the mirror never needs to be fetched again; an unchanged lake fetches nothing, a slightly changed
+lake only fetches its new files.
+
+The cache is evicted least-recently-used, by bytes, after each sync. The index (index.json) keeps
+size and last use per file, and the snapshot id of the last sync.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+import time
+
+INDEX_FILE = 'index.json'
+# well below the 10 GB of actions cache per repository (see: .github/workflows/update_dashboard.yml)
+DEFAULT_MAX_BYTES = 3 * 1024**3
+NR_DOWNLOAD_THREADS = 16
+
+
+class LakeCache:
+    def __init__(self, cache_dir: str | Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.data_dir = self.cache_dir / 'data'
+        self.index_path = self.cache_dir / INDEX_FILE
+        self.max_bytes = max_bytes
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'files': 0, 'hits': 0, 'misses': 0, 'bytes_fetched': 0, 'evicted_files': 0, 'evicted_bytes': 0}
+
+    def load_index(self) -> dict:
+        if self.index_path.is_file():
+            return json.loads(self.index_path.read_text())
+        return {'snapshot_id': None, 'snapshot_files': [], 'files': {}}
+
+    def save_index(self, index: dict):
+        tmp_path = self.index_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(index, indent=1))
+        tmp_path.replace(self.index_path)
+
+    def referenced_files(self, con) -> tuple[str, list[tuple[str, int]]]:
+        # all data and delete files of the current snapshot, as (full path, size in bytes)
+        data_path = con.sql(f"select value from {con.catalog}.ducklake_metadata where key = 'data_path'").fetchone()[0]
+        tables = con.sql(
+            f"""
+            select schema_name, table_name from duckdb_tables()
+            where database_name = '{con.ducklake_db_alias}'
+            """
+        ).fetchall()
+        files = {}
+        for schema_name, table_name in tables:
+            res = con.sql(
+                f"""
+                select data_file, data_file_size_bytes, delete_file, delete_file_size_bytes
+                from ducklake_list_files('{con.ducklake_db_alias}', '{table_name}', schema => '{schema_name}')
+                """
+            ).fetchall()
+            for data_file, data_file_size, delete_file, delete_file_size in res:
+                files[data_file] = data_file_size
+                if delete_file:
+                    files[delete_file] = delete_file_size
+        return data_path, list(files.items())
+
+    def fetch(self, con, remote_path: str, local_path: Path):
+        # read_blob uses the secrets of the connection (e.g. 'benchmark_s3_secret'); one cursor per thread
+        cursor = con.con.cursor()
+        try:
+            content = cursor.execute("select content from read_blob(?)", [remote_path]).fetchone()[0]
+        finally:
+            cursor.close()
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = local_path.with_name(local_path.name + '.part')
+        tmp_path.write_bytes(content)
+        tmp_path.replace(local_path)
+        return len(content)
+
+    def sync(self, con) -> tuple[int, Path] | None:
+        """
+        Mirror the files of the current snapshot of the attached lake.
+        Returns (snapshot_id, local data path), or None if the lake can not be mirrored (then read remotely).
+        """
+        self.reset_stats()
+        index = self.load_index()
+        snapshot_id = con.current_snapshot()
+        now = time.time()
+        snapshot_files = index.get('snapshot_files', [])
+        if index['snapshot_id'] == snapshot_id and all((self.data_dir / f).is_file() for f in snapshot_files):
+            # unchanged lake: nothing to list or fetch
+            for rel_path in snapshot_files:
+                index['files'][rel_path]['last_used'] = now
+            self.stats['files'] = self.stats['hits'] = len(snapshot_files)
+            self.evict(index, keep=set(snapshot_files))
+            self.save_index(index)
+            return snapshot_id, self.data_dir
+
+        data_path, files = self.referenced_files(con)
+        if any(not path.startswith(data_path) for path, _ in files):
+            print(f"lake cache: files outside data_path '{data_path}', reading from remote storage")
+            return None
+
+        to_fetch = []
+        for path, size in files:
+            rel_path = path.removeprefix(data_path)
+            local_path = self.data_dir / rel_path
+            entry = index['files'].get(rel_path)
+            if entry and local_path.is_file() and local_path.stat().st_size == size:
+                self.stats['hits'] += 1
+                entry['last_used'] = now
+            else:
+                to_fetch.append((path, rel_path, local_path))
+        self.stats['files'] = len(files)
+        self.stats['misses'] = len(to_fetch)
+
+        if to_fetch:
+            print(f"lake cache: fetching {len(to_fetch)} files ...", flush=True)
+            with ThreadPoolExecutor(max_workers=NR_DOWNLOAD_THREADS) as executor:
+                sizes = list(executor.map(lambda f: self.fetch(con, f[0], f[2]), to_fetch))
+            for (_, rel_path, _), size in zip(to_fetch, sizes):
+                index['files'][rel_path] = {'size': size, 'last_used': now}
+                self.stats['bytes_fetched'] += size
+
+        index['snapshot_id'] = snapshot_id
+        index['snapshot_files'] = [path.removeprefix(data_path) for path, _ in files]
+        self.evict(index, keep=set(index['snapshot_files']))
+        self.save_index(index)
+        return snapshot_id, self.data_dir
+
+    def evict(self, index: dict, keep: set[str]):
+        # least recently used first; files of the current snapshot are never evicted
+        total = sum(entry['size'] for entry in index['files'].values())
+        for rel_path, entry in sorted(index['files'].items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if rel_path in keep:
+                continue
+            local_path = self.data_dir / rel_path
+            if local_path.is_file():
+                os.remove(local_path)
+            del index['files'][rel_path]
+            total -= entry['size']
+            self.stats['evicted_files'] += 1
+            self.stats['evicted_bytes'] += entry['size']
+        self.stats['cache_bytes'] = total
+
+    def print_stats(self):
+        stats = self.stats
+        print(
+            f"lake cache '{self.cache_dir}': {stats['files']} files, {stats['hits']} hits, {stats['misses']} misses, "
+            f"fetched {stats['bytes_fetched'] / 1024**2:.1f} MiB, "
+            f"evicted {stats['evicted_files']} files ({stats['evicted_bytes'] / 1024**2:.1f} MiB), "
+            f"cache size {stats.get('cache_bytes', 0) / 1024**2:.1f} MiB",
+            flush=True,
+        )
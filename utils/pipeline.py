@@ -0,0 +1,75 @@
+"""
+Overlap fetching (network) and storing (ducklake commits): a single writer thread stores the batches
+that the fetching thread produces, via a bounded queue.
+- backpressure: put() blocks when 'max_pending' batches are waiting, so memory stays bounded
+- batches that queued up while the writer was busy are stored together, in one commit
+- an error in the writer is raised in the fetching thread (on the next put(), or on exit)
+
+example:
+    with StoreWorker(lambda batches: store(dl_secret, [rec for batch in batches for rec in batch])) as writer:
+        for item in items:
+            writer.put(fetch(item))
+"""
+
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class StoreWorker:
+    def __init__(self, store_func, max_pending: int = 2):
+        # store_func: called (in the writer thread) with a list of 1 or more batches
+        self.store_func = store_func
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.store_seconds = 0.0
+        self.nr_commits = 0
+        self.thread = threading.Thread(target=self._run, name='store-worker', daemon=True)
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.queue.put(_DONE)
+        self.thread.join()
+        total = time.time() - self.start_time
+        print(
+            f"pipeline: {total:.1f}s total, of which {self.store_seconds:.1f}s storing in {self.nr_commits} commits "
+            f"(overlapping with fetching)",
+            flush=True,
+        )
+        if self.error and exc_type is None:
+            raise self.error
+
+    def put(self, batch):
+        if self.error:
+            raise self.error
+        self.queue.put(batch)
+
+    def _run(self):
+        done = False
+        while not done:
+            batches = [self.queue.get()]
+            # coalesce the batches that are already waiting
+            while True:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _DONE in batches:
+                done = True
+                batches = [batch for batch in batches if batch is not _DONE]
+            if not batches or self.error:
+                # after an error: keep draining the queue, so the fetching thread never blocks
+                continue
+            start = time.time()
+            try:
+                self.store_func(batches)
+                self.nr_commits += 1
+            except Exception as e:
+                self.error = e
+            self.store_seconds += time.time() - start
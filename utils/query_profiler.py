@@ -0,0 +1,150 @@
+"""
+Query-level profiling for DuckLakeConnection, e.g.:
+    python3 -m evidence.sources.generate_sources --profile
+    python3 -m feeds.run_feeds --profile
+
+When env variable DUCKLAKE_PROFILE_DIR is set (e.g. by the --profile flag of generate_sources and
+run_feeds), every statement run via DuckLakeConnection.execute / execute_transaction is profiled:
+- the JSON profile (plan + operator timings) is stored as <profile_dir>/<nr>_<label>.json
+- the bytes fetched from remote storage (http GET responses, e.g. from r2 or s3) are counted per statement
+- print_profile_summary() prints the slowest statements and operators, from the files in the dir
+Note: a query is profiled as CREATE TEMPORARY TABLE ... AS <query> (its result has to outlive the profiler), so
+its profile includes the CREATE_TABLE_AS operator and the copy of the result, on top of the query itself.
+DuckLakeConnection.sql returns a lazy relation, which is not profiled (it runs when it is fetched,
+outside of the profiler); run a statement via execute() to profile it.
+"""
+
+from datetime import datetime
+import itertools
+import json
+import os
+from pathlib import Path
+import re
+
+PROFILE_DIR_ENV_VAR = 'DUCKLAKE_PROFILE_DIR'
+PROFILES_ROOT = Path('./profiles')
+
+# unique file names across all connections in the process
+_statement_counter = itertools.count(1)
+
+
+def is_query_sql(sql_str: str) -> bool:
+    # statements whose result can be stored with CREATE TABLE AS (not e.g. describe, show or summarize)
+    return re.match(r"\s*(select|from|with|values|\()", sql_str, re.IGNORECASE) is not None
+
+
+def new_profile_dir(name: str) -> Path:
+    profile_dir = PROFILES_ROOT / f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    profile_dir.mkdir(parents=True)
+    return profile_dir
+
+
+class QueryProfiler:
+    def __init__(self, profile_dir: str | Path):
+        self.profile_dir = Path(profile_dir)
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        # the temporary table with the result of the last profiled statement
+        self.result_table = None
+
+    def start(self, con):
+        # http logging is used to count the bytes read from remote storage
+        con.execute("CALL enable_logging('HTTP')")
+
+    def profile(self, con, sql_str: str, parameters=None):
+        """
+        Run a statement with profiling; returns its result as a relation (the full DuckDB result API: fetchone,
+        fetchall, df, arrow, show, ...). The result has to be materialized before profiling is disabled (a
+        statement replaces the pending result of the connection): a query into a temporary table, the (small)
+        result of any other statement from its rows. As with con.execute, the result is valid until the next
+        profiled statement.
+        """
+        nr = next(_statement_counter)
+        label = re.sub(r"[^a-z0-9]+", "_", " ".join(sql_str.lower().split()[:6])).strip("_")[:60]
+        profile_file = self.profile_dir / f"{nr:05d}_{label}.json"
+        if self.result_table:
+            con.execute(f"DROP TABLE IF EXISTS {self.result_table}")
+        self.result_table = f"__profiled_result_{nr}"
+        con.execute("CALL truncate_duckdb_logs()")
+        con.execute("PRAGMA enable_profiling = 'json'")
+        con.execute("SET profiling_mode = 'detailed'")
+        con.execute(f"SET profiling_output = '{profile_file}'")
+        try:
+            if is_query_sql(sql_str):
+                con.execute(f"CREATE TEMPORARY TABLE {self.result_table} AS {sql_str}", parameters)
+                rows, description = None, None
+            else:
+                res = con.execute(sql_str, parameters)
+                rows, description = (res.fetchall(), res.description) if res.description else ([], None)
+        finally:
+            con.execute("PRAGMA disable_profiling")
+        if rows is not None:
+            columns = ", ".join([f'"{col[0]}" {col[1]}' for col in description or [('Count', 'BIGINT')]])
+            con.execute(f"CREATE TEMPORARY TABLE {self.result_table} ({columns})")
+            if rows:
+                con.executemany(f"INSERT INTO {self.result_table} VALUES ({', '.join(['?'] * len(rows[0]))})", rows)
+        http_requests, http_bytes = con.execute(
+            """
+            SELECT count(*), coalesce(sum(try_cast(response.headers['Content-Length'] AS BIGINT)), 0)
+            FROM duckdb_logs_parsed('HTTP')
+            WHERE request.type = 'GET'
+            """
+        ).fetchone()
+        # add the remote storage stats to the profile
+        if profile_file.is_file():
+            profile = json.loads(profile_file.read_text())
+            profile['http_get_requests'] = http_requests
+            profile['http_bytes_read'] = http_bytes
+            profile_file.write_text(json.dumps(profile, indent=1))
+        return con.table(self.result_table)
+
+
+def walk_operators(node: dict):
+    for child in node.get('children', []):
+        yield child
+        yield from walk_operators(child)
+
+
+def print_profile_summary(profile_dir: str | Path, top_n: int = 10):
+    profile_dir = Path(profile_dir)
+    statements = []
+    operators = []
+    for profile_file in sorted(profile_dir.glob('*.json')):
+        profile = json.loads(profile_file.read_text())
+        statements.append(
+            (
+                profile.get('latency', 0.0),
+                profile.get('http_bytes_read', 0),
+                profile.get('http_get_requests', 0),
+                profile.get('total_bytes_read', 0),
+                profile_file.name,
+            )
+        )
+        for op in walk_operators(profile):
+            operators.append(
+                (
+                    op.get('operator_timing', 0.0),
+                    op.get('operator_name', '').strip(),
+                    op.get('operator_cardinality', 0),
+                    profile_file.name,
+                )
+            )
+    if not statements:
+        print(f"no profiles found in {profile_dir}")
+        return
+
+    total_latency = sum(s[0] for s in statements)
+    total_http_bytes = sum(s[1] for s in statements)
+    print(f"---\nprofile summary: {len(statements)} statements, {total_latency:.2f}s, "
+          f"{total_http_bytes / 1024**2:.1f} MiB read from remote storage (profiles in {profile_dir})")
+    print(f"\ntop {top_n} slowest statements:")
+    print(f"{'seconds':>10}{'remote MiB':>12}{'GETs':>8}{'local MiB':>11}  profile")
+    for latency, http_bytes, http_requests, bytes_read, name in sorted(statements, reverse=True)[:top_n]:
+        print(f"{latency:>10.2f}{http_bytes / 1024**2:>12.1f}{http_requests:>8}{bytes_read / 1024**2:>11.1f}  {name}")
+    print(f"\ntop {top_n} slowest operators:")
+    print(f"{'seconds':>10}{'rows':>14}  {'operator':<28}profile")
+    for timing, name, cardinality, profile_name in sorted(operators, reverse=True)[:top_n]:
+        print(f"{timing:>10.2f}{cardinality:>14}  {name:<28}{profile_name}")
+
+
+def profile_dir_from_env() -> str | None:
+    return os.getenv(PROFILE_DIR_ENV_VAR) or None
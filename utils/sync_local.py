@@ -1,9 +1,13 @@
 # creates a local copy of the ducklake for testing and debug, in direcory ./local_copy
-# - copies the postgres catalog to a local postgres instance
+# - copies the postgres catalog to a local postgres instance (default), or to a DuckDB database file ('--catalog duckdb')
 # - copies parquet data from cloudflare r2 to the local dir
 
 # each run creates an independent, timestamped copy
-# secret 'ducklake_secret_local' points at the most recent one.
+# secret 'ducklake_secret_local' points at the most recent one (of either kind).
+
+# '--catalog duckdb' needs no local postgres (nor Homebrew or the pg tools): the production catalog tables are read
+# in bulk via the duckdb postgres extension, and written to ./local_copy/duckdb_<timestamp>/catalog.ducklake
+# usage: python3 -m utils.sync_local [--catalog postgres|duckdb]
 
 
 from datetime import datetime
@@ -14,11 +18,13 @@ import os
 from pathlib import Path
 import shutil
 import subprocess
+import sys
 import time
 
 load_dotenv()
 
 POSTGRES_CATALOG_DB = "ducklake_catalog"
+CATALOG_KINDS = ["postgres", "duckdb"]
 
 BREW_PG_FORMULA = "postgresql@17"
 LOCAL_PG_HOST = "localhost"
@@ -103,6 +109,43 @@ def create_local_catalog(db_name: str, local_data_path: Path):
     )
 
 
+def create_local_duckdb_catalog(catalog_path: Path, local_data_path: Path):
+    # copy the production catalog verbatim into a duckdb database file; ducklake migrates it on attach if needed
+    print(f"copying catalog '{POSTGRES_CATALOG_DB}' from production into '{catalog_path}' ...", flush=True)
+    start = time.time()
+    pg_connection = (
+        f"host={os.getenv('DUCKLAKE_CATALOG_PG_HOST')} port=5432 dbname={POSTGRES_CATALOG_DB} "
+        f"user={os.getenv('DUCKLAKE_CATALOG_PG_USER')} password={os.getenv('DUCKLAKE_CATALOG_PG_PASSWORD')}"
+    )
+    with duckdb.connect(str(catalog_path)) as con:
+        con.execute("INSTALL postgres; LOAD postgres;")
+        con.execute(f"ATTACH '{pg_connection}' AS prod_catalog (TYPE postgres, READ_ONLY)")
+        tables = [
+            tup[0]
+            for tup in con.sql(
+                """
+                select table_name from duckdb_tables()
+                where database_name = 'prod_catalog' and schema_name = 'public' and starts_with(table_name, 'ducklake_')
+                order by table_name
+                """
+            ).fetchall()
+        ]
+        if not tables:
+            raise RuntimeError(f"no ducklake catalog tables found in '{POSTGRES_CATALOG_DB}'")
+        # one transaction on the postgres side: a consistent snapshot of the catalog
+        con.execute("BEGIN TRANSACTION")
+        for table in tables:
+            con.execute(f"CREATE TABLE main.{table} AS FROM prod_catalog.public.{table}")
+        con.execute("COMMIT")
+        con.execute("DETACH prod_catalog")
+
+        # update data_path in ducklake_metadata: NOTE: absolute path with trailing slash!
+        data_path = str(local_data_path.absolute()) + '/'
+        print(f"update metadata: set data_path to: '{data_path}'")
+        con.execute("UPDATE ducklake_metadata SET value = ? WHERE key = 'data_path'", [data_path])
+    print(f"copied {len(tables)} catalog tables in {time.time() - start:.1f}s", flush=True)
+
+
 # make sure r2 credentials are available in profile [r2-extensions] in ~/.aws/credentials
 def create_local_storage(local_data_path: Path):
     print("downloading parquet files...", flush=True)
@@ -141,37 +184,75 @@ def create_local_secrets(db_name: str):
     print(f"updated 'ducklake_secret_local', it now points at local postgres db '{db_name}'")
 
 
-def main():
+def create_local_duckdb_secrets(catalog_path: Path, local_data_path: Path):
+    with duckdb.connect() as con:
+        con.execute(f"""
+            CREATE OR REPLACE PERSISTENT SECRET ducklake_secret_local (
+                TYPE ducklake,
+                METADATA_PATH '{catalog_path.absolute()}',
+                DATA_PATH '{local_data_path.absolute()}/'
+            );
+        """)
+    print(f"updated 'ducklake_secret_local', it now points at local catalog file '{catalog_path}'")
+
+
+def main(catalog_kind: str = "postgres"):
     validate_env()
     root_dir = Path('local_copy')
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    sync_dir = root_dir / f"pg_{timestamp}"
-    local_data_path = sync_dir / 'r2_data'
-    local_data_path.mkdir(parents=True)
-    db_name = f"ducklake_{timestamp}"
-
-    create_local_catalog(db_name, local_data_path)
-    create_local_storage(local_data_path)
-    create_local_secrets(db_name)
-
-    connection_str = (
-        "-- to connect to the local ducklake:\n"
-        "install ducklake; load ducklake; install postgres; load postgres;\n"
-        "attach 'ducklake:ducklake_secret_local' as my_ducklake; use my_ducklake;\n\n"
-        "-- the secret contains credential for:\n"
-        f"--   data: {local_data_path}\n"
-        f"--   catalog: {db_name}\n\n"
-        "-- to list all ducklake catalogs in the cluster:\n"
-        "--   psql -h localhost -d postgres -c \"SELECT datname FROM pg_database WHERE datname LIKE 'ducklake\\_%' ORDER BY datname;\"\n\n"
-        "-- to drop it if it is no longer needed:\n"
-        f"--   dropdb -h localhost {db_name}"
-    )
+    if catalog_kind == "duckdb":
+        sync_dir = root_dir / f"duckdb_{timestamp}"
+        local_data_path = sync_dir / 'r2_data'
+        local_data_path.mkdir(parents=True)
+        catalog_path = sync_dir / 'catalog.ducklake'
+        create_local_duckdb_catalog(catalog_path, local_data_path)
+        create_local_storage(local_data_path)
+        create_local_duckdb_secrets(catalog_path, local_data_path)
+        connection_str = (
+            "-- to connect to the local ducklake:\n"
+            "install ducklake; load ducklake;\n"
+            "attach 'ducklake:ducklake_secret_local' as my_ducklake; use my_ducklake;\n\n"
+            "-- the secret contains the paths of:\n"
+            f"--   data: {local_data_path}\n"
+            f"--   catalog: {catalog_path}\n\n"
+            "-- to drop it if it is no longer needed:\n"
+            f"--   rm -r {sync_dir}"
+        )
+        catalog_name = str(catalog_path)
+    else:
+        sync_dir = root_dir / f"pg_{timestamp}"
+        local_data_path = sync_dir / 'r2_data'
+        local_data_path.mkdir(parents=True)
+        db_name = f"ducklake_{timestamp}"
+
+        create_local_catalog(db_name, local_data_path)
+        create_local_storage(local_data_path)
+        create_local_secrets(db_name)
+
+        connection_str = (
+            "-- to connect to the local ducklake:\n"
+            "install ducklake; load ducklake; install postgres; load postgres;\n"
+            "attach 'ducklake:ducklake_secret_local' as my_ducklake; use my_ducklake;\n\n"
+            "-- the secret contains credential for:\n"
+            f"--   data: {local_data_path}\n"
+            f"--   catalog: {db_name}\n\n"
+            "-- to list all ducklake catalogs in the cluster:\n"
+            "--   psql -h localhost -d postgres -c \"SELECT datname FROM pg_database WHERE datname LIKE 'ducklake\\_%' ORDER BY datname;\"\n\n"
+            "-- to drop it if it is no longer needed:\n"
+            f"--   dropdb -h localhost {db_name}"
+        )
+        catalog_name = db_name
     connect_sql_file = sync_dir / 'connect.sql'
     connect_sql_file.write_text(connection_str)
 
-    print(f"finished creating local copy in dir: ./{sync_dir} , with catalog: {db_name}")
+    print(f"finished creating local copy in dir: ./{sync_dir} , with catalog: {catalog_name}")
     print(f"to connect, use statements in ./{connect_sql_file}")
 
-
 if __name__ == "__main__":
-    main()
+    args = sys.argv[1:]
+    catalog_kind = "postgres"
+    if args[:1] == ["--catalog"] and len(args) == 2 and args[1] in CATALOG_KINDS:
+        catalog_kind = args[1]
+    elif args:
+        raise ValueError(f"Invalid arguments for sync_local: {args}; usage: [--catalog {'|'.join(CATALOG_KINDS)}]")
+    main(catalog_kind)
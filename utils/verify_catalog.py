@@ -1,18 +1,41 @@
 """
 connect with postgres
 if the ducklake catalog database is not present, it is created (empty)
+
+verify_lake: integrity check of a ducklake against its storage, e.g. before the destructive steps of a checkpoint
+- the data and delete files that the catalog references are read in bulk (one catalog query)
+- the storage is listed concurrently, per table directory (NR_LIST_THREADS); files outside the data path are
+  checked with concurrent HEAD requests. A listing returns up to 1000 objects per request, so a lake with hundreds
+  of thousands of files is verified in a few hundred requests
+- reported per table: missing files, size mismatches (catalog vs storage), and orphaned files (in storage, not
+  referenced and not scheduled for deletion). Files written in the last ORPHAN_GRACE_MINUTES are not reported as
+  orphaned: a concurrent writer uploads its files before it commits them to the catalog
+
+storage: the data path of the lake ('r2://', 's3://' or a local directory, e.g. a copy made by sync_local);
+env variable DUCKLAKE_VERIFY_S3_ENDPOINT_URL points the s3 client at another endpoint (e.g. a local S3 stand-in)
+
+run this file via Makefile: 'make verify_lake' (or 'make verify_lake_local')
+or: python3 -m utils.verify_catalog --verify [--local] [--threads 32]
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-import psycopg2
 import os
+from pathlib import Path
+import sys
 
 load_dotenv()
 
 CATALOG_DB_NAME = 'ducklake_catalog'
+NR_LIST_THREADS = 32
+ORPHAN_GRACE_MINUTES = 60
+VERIFY_S3_ENDPOINT_ENV_VAR = 'DUCKLAKE_VERIFY_S3_ENDPOINT_URL'
 
 
 def create_catalog_db_if_not_exists():
+    import psycopg2
+
     con = psycopg2.connect(
         dbname="postgres",
         user=os.environ["DUCKLAKE_CATALOG_PG_USER"],
@@ -30,5 +53,229 @@ def create_catalog_db_if_not_exists():
         con.close()
 
 
+class S3Storage:
+    # r2:// or s3:// paths, via boto3 (the client is thread-safe)
+    def __init__(self, scheme: str):
+        import boto3
+
+        endpoint_url = os.getenv(VERIFY_S3_ENDPOINT_ENV_VAR)
+        if scheme == 'r2':
+            endpoint_url = endpoint_url or f"https://{os.getenv('DUCKLAKE_STORAGE_R2_ACCOUNT_ID')}.r2.cloudflarestorage.com"
+            self.client = boto3.client(
+                service_name="s3",
+                endpoint_url=endpoint_url,
+                aws_access_key_id=os.getenv('DUCKLAKE_STORAGE_S3_KEY_ID'),
+                aws_secret_access_key=os.getenv('DUCKLAKE_STORAGE_S3_SECRET'),
+                region_name="auto",
+            )
+        else:
+            self.client = boto3.client(service_name="s3", endpoint_url=endpoint_url)
+        self.scheme = scheme
+
+    def split(self, path: str) -> tuple[str, str]:
+        bucket, _, key = path.removeprefix(f"{self.scheme}://").partition('/')
+        return bucket, key
+
+    def list_dirs(self, prefix: str) -> tuple[list[str], dict[str, tuple[int, datetime]]]:
+        # one level: the sub directories, and the files directly under prefix
+        bucket, key = self.split(prefix)
+        dirs, files = [], {}
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key, Delimiter='/'):
+            dirs.extend(f"{self.scheme}://{bucket}/{p['Prefix']}" for p in page.get('CommonPrefixes', []))
+            for obj in page.get('Contents', []):
+                files[f"{self.scheme}://{bucket}/{obj['Key']}"] = (obj['Size'], obj['LastModified'])
+        return dirs, files
+
+    def list_files(self, prefix: str) -> dict[str, tuple[int, datetime]]:
+        # recursive: path -> (size, last modified)
+        bucket, key = self.split(prefix)
+        files = {}
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=key):
+            for obj in page.get('Contents', []):
+                files[f"{self.scheme}://{bucket}/{obj['Key']}"] = (obj['Size'], obj['LastModified'])
+        return files
+
+    def head(self, path: str) -> int | None:
+        from botocore.exceptions import ClientError
+
+        bucket, key = self.split(path)
+        try:
+            return self.client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+                return None
+            raise
+
+
+class LocalStorage:
+    # a data path on the local file system
+    def list_dirs(self, prefix: str) -> tuple[list[str], dict[str, tuple[int, datetime]]]:
+        dirs, files = [], {}
+        if os.path.isdir(prefix):
+            for entry in os.scandir(prefix):
+                if entry.is_dir():
+                    dirs.append(os.path.join(prefix, entry.name) + '/')
+                else:
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+        return dirs, files
+
+    def list_files(self, prefix: str) -> dict[str, tuple[int, datetime]]:
+        files = {}
+        for path in Path(prefix).rglob('*'):
+            if path.is_file():
+                stat = path.stat()
+                files[str(path)] = (stat.st_size, datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+        return files
+
+    def head(self, path: str) -> int | None:
+        return os.path.getsize(path) if os.path.isfile(path) else None
+
+
+def get_storage(data_path: str):
+    scheme, sep, _ = data_path.partition('://')
+    if sep and scheme in ['r2', 's3']:
+        return S3Storage(scheme)
+    if sep:
+        raise ValueError(f"verify_lake: unsupported storage: '{data_path}', expected r2://, s3:// or a local path")
+    return LocalStorage()
+
+
+def catalog_files(con) -> tuple[str, list[tuple]]:
+    """
+    All data and delete files in the catalog, with their full path: (schema_name, table_name, table_path, kind, path, size)
+    and the files that are scheduled for deletion (kind 'scheduled', no size): these may or may not exist
+    con: DuckLakeConnection
+    """
+    data_path = con.sql(f"select value from {con.catalog}.ducklake_metadata where key = 'data_path'").fetchone()[0]
+    rows = con.execute(
+        f"""
+        with schemas as (
+          select schema_id, schema_name,
+                 if(coalesce(path_is_relative, true), $data_path || coalesce(path, ''), path) as schema_path
+          from {con.catalog}.ducklake_schema
+          qualify row_number() over (partition by schema_id order by begin_snapshot desc) = 1
+        ),
+        tables as (
+          select t.table_id, s.schema_name, t.table_name,
+                 if(coalesce(t.path_is_relative, true), s.schema_path || coalesce(t.path, ''), t.path) as table_path
+          from {con.catalog}.ducklake_table t join schemas s using (schema_id)
+          qualify row_number() over (partition by t.table_id order by t.begin_snapshot desc) = 1
+        ),
+        files as (
+          select table_id, 'data' as kind, path, path_is_relative, file_size_bytes from {con.catalog}.ducklake_data_file
+          union all
+          select table_id, 'delete' as kind, path, path_is_relative, file_size_bytes from {con.catalog}.ducklake_delete_file
+        )
+        select schema_name, table_name, table_path, kind,
+               if(path_is_relative, table_path || path, path) as full_path, file_size_bytes
+        from files join tables using (table_id)
+        union all
+        select NULL, NULL, NULL, 'scheduled', if(path_is_relative, $data_path || path, path), NULL
+        from {con.catalog}.ducklake_files_scheduled_for_deletion
+        """,
+        {"data_path": data_path},
+    ).fetchall()
+    return data_path, rows
+
+
+def list_storage(storage, data_path: str, nr_threads: int) -> dict[str, tuple[int, datetime]]:
+    # the data path has a directory per schema, with a directory per table: list the tables concurrently
+    schema_dirs, files = storage.list_dirs(data_path)
+    with ThreadPoolExecutor(max_workers=nr_threads) as pool:
+        table_dirs = []
+        for dirs, schema_files in pool.map(storage.list_dirs, schema_dirs):
+            table_dirs.extend(dirs)
+            files.update(schema_files)
+        for table_files in pool.map(storage.list_files, table_dirs):
+            files.update(table_files)
+    return files
+
+
+def verify_lake(con, nr_threads: int = NR_LIST_THREADS) -> dict:
+    """
+    Compare the files of the catalog with the files in storage
+    Returns: {'missing': [...], 'size_mismatch': [...], 'orphaned': [...]}, as (schema.table, path, catalog size, storage size)
+    con: DuckLakeConnection
+    """
+    start = datetime.now()
+    data_path, rows = catalog_files(con)
+    storage = get_storage(data_path)
+    listed = list_storage(storage, data_path, nr_threads)
+    referenced = {row[4]: row for row in rows if row[3] != 'scheduled'}
+    scheduled = {row[4] for row in rows if row[3] == 'scheduled'}
+    # files outside the data path are not listed: HEAD them
+    outside = [path for path in referenced if not path.startswith(data_path)]
+    with ThreadPoolExecutor(max_workers=nr_threads) as pool:
+        for path, size in zip(outside, pool.map(storage.head, outside)):
+            if size is not None:
+                listed[path] = (size, None)
+
+    report = {'missing': [], 'size_mismatch': [], 'orphaned': []}
+    for path, (schema_name, table_name, _, _, _, size) in referenced.items():
+        table = f"{schema_name}.{table_name}"
+        if path not in listed:
+            report['missing'].append((table, path, size, None))
+        elif listed[path][0] != size:
+            report['size_mismatch'].append((table, path, size, listed[path][0]))
+    grace = datetime.now(timezone.utc) - timedelta(minutes=ORPHAN_GRACE_MINUTES)
+    # orphans are attributed to the table whose directory they are in
+    table_paths = sorted({(row[2], f"{row[0]}.{row[1]}") for row in rows if row[2]}, key=lambda t: -len(t[0]))
+    for path, (size, last_modified) in listed.items():
+        if path in referenced or path in scheduled or (last_modified and last_modified > grace):
+            continue
+        table = next((name for table_path, name in table_paths if path.startswith(table_path)), '(no table)')
+        report['orphaned'].append((table, path, None, size))
+    print(
+        f"verify_lake: {len(referenced)} referenced files, {len(listed)} files in storage ({data_path}), "
+        f"verified in {(datetime.now() - start).total_seconds():.1f}s"
+    )
+    return report
+
+
+def print_report(report: dict, max_examples: int = 5):
+    for problem, files in report.items():
+        if not files:
+            print(f"{problem}: none")
+            continue
+        per_table: dict[str, list] = {}
+        for file in files:
+            per_table.setdefault(file[0], []).append(file)
+        print(f"{problem}: {len(files)} files")
+        for table, table_files in sorted(per_table.items()):
+            print(f"  {table}: {len(table_files)} files, {sum((f[2] or f[3] or 0) for f in table_files)} bytes")
+            for _, path, catalog_size, storage_size in table_files[:max_examples]:
+                print(f"    {path} (catalog: {catalog_size}, storage: {storage_size})")
+
+
 if __name__ == "__main__":
-    create_catalog_db_if_not_exists()
+    args = sys.argv[1:]
+
+    def pop_option(name, default=None):
+        if name in args:
+            idx = args.index(name)
+            value = args[idx + 1]
+            del args[idx : idx + 2]
+            return value
+        return default
+
+    if '--verify' in args:
+        from utils.ducklake import DuckLakeConnection
+
+        args.remove('--verify')
+        dl_secret = 'ducklake_secret'
+        if '--local' in args:
+            args.remove('--local')
+            dl_secret = 'ducklake_secret_local'
+        nr_threads = int(pop_option('--threads', NR_LIST_THREADS))
+        if args:
+            raise ValueError(f"Invalid arguments for verify_catalog: {args}")
+        with DuckLakeConnection(dl_secret, read_only=True) as con:
+            report = verify_lake(con, nr_threads)
+        print_report(report)
+        if report['missing'] or report['size_mismatch']:
+            sys.exit(1)
+    elif args:
+        raise ValueError(f"Invalid arguments for verify_catalog: {args}")
+    else:
+        create_catalog_db_if_not_exists()
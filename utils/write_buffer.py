@@ -0,0 +1,125 @@
+"""
+Local write buffer for DuckLakeConnection: coalesces many small appends into one ducklake commit.
+
+Enabled by env variable DUCKLAKE_WRITE_BUFFER_DIR; the buffer of a lake is a local DuckDB file
+<dir>/<lake_secret>.duckdb. Appends via DuckLakeConnection.insert_by_name / insert_tables_by_name (used by
+append_table and store_jobs) then go to the local file instead of the lake (the inserts of one call in one
+transaction, e.g. jobs and their steps), and flush() writes everything that is
+buffered to the lake in one transaction: one snapshot, and a few large Parquet files instead of many
+small ones (or inlined rows that checkpoint() has to flush and merge later).
+
+The buffer is flushed at the end of every feed run (see run_feeds.py), and when it holds more than
+WRITE_BUFFER_MAX_ROWS rows. It is not kept across runs: the feeds decide what to fetch from what is in
+the lake, so rows that stay buffered would be fetched (and appended) again.
+
+Crash safety: the buffer is a durable DuckDB file, and every flush has an id, stored in the lake table
+'write_buffer_flushes' in the same transaction as the data. A buffer that was not flushed (crash) is
+flushed at the start of the next run (recover); if the crash happened after the lake commit but before
+the buffer was cleared, the flush id is found in the lake and the buffer is only cleared.
+"""
+
+from datetime import datetime
+import os
+from pathlib import Path
+import uuid
+
+WRITE_BUFFER_DIR_ENV_VAR = 'DUCKLAKE_WRITE_BUFFER_DIR'
+WRITE_BUFFER_ALIAS = 'write_buffer'
+WRITE_BUFFER_FLUSHES_TABLE = 'write_buffer_flushes'
+WRITE_BUFFER_MAX_ROWS = 1_000_000
+
+
+class WriteBuffer:
+    def __init__(self, buffer_path: str | Path, max_rows: int = WRITE_BUFFER_MAX_ROWS):
+        self.buffer_path = Path(buffer_path)
+        self.max_rows = max_rows
+
+    def attach(self, con):
+        # con: DuckLakeConnection
+        self.buffer_path.parent.mkdir(parents=True, exist_ok=True)
+        con.con.execute(f"ATTACH '{self.buffer_path}' AS {WRITE_BUFFER_ALIAS}")
+        con.con.execute(
+            f"CREATE TABLE IF NOT EXISTS {WRITE_BUFFER_ALIAS}.main.__flush_state (flush_id VARCHAR, created_at TIMESTAMP)"
+        )
+
+    def buffered_tables(self, con) -> list[str]:
+        return [
+            tup[0]
+            for tup in con.con.sql(
+                f"""
+                select table_name from duckdb_tables()
+                where database_name = '{WRITE_BUFFER_ALIAS}' and table_name != '__flush_state'
+                order by table_name
+                """
+            ).fetchall()
+        ]
+
+    def nr_buffered_rows(self, con) -> int:
+        return sum(
+            con.con.sql(f'select count(*) from {WRITE_BUFFER_ALIAS}.main."{table}"').fetchone()[0]
+            for table in self.buffered_tables(con)
+        )
+
+    def append(self, con, inserts: list[tuple[str, str]]):
+        # (table_name, select_sql): buffered in one transaction, so related rows (e.g. jobs and their steps) are
+        # buffered (and recovered after a crash) together
+        for table_name, select_sql in inserts:
+            buffer_table = f'{WRITE_BUFFER_ALIAS}.main."{table_name}"'
+            con.con.execute(f"CREATE TABLE IF NOT EXISTS {buffer_table} AS {select_sql} WITH NO DATA")
+            # additive schema changes (e.g. a column added to a schema registry) are applied to the buffer as well
+            buffer_columns = {tup[0] for tup in con.con.sql(f"select column_name from (describe {buffer_table})").fetchall()}
+            for column_name, column_type in con.con.sql(f"select column_name, column_type from (describe ({select_sql}))").fetchall():
+                if column_name not in buffer_columns:
+                    con.con.execute(f'ALTER TABLE {buffer_table} ADD COLUMN "{column_name}" {column_type}')
+        con.con.execute("BEGIN TRANSACTION")
+        try:
+            for table_name, select_sql in inserts:
+                con.con.execute(f'INSERT INTO {WRITE_BUFFER_ALIAS}.main."{table_name}" BY NAME {select_sql}')
+            if not con.con.sql(f"select 1 from {WRITE_BUFFER_ALIAS}.main.__flush_state").fetchone():
+                con.con.execute(
+                    f"INSERT INTO {WRITE_BUFFER_ALIAS}.main.__flush_state VALUES (?, ?)", [str(uuid.uuid4()), datetime.now()]
+                )
+        except Exception:
+            con.con.execute("ROLLBACK")
+            raise
+        con.con.execute("COMMIT")
+        if self.nr_buffered_rows(con) >= self.max_rows:
+            self.flush(con)
+
+    def flush(self, con):
+        state = con.con.sql(f"select flush_id from {WRITE_BUFFER_ALIAS}.main.__flush_state").fetchone()
+        if not state:
+            return
+        flush_id = state[0]
+        tables = self.buffered_tables(con)
+        con.execute(
+            f"CREATE TABLE IF NOT EXISTS {WRITE_BUFFER_FLUSHES_TABLE} (flush_id VARCHAR, flushed_at TIMESTAMP, nr_rows BIGINT)"
+        )
+        already_flushed = con.execute(
+            f"select 1 from {WRITE_BUFFER_FLUSHES_TABLE} where flush_id = ?", [flush_id]
+        ).fetchone()
+        if already_flushed:
+            print(f"write buffer: flush {flush_id} was already committed to the lake; clearing the buffer")
+        else:
+            nr_rows = self.nr_buffered_rows(con)
+            statements = [
+                f'INSERT INTO "{table}" BY NAME SELECT * FROM {WRITE_BUFFER_ALIAS}.main."{table}"' for table in tables
+            ]
+            statements.append(
+                f"INSERT INTO {WRITE_BUFFER_FLUSHES_TABLE} VALUES ('{flush_id}', now()::TIMESTAMP, {nr_rows})"
+            )
+            con.execute_transaction(statements)
+            print(f"write buffer: flushed {nr_rows} rows into {', '.join(tables)} in one commit", flush=True)
+        # clear the buffer (a separate transaction: a transaction can only write to one database)
+        con.con.execute("BEGIN TRANSACTION")
+        for table in tables:
+            con.con.execute(f'DROP TABLE {WRITE_BUFFER_ALIAS}.main."{table}"')
+        con.con.execute(f"DELETE FROM {WRITE_BUFFER_ALIAS}.main.__flush_state")
+        con.con.execute("COMMIT")
+
+
+def get_write_buffer(lake_secret: str) -> WriteBuffer | None:
+    buffer_dir = os.getenv(WRITE_BUFFER_DIR_ENV_VAR)
+    if not buffer_dir:
+        return None
+    return WriteBuffer(Path(buffer_dir) / f"{lake_secret}.duckdb")